@@ -1,7 +1,39 @@
+import asyncio
+import functools
+import inspect
+import itertools
+import json
+import logging
+import threading
+import time
 from dataclasses import dataclass
 from api.config.base import BaseConfig
-from typing import Optional
-from openai import OpenAI
+from typing import (
+    Any,
+    AsyncIterator,
+    BinaryIO,
+    Callable,
+    Dict,
+    Iterator,
+    List,
+    Optional,
+)
+from api.utils.lazy_module import LazyModule
+from api.utils.metrics import metrics
+from api.utils.request_scheduler import Priority, RequestScheduler, parse_budgets
+from api.utils.single_flight import SingleFlight
+from api.utils.tracing import get_user_id
+from api.utils.translation_batcher import TranslationBatcher
+from api.utils.translation_cache import AsyncTranslationCache, TranslationCache
+
+openai = LazyModule("openai")
+
+logger = logging.getLogger(__name__)
+
+# The only model the audio translation endpoint serves, which always outputs
+# English
+AUDIO_TRANSLATION_MODEL = "whisper-1"
+AUDIO_TRANSLATION_LANGUAGE = "English"
 
 
 @dataclass
@@ -12,6 +44,12 @@ class OpenAIConfig(BaseConfig):
     tts_model: str = "gpt-4o-mini-tts"
     tts_voice: str = "alloy"
     whisper_model: str = "whisper-1"
+    fused_audio_translation_enabled: bool = False
+    translation_batch_window_ms: int = 0
+    translation_batch_max_size: int = 16
+    max_concurrency: int = 0
+    rate_limits: str = ""
+    max_retries: int = None
 
     @classmethod
     def from_env(cls) -> "OpenAIConfig":
@@ -22,6 +60,18 @@ class OpenAIConfig(BaseConfig):
             tts_model=cls.get_str("OPENAI_TTS_MODEL", "gpt-4o-mini-tts"),
             tts_voice=cls.get_str("OPENAI_TTS_VOICE", "alloy"),
             whisper_model=cls.get_str("OPENAI_WHISPER_MODEL", "whisper-1"),
+            fused_audio_translation_enabled=cls.get_bool(
+                "OPENAI_FUSED_AUDIO_TRANSLATION_ENABLED", False
+            ),
+            translation_batch_window_ms=cls.get_int(
+                "OPENAI_TRANSLATION_BATCH_WINDOW_MS", 0
+            ),
+            translation_batch_max_size=cls.get_int(
+                "OPENAI_TRANSLATION_BATCH_MAX_SIZE", 16
+            ),
+            max_concurrency=cls.get_int("OPENAI_MAX_CONCURRENCY", 0),
+            rate_limits=cls.get_str("OPENAI_RATE_LIMITS", ""),
+            max_retries=cls.get_int("OPENAI_MAX_RETRIES", 2),
         )
 
     @classmethod
@@ -37,33 +87,577 @@ class OpenAIConfig(BaseConfig):
             tts_model=override.tts_model or base.tts_model,
             tts_voice=override.tts_voice or base.tts_voice,
             whisper_model=override.whisper_model or base.whisper_model,
+            fused_audio_translation_enabled=override.fused_audio_translation_enabled
+            or base.fused_audio_translation_enabled,
+            translation_batch_window_ms=override.translation_batch_window_ms
+            or base.translation_batch_window_ms,
+            translation_batch_max_size=override.translation_batch_max_size
+            or base.translation_batch_max_size,
+            max_concurrency=override.max_concurrency or base.max_concurrency,
+            rate_limits=override.rate_limits or base.rate_limits,
+            max_retries=(
+                override.max_retries
+                if override.max_retries is not None
+                else base.max_retries
+            ),
+        )
+
+    def is_scheduled(self) -> bool:
+        return self.max_concurrency > 0 or bool(self.rate_limits)
+
+    def create_scheduler(self) -> Optional[RequestScheduler]:
+        if not self.is_scheduled():
+            return None
+        return RequestScheduler(
+            "openai", self.max_concurrency, parse_budgets(self.rate_limits)
         )
 
+    def check_fused_audio_translation(self) -> None:
+        # Called at startup, as the flag silently does nothing for most settings
+        if not self.fused_audio_translation_enabled:
+            return
+        if self.whisper_model != AUDIO_TRANSLATION_MODEL:
+            raise ValueError(
+                "OPENAI_FUSED_AUDIO_TRANSLATION_ENABLED 須搭配 "
+                f"OPENAI_WHISPER_MODEL={AUDIO_TRANSLATION_MODEL}，"
+                f"目前為 {self.whisper_model}"
+            )
+        logger.warning(
+            "OPENAI_FUSED_AUDIO_TRANSLATION_ENABLED only applies to users whose "
+            "audio is translated into %s, audio translated into other languages "
+            "is still transcribed and then translated",
+            AUDIO_TRANSLATION_LANGUAGE,
+        )
+
+    def get_sdk_max_retries(self) -> int:
+        # Scheduled requests are retried by the scheduler, which makes them wait
+        # for their turn again instead of piling up on the server
+        return 0 if self.is_scheduled() else self.max_retries
+
+
+def estimate_tokens(args: tuple, output_tokens: bool) -> int:
+    # About a token per three bytes of UTF-8, which is four characters of English
+    # or one CJK character; a translation returns about as many tokens as it gets
+    size = 0
+    for arg in args:
+        for text in arg if isinstance(arg, list) else (arg,):
+            if isinstance(text, str):
+                size += len(text.encode())
+    tokens = size // 3 + 1
+    return tokens * 2 if output_tokens else tokens
+
+
+def get_retry_after(headers: Any) -> Optional[float]:
+    try:
+        if headers.get("retry-after-ms"):
+            return float(headers["retry-after-ms"]) / 1000
+        if headers.get("retry-after"):
+            return float(headers["retry-after"])
+    except ValueError:
+        # An HTTP date is left to the backoff
+        pass
+    return None
+
+
+def handle_request_error(
+    scheduler: RequestScheduler,
+    model: str,
+    error: Exception,
+    attempt: int,
+    max_retries: int,
+) -> Optional[float]:
+    # Returns how long to sleep before retrying, or None when the error is final
+    backoff = min(0.5 * 2**attempt, 8.0)
+    if isinstance(error, openai.RateLimitError):
+        metrics.increment("openai_rate_limited_total", model=model)
+        # Running out of quota is not solved by waiting
+        if error.code == "insufficient_quota":
+            return None
+        # Every request for the model, the retry included, waits in the queue
+        scheduler.slow_down(model, get_retry_after(error.response.headers) or backoff)
+        return 0.0 if attempt < max_retries else None
+    if isinstance(error, (openai.APIConnectionError, openai.InternalServerError)):
+        return backoff if attempt < max_retries else None
+    return None
+
+
+class ScheduledStream:
+    # Keeps the scheduler slot of a streamed response until the stream is closed,
+    # as the generation goes on while it is read
+    def __init__(self, stream: Any, release: Callable[[], None]):
+        self.stream = stream
+        self.release = release
+        self.closed = False
+
+    def __iter__(self) -> Iterator[Any]:
+        return iter(self.stream)
+
+    def __enter__(self) -> "ScheduledStream":
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback) -> None:
+        self.close()
+
+    def close(self) -> None:
+        if self.closed:
+            return
+        self.closed = True
+        try:
+            self.stream.close()
+        finally:
+            self.release()
+
+
+class AsyncScheduledStream:
+    # ScheduledStream of the async client
+    def __init__(self, stream: Any, release: Callable[[], None]):
+        self.stream = stream
+        self.release = release
+        self.closed = False
+
+    def __aiter__(self) -> AsyncIterator[Any]:
+        return self.stream.__aiter__()
+
+    async def __aenter__(self) -> "AsyncScheduledStream":
+        return self
+
+    async def __aexit__(self, exc_type, exc_value, traceback) -> None:
+        await self.close()
+
+    async def close(self) -> None:
+        if self.closed:
+            return
+        self.closed = True
+        try:
+            await self.stream.close()
+        finally:
+            self.release()
+
+
+def scheduled(
+    priority: Priority,
+    model_field: str,
+    output_tokens: bool = False,
+    streaming: bool = False,
+):
+    # Sends the request through the client's scheduler when one is configured,
+    # which then retries it instead of the SDK. File arguments are rewound to
+    # where they were before every retry. A streaming request returns a
+    # ScheduledStream, or an AsyncScheduledStream from the async client
+    def decorator(func: Callable) -> Callable:
+        if inspect.iscoroutinefunction(func):
+
+            @functools.wraps(func)
+            async def async_wrapper(self, *args, **kwargs):
+                scheduler = self.scheduler
+                if scheduler is None:
+                    return await func(self, *args, **kwargs)
+                model = getattr(self.config, model_field)
+                tokens = estimate_tokens(args, output_tokens)
+                files = [(arg, arg.tell()) for arg in args if hasattr(arg, "seek")]
+                for attempt in itertools.count():
+                    for file, position in files:
+                        file.seek(position)
+                    await scheduler.acquire_async(
+                        model, priority, get_user_id(), tokens
+                    )
+                    released_by_stream = False
+                    try:
+                        result = await func(self, *args, **kwargs)
+                    except Exception as error:
+                        delay = handle_request_error(
+                            scheduler, model, error, attempt, self.config.max_retries
+                        )
+                        if delay is None:
+                            raise
+                    else:
+                        scheduler.speed_up(model)
+                        if streaming:
+                            result = AsyncScheduledStream(result, scheduler.release)
+                            released_by_stream = True
+                        return result
+                    finally:
+                        if not released_by_stream:
+                            scheduler.release()
+                    await asyncio.sleep(delay)
+
+            return async_wrapper
+
+        @functools.wraps(func)
+        def wrapper(self, *args, **kwargs):
+            scheduler = self.scheduler
+            if scheduler is None:
+                return func(self, *args, **kwargs)
+            model = getattr(self.config, model_field)
+            tokens = estimate_tokens(args, output_tokens)
+            files = [(arg, arg.tell()) for arg in args if hasattr(arg, "seek")]
+            for attempt in itertools.count():
+                for file, position in files:
+                    file.seek(position)
+                scheduler.acquire(model, priority, get_user_id(), tokens)
+                released_by_stream = False
+                try:
+                    result = func(self, *args, **kwargs)
+                except Exception as error:
+                    delay = handle_request_error(
+                        scheduler, model, error, attempt, self.config.max_retries
+                    )
+                    if delay is None:
+                        raise
+                else:
+                    scheduler.speed_up(model)
+                    if streaming:
+                        result = ScheduledStream(result, scheduler.release)
+                        released_by_stream = True
+                    return result
+                finally:
+                    if not released_by_stream:
+                        scheduler.release()
+                time.sleep(delay)
+
+        return wrapper
+
+    return decorator
+
 
 class ChatGPT:
-    def __init__(self, config: Optional[OpenAIConfig] = None):
+    # Upload limit of the transcription endpoint
+    WHISPER_MAX_FILE_SIZE = 25 * 1024 * 1024
+
+    def __init__(
+        self,
+        config: Optional[OpenAIConfig] = None,
+        translation_cache: Optional[TranslationCache] = None,
+    ):
         self.config = OpenAIConfig.merge(base=OpenAIConfig.from_env(), override=config)
-        self.client = OpenAI(api_key=self.config.api_key)
+        self.config.check_fused_audio_translation()
+        # The SDK is imported and the client built on the first request
+        self.lock = threading.Lock()
+        self.openai_client: Optional[Any] = None
+        self.scheduler = self.config.create_scheduler()
+        self.translation_cache = translation_cache
+        self.translation_single_flight = SingleFlight("translate")
+        self.translation_batcher = (
+            TranslationBatcher(
+                self.config.translation_batch_window_ms,
+                self.config.translation_batch_max_size,
+                self.request_batch_translation,
+                self.request_translation,
+            )
+            if self.config.translation_batch_window_ms > 0
+            else None
+        )
+
+    @property
+    def client(self) -> Any:
+        if self.openai_client is None:
+            with self.lock:
+                if self.openai_client is None:
+                    self.openai_client = openai.OpenAI(
+                        api_key=self.config.api_key,
+                        max_retries=self.config.get_sdk_max_retries(),
+                    )
+        return self.openai_client
 
     def translate(self, text: str, language: str) -> str:
-        prompt = f"""Translate the provided sentence into the {language}, outputting only the translation."""
+        cache_args = (text, language, self.config.model, self.config.temperature)
+        if self.translation_cache is None:
+            return self.translation_single_flight.do(
+                cache_args, lambda: self.dispatch_translation(text, language)
+            )
+        translated_text = self.translation_cache.get(*cache_args)
+        if translated_text is None:
+            # Identical in-flight translations share one upstream request
+            translated_text = self.translation_single_flight.do(
+                cache_args,
+                lambda: self.translation_cache.load(
+                    *cache_args, lambda: self.dispatch_translation(text, language)
+                ),
+            )
+        return translated_text
+
+    def prefetch_translations(self, texts: List[str], language: str) -> None:
+        if self.translation_cache is not None:
+            self.translation_cache.prefetch(
+                texts, language, self.config.model, self.config.temperature
+            )
+
+    def stream_translate(self, text: str, language: str) -> Iterator[str]:
+        cache_args = (text, language, self.config.model, self.config.temperature)
+        if self.translation_cache is not None:
+            translated_text = self.translation_cache.get(*cache_args)
+            if translated_text is not None:
+                yield translated_text
+                return
+        deltas = []
+        for delta in self.request_translation_stream(text, language):
+            deltas.append(delta)
+            yield delta
+        if self.translation_cache is not None:
+            self.translation_cache.set(*cache_args, "".join(deltas))
+
+    def dispatch_translation(self, text: str, language: str) -> str:
+        if self.translation_batcher is None:
+            return self.request_translation(text, language)
+        return self.translation_batcher.translate(text, language)
+
+    @scheduled(Priority.INTERACTIVE, "model", output_tokens=True)
+    @metrics.external_call("openai", "translate")
+    def request_translation(self, text: str, language: str) -> str:
         response = self.client.responses.create(
             model=self.config.model,
-            instructions=prompt,
+            instructions=self.make_translation_prompt(language),
             input=text,
             temperature=self.config.temperature,
         )
         return response.output_text
 
-    def tts(self, text: str, audio_path: str) -> None:
+    @scheduled(Priority.INTERACTIVE, "model", output_tokens=True)
+    @metrics.external_call("openai", "translate_batch")
+    def request_batch_translation(self, texts: List[str], language: str) -> List[str]:
+        prompt = f"""Translate each sentence in the provided JSON array into the {language}, outputting only the translations in the same order."""
+        response = self.client.responses.create(
+            model=self.config.model,
+            instructions=prompt,
+            input=json.dumps(texts, ensure_ascii=False),
+            temperature=self.config.temperature,
+            text={
+                "format": {
+                    "type": "json_schema",
+                    "name": "translations",
+                    "strict": True,
+                    "schema": {
+                        "type": "object",
+                        "properties": {
+                            "translations": {
+                                "type": "array",
+                                "items": {"type": "string"},
+                            }
+                        },
+                        "required": ["translations"],
+                        "additionalProperties": False,
+                    },
+                }
+            },
+        )
+        # json.JSONDecodeError is a ValueError, which makes the batcher fall back
+        result = json.loads(response.output_text)
+        translations = result.get("translations") if isinstance(result, dict) else None
+        if not isinstance(translations, list) or len(translations) != len(texts):
+            raise ValueError("批次翻譯結果數量不符")
+        return [str(translation) for translation in translations]
+
+    def request_translation_stream(self, text: str, language: str) -> Iterator[str]:
+        # Only the wait for the first delta is timed, the rest of the stream is
+        # paced by whoever consumes it
+        start = time.perf_counter()
+        stream = self.open_translation_stream(text, language)
+        with stream:
+            for event in stream:
+                if event.type == "response.output_text.delta":
+                    if start:
+                        metrics.observe(
+                            "openai_first_delta_seconds", time.perf_counter() - start
+                        )
+                        start = 0.0
+                    yield event.delta
+
+    @scheduled(Priority.INTERACTIVE, "model", output_tokens=True, streaming=True)
+    @metrics.external_call("openai", "translate_stream")
+    def open_translation_stream(self, text: str, language: str) -> Any:
+        return self.client.responses.create(
+            model=self.config.model,
+            instructions=self.make_translation_prompt(language),
+            input=text,
+            temperature=self.config.temperature,
+            stream=True,
+        )
+
+    @staticmethod
+    def make_translation_prompt(language: str) -> str:
+        return f"""Translate the provided sentence into the {language}, outputting only the translation."""
+
+    @scheduled(Priority.BACKGROUND, "tts_model")
+    @metrics.external_call("openai", "tts")
+    def stream_tts(self, text: str, output: BinaryIO, chunk_size: int = 65536) -> None:
+        # The audio replaces whatever follows the position of output, including
+        # what a failed attempt wrote before a retry
+        output.truncate()
         with self.client.audio.speech.with_streaming_response.create(
             model=self.config.tts_model, voice=self.config.tts_voice, input=text
         ) as response:
-            response.stream_to_file(audio_path)
+            for chunk in response.iter_bytes(chunk_size):
+                output.write(chunk)
 
-    def whisper(self, audio_path: str) -> str:
-        with open(audio_path, "rb") as audio_file:
-            transcript = self.client.audio.transcriptions.create(
-                model=self.config.whisper_model, file=audio_file
+    @scheduled(Priority.INTERACTIVE, "whisper_model")
+    @metrics.external_call("openai", "transcribe")
+    def whisper_stream(self, audio: BinaryIO, filename: str) -> str:
+        # The filename tells the API which audio format it receives
+        transcript = self.client.audio.transcriptions.create(
+            model=self.config.whisper_model, file=(filename, audio)
+        )
+        return transcript.text
+
+    def whisper_translate(self, audio: BinaryIO, filename: str, language: str) -> str:
+        # The translation endpoint goes from audio straight to English text in one
+        # round trip, other languages still need a transcription and a translation
+        if (
+            self.config.fused_audio_translation_enabled
+            and language == AUDIO_TRANSLATION_LANGUAGE
+        ):
+            return self.request_audio_translation(audio, filename)
+        return self.translate(self.whisper_stream(audio, filename), language)
+
+    @scheduled(Priority.INTERACTIVE, "whisper_model")
+    @metrics.external_call("openai", "translate_audio")
+    def request_audio_translation(self, audio: BinaryIO, filename: str) -> str:
+        translation = self.client.audio.translations.create(
+            model=self.config.whisper_model, file=(filename, audio)
+        )
+        return translation.text
+
+
+class AsyncChatGPT:
+    def __init__(
+        self,
+        config: Optional[OpenAIConfig] = None,
+        translation_cache: Optional[AsyncTranslationCache] = None,
+    ):
+        self.config = OpenAIConfig.merge(base=OpenAIConfig.from_env(), override=config)
+        self.config.check_fused_audio_translation()
+        self.openai_client: Optional[Any] = None
+        self.scheduler = self.config.create_scheduler()
+        self.translation_cache = translation_cache
+        self.translation_tasks: Dict[tuple, asyncio.Task] = {}
+
+    @property
+    def client(self) -> Any:
+        if self.openai_client is None:
+            self.openai_client = openai.AsyncOpenAI(
+                api_key=self.config.api_key,
+                max_retries=self.config.get_sdk_max_retries(),
             )
+        return self.openai_client
+
+    async def translate(self, text: str, language: str) -> str:
+        cache_args = (text, language, self.config.model, self.config.temperature)
+        if self.translation_cache is not None:
+            translated_text = await self.translation_cache.get(*cache_args)
+            if translated_text is not None:
+                return translated_text
+        # Identical in-flight translations share one upstream request
+        task = self.translation_tasks.get(cache_args)
+        if task is None:
+            task = asyncio.ensure_future(self.load_translation(text, language))
+            self.translation_tasks[cache_args] = task
+            task.add_done_callback(
+                lambda _: self.translation_tasks.pop(cache_args, None)
+            )
+        return await asyncio.shield(task)
+
+    async def stream_translate(self, text: str, language: str) -> AsyncIterator[str]:
+        cache_args = (text, language, self.config.model, self.config.temperature)
+        if self.translation_cache is not None:
+            translated_text = await self.translation_cache.get(*cache_args)
+            if translated_text is not None:
+                yield translated_text
+                return
+        deltas = []
+        async for delta in self.request_translation_stream(text, language):
+            deltas.append(delta)
+            yield delta
+        if self.translation_cache is not None:
+            await self.translation_cache.set(*cache_args, "".join(deltas))
+
+    async def load_translation(self, text: str, language: str) -> str:
+        if self.translation_cache is None:
+            return await self.request_translation(text, language)
+        return await self.translation_cache.load(
+            text,
+            language,
+            self.config.model,
+            self.config.temperature,
+            lambda: self.request_translation(text, language),
+        )
+
+    @scheduled(Priority.INTERACTIVE, "model", output_tokens=True)
+    @metrics.external_call("openai", "translate")
+    async def request_translation(self, text: str, language: str) -> str:
+        response = await self.client.responses.create(
+            model=self.config.model,
+            instructions=ChatGPT.make_translation_prompt(language),
+            input=text,
+            temperature=self.config.temperature,
+        )
+        return response.output_text
+
+    async def request_translation_stream(
+        self, text: str, language: str
+    ) -> AsyncIterator[str]:
+        start = time.perf_counter()
+        stream = await self.open_translation_stream(text, language)
+        async with stream:
+            async for event in stream:
+                if event.type == "response.output_text.delta":
+                    if start:
+                        metrics.observe(
+                            "openai_first_delta_seconds", time.perf_counter() - start
+                        )
+                        start = 0.0
+                    yield event.delta
+
+    @scheduled(Priority.INTERACTIVE, "model", output_tokens=True, streaming=True)
+    @metrics.external_call("openai", "translate_stream")
+    async def open_translation_stream(self, text: str, language: str) -> Any:
+        return await self.client.responses.create(
+            model=self.config.model,
+            instructions=ChatGPT.make_translation_prompt(language),
+            input=text,
+            temperature=self.config.temperature,
+            stream=True,
+        )
+
+    @scheduled(Priority.BACKGROUND, "tts_model")
+    @metrics.external_call("openai", "tts")
+    async def stream_tts(
+        self, text: str, output: BinaryIO, chunk_size: int = 65536
+    ) -> None:
+        output.truncate()
+        async with self.client.audio.speech.with_streaming_response.create(
+            model=self.config.tts_model, voice=self.config.tts_voice, input=text
+        ) as response:
+            async for chunk in response.iter_bytes(chunk_size):
+                output.write(chunk)
+
+    @scheduled(Priority.INTERACTIVE, "whisper_model")
+    @metrics.external_call("openai", "transcribe")
+    async def whisper_stream(self, audio: BinaryIO, filename: str) -> str:
+        transcript = await self.client.audio.transcriptions.create(
+            model=self.config.whisper_model, file=(filename, audio)
+        )
         return transcript.text
+
+    async def whisper_translate(
+        self, audio: BinaryIO, filename: str, language: str
+    ) -> str:
+        if (
+            self.config.fused_audio_translation_enabled
+            and language == AUDIO_TRANSLATION_LANGUAGE
+        ):
+            return await self.request_audio_translation(audio, filename)
+        return await self.translate(
+            await self.whisper_stream(audio, filename), language
+        )
+
+    @scheduled(Priority.INTERACTIVE, "whisper_model")
+    @metrics.external_call("openai", "translate_audio")
+    async def request_audio_translation(self, audio: BinaryIO, filename: str) -> str:
+        translation = await self.client.audio.translations.create(
+            model=self.config.whisper_model, file=(filename, audio)
+        )
+        return translation.text
+
+    async def close(self) -> None:
+        if self.openai_client is not None:
+            await self.openai_client.close()
+            self.openai_client = None
@@ -0,0 +1,347 @@
+import asyncio
+import contextvars
+import io
+import logging
+import os
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
+from typing import Dict
+from dotenv import load_dotenv
+from flask import Config
+from linebot.v3.exceptions import InvalidSignatureError
+from linebot.v3.webhooks import MessageEvent, TextMessageContent, AudioMessageContent
+from api.ai.chatgpt import AsyncChatGPT
+from api.bot.line import AsyncLine
+from api.bot.message_handler import (
+    DEFAULT_USER_SETTINGS,
+    USER_AUDIO_LANGUAGE_KEY,
+    USER_TRANSLATE_LANGUAGE_KEY,
+    AsyncTranslationReplier,
+    create_audio_rejection,
+    create_audio_spool,
+    create_command_reply,
+    get_settings_changes,
+)
+from api.config.key import ConfigKey
+from api.config.loader import ConfigLoader
+from api.media.tinytag import TinyTagMedia
+from api.storage.cache import (
+    AsyncMultiTierCacheAdapter,
+    CacheConfig,
+    MultiTierCacheAdapter,
+)
+from api.storage.minio import MinioStorage
+from api.utils.audio_processor import AudioProcessor
+from api.utils.event_deduplicator import (
+    AsyncEventDeduplicator,
+    EventDeduplicatorConfig,
+)
+from api.utils.event_dispatcher import get_chat_id, get_sender_id
+from api.utils.lazy_module import LazyModule
+from api.utils.metrics import metrics
+from api.utils.segmented_translator import AsyncSegmentedTranslator
+from api.utils.text_segmenter import TextSegmenter
+from api.utils.tracing import enable_trace_id_logging, trace
+from api.utils.translation_cache import AsyncTranslationCache, TranslationCacheConfig
+from api.utils.user_settings_manager import (
+    AsyncUserSettingsManager,
+    UserSettingsConfig,
+)
+
+logger = logging.getLogger(__name__)
+
+load_dotenv()
+
+# Message models are only needed once a reply is sent
+messaging = LazyModule("linebot.v3.messaging")
+
+config = Config(os.getcwd())
+ConfigLoader().load(config)
+app_name = config.get(ConfigKey.APP_NAME)
+app_persistent_user_settings_enabled = config.get(
+    ConfigKey.APP_PERSISTENT_USER_SETTINGS_ENABLED
+)
+app_remote_cache_enabled = config.get(ConfigKey.APP_REMOTE_CACHE_ENABLED)
+app_push_translated_text_audio_enabled = config.get(
+    ConfigKey.APP_PUSH_TRANSLATED_TEXT_AUDIO_ENABLED
+)
+app_translation_cache_enabled = config.get(ConfigKey.APP_TRANSLATION_CACHE_ENABLED)
+app_async_max_concurrency = config.get(ConfigKey.APP_ASYNC_MAX_CONCURRENCY)
+app_metrics_token = config.get(ConfigKey.APP_METRICS_TOKEN)
+if config.get(ConfigKey.APP_TRACE_ID_ENABLED):
+    enable_trace_id_logging()
+
+translation_cache_config = TranslationCacheConfig.from_env()
+chatgpt = AsyncChatGPT(
+    translation_cache=(
+        AsyncTranslationCache(
+            AsyncMultiTierCacheAdapter(
+                CacheConfig(
+                    lru_size=translation_cache_config.lru_size,
+                    remote_cache_enabled=app_remote_cache_enabled,
+                    ttl=translation_cache_config.ttl,
+                    max_bytes=translation_cache_config.max_bytes,
+                    namespace="translation",
+                )
+            ),
+            app_name,
+            translation_cache_config.lock_seconds,
+        )
+        if app_translation_cache_enabled
+        else None
+    )
+)
+line = AsyncLine()
+translation_replier = AsyncTranslationReplier(
+    config, line, AsyncSegmentedTranslator(chatgpt, TextSegmenter())
+)
+# MinIO and TinyTag have no async client, so they run on this executor
+audio_processor = AudioProcessor(
+    (
+        MinioStorage(expiring_prefixes=AudioProcessor.OBJECT_PREFIXES)
+        if app_push_translated_text_audio_enabled
+        else None
+    ),
+    TinyTagMedia() if app_push_translated_text_audio_enabled else None,
+    app_name,
+    MultiTierCacheAdapter(
+        CacheConfig(
+            lru_size=translation_cache_config.audio_lru_size,
+            remote_cache_enabled=app_remote_cache_enabled,
+            ttl=translation_cache_config.ttl,
+            max_bytes=translation_cache_config.audio_max_bytes,
+            namespace="audio",
+        )
+    ),
+)
+storage_executor = ThreadPoolExecutor(thread_name_prefix="storage")
+
+user_settings_config = UserSettingsConfig.from_env()
+user_settings_manager = AsyncUserSettingsManager(
+    AsyncMultiTierCacheAdapter(
+        CacheConfig(
+            remote_cache_enabled=app_persistent_user_settings_enabled,
+            local_ttl=user_settings_config.ttl,
+            max_bytes=user_settings_config.max_bytes,
+            namespace="settings",
+        )
+    ),
+    app_name,
+)
+event_deduplicator_config = EventDeduplicatorConfig.from_env()
+event_deduplicator = (
+    AsyncEventDeduplicator(
+        AsyncMultiTierCacheAdapter(
+            CacheConfig(
+                lru_size=event_deduplicator_config.lru_size,
+                remote_cache_enabled=app_remote_cache_enabled,
+                ttl=event_deduplicator_config.ttl,
+                namespace="webhook_events",
+            )
+        ),
+        app_name,
+    )
+    if event_deduplicator_config.ttl > 0
+    else None
+)
+
+
+class WebhookApp:
+    # Minimal ASGI app: acknowledges LINE right away and handles each event in its
+    # own task, at most app_async_max_concurrency at a time. A task waits for the
+    # previous event of the same chat, so each chat is handled in order
+    def __init__(self, max_concurrency: int):
+        self.semaphore = asyncio.Semaphore(max_concurrency)
+        self.tasks = set()
+        self.chat_tasks: Dict[str, asyncio.Task] = {}
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] == "lifespan":
+            await self.lifespan(receive, send)
+        elif scope["type"] == "http":
+            status, text = await self.route(scope, receive)
+            await send(
+                {
+                    "type": "http.response.start",
+                    "status": status,
+                    "headers": [(b"content-type", b"text/plain; charset=utf-8")],
+                }
+            )
+            await send({"type": "http.response.body", "body": text.encode()})
+
+    async def route(self, scope, receive):
+        if scope["path"] == "/":
+            return 200, "OK"
+        if scope["path"] == "/metrics" and app_metrics_token:
+            # Served only when APP_METRICS_TOKEN is set, to scrapes that send it
+            headers = dict(scope["headers"])
+            authorization = headers.get(b"authorization", b"").decode()
+            if not metrics.is_scrape_allowed(authorization, app_metrics_token):
+                return 401, "Unauthorized"
+            return 200, metrics.render()
+        if scope["path"] == "/webhook" and scope["method"] == "POST":
+            headers = dict(scope["headers"])
+            signature = headers.get(b"x-line-signature", b"").decode()
+            body = await self.read_body(receive)
+            try:
+                payload = line.handler.parse(body, signature)
+            except InvalidSignatureError:
+                return 400, "Bad Request"
+            events = payload.events
+            if event_deduplicator is not None:
+                events = await event_deduplicator.filter(events)
+            for event in events:
+                self.spawn(event, payload)
+            return 200, "OK"
+        return 404, "Not Found"
+
+    def spawn(self, event, payload) -> None:
+        chat_id = get_chat_id(event)
+        previous = self.chat_tasks.get(chat_id) if chat_id else None
+        task = asyncio.create_task(self.run(event, payload, previous))
+        self.tasks.add(task)
+        task.add_done_callback(self.tasks.discard)
+        if chat_id:
+            self.chat_tasks[chat_id] = task
+            task.add_done_callback(partial(self.forget_chat_task, chat_id))
+
+    def forget_chat_task(self, chat_id, task) -> None:
+        if self.chat_tasks.get(chat_id) is task:
+            del self.chat_tasks[chat_id]
+
+    async def run(self, event, payload, previous) -> None:
+        # Each task has its own context, so the trace ID stays with this event
+        with trace(getattr(event, "webhook_event_id", None), get_sender_id(event)):
+            if previous is not None:
+                # A failure of the previous event is logged by its own task
+                await asyncio.wait([previous])
+            async with self.semaphore:
+                try:
+                    handling = line.handler.dispatch(event, payload)
+                    if handling is not None:
+                        with metrics.timer("webhook_handle_seconds"):
+                            await handling
+                except Exception:
+                    metrics.increment("webhook_events_failed_total")
+                    logger.exception("Failed to handle webhook event")
+                    if event_deduplicator is not None:
+                        await event_deduplicator.release(event)
+
+    async def lifespan(self, receive, send):
+        while True:
+            message = await receive()
+            if message["type"] == "lifespan.startup":
+                await send({"type": "lifespan.startup.complete"})
+            elif message["type"] == "lifespan.shutdown":
+                # Let in-flight events finish before the clients are closed
+                await asyncio.gather(*self.tasks, return_exceptions=True)
+                await line.close()
+                await chatgpt.close()
+                storage_executor.shutdown()
+                await send({"type": "lifespan.shutdown.complete"})
+                return
+
+    @staticmethod
+    async def read_body(receive) -> str:
+        body = b""
+        while True:
+            message = await receive()
+            body += message.get("body", b"")
+            if not message.get("more_body", False):
+                return body.decode()
+
+
+app = WebhookApp(app_async_max_concurrency)
+
+
+@line.handler.add(MessageEvent, message=TextMessageContent)
+async def handle_text_message(event):
+    user_id = event.source.user_id
+    user_settings = await user_settings_manager.get_or_init_settings(
+        user_id, DEFAULT_USER_SETTINGS
+    )
+    user_input = event.message.text
+    settings_changes = get_settings_changes(user_input)
+    if settings_changes is not None:
+        user_settings = await user_settings_manager.set_settings(
+            user_id, settings_changes
+        )
+    command_reply = create_command_reply(user_input, user_settings)
+    if command_reply is not None:
+        await line.reply_message(event.reply_token, command_reply)
+        return
+    # Show loading animation
+    await line.show_loading_animation(user_id)
+    # Reply translated text, then push its audio when enabled
+    await translation_replier.reply_translation(
+        event.reply_token,
+        user_id,
+        user_input,
+        user_settings[USER_TRANSLATE_LANGUAGE_KEY],
+        (
+            prepare_translated_text_audio
+            if app_push_translated_text_audio_enabled
+            else None
+        ),
+    )
+
+
+@line.handler.add(MessageEvent, message=AudioMessageContent)
+async def handle_audio_message(event):
+    user_id = event.source.user_id
+    user_settings = await user_settings_manager.get_or_init_settings(
+        user_id, DEFAULT_USER_SETTINGS
+    )
+    message_id = event.message.id
+    # Show loading animation
+    await line.show_loading_animation(user_id)
+    # Read audio message for whisper api input
+    user_audio = await line.get_audio_by_message(message_id)
+    audio_rejection = create_audio_rejection(user_audio)
+    if audio_rejection is not None:
+        await line.reply_message(event.reply_token, audio_rejection)
+        return
+    # The audio is already in memory and below the whisper size limit
+    with io.BytesIO(user_audio) as user_audio_file:
+        # Translate text from whisper api output
+        translated_text = await chatgpt.whisper_translate(
+            user_audio_file, f"{message_id}.m4a", user_settings[USER_AUDIO_LANGUAGE_KEY]
+        )
+    # Reply translated text
+    await line.reply_message(
+        event.reply_token, messaging.TextMessage(text=translated_text)
+    )
+
+
+async def prepare_translated_text_audio(translated_text):
+    # Reuse the audio of an identical translated text if it was synthesized before
+    translated_text_audio_key = audio_processor.make_shared_audio_key(
+        translated_text, chatgpt.config.tts_model, chatgpt.config.tts_voice
+    )
+    translated_text_audio_url, translated_text_audio_duration = await asyncio.gather(
+        run_blocking(audio_processor.get_shared_audio_url, translated_text_audio_key),
+        run_blocking(
+            audio_processor.get_shared_audio_duration, translated_text_audio_key
+        ),
+    )
+    if translated_text_audio_duration is None:
+        with create_audio_spool(config) as translated_text_audio:
+            await chatgpt.stream_tts(translated_text, translated_text_audio)
+            # Operate audio with remote storage
+            translated_text_audio_duration = await run_blocking(
+                audio_processor.get_stream_duration, translated_text_audio
+            )
+            await run_blocking(
+                audio_processor.upload_shared_audio,
+                translated_text_audio_key,
+                translated_text_audio,
+                translated_text_audio_duration,
+            )
+    return translated_text_audio_url, translated_text_audio_duration
+
+
+def run_blocking(func, *args):
+    # The executor thread keeps the trace ID of the calling task
+    return asyncio.get_running_loop().run_in_executor(
+        storage_executor, partial(contextvars.copy_context().run, func, *args)
+    )
@@ -1,28 +1,49 @@
+import asyncio
+import inspect
+import socket
+import threading
+import uuid
 from dataclasses import dataclass
 from api.config.base import BaseConfig
-from typing import Any, Optional
+from api.utils.metrics import metrics
+from api.utils.lazy_module import LazyModule
+from typing import Any, Awaitable, Callable, Dict, List, Optional
+from urllib3.connection import HTTPConnection
+from urllib3.util.retry import Retry
 from linebot.v3 import WebhookHandler
-from linebot.v3.messaging import (
-    Configuration,
-    ApiClient,
-    MessagingApi,
-    MessagingApiBlob,
-    ShowLoadingAnimationRequest,
-    ReplyMessageRequest,
-    PushMessageRequest,
-)
+from linebot.v3.webhooks import MessageEvent
+
+# The messaging SDK takes most of the import time, parsing webhooks does not
+# need it
+messaging = LazyModule("linebot.v3.messaging")
+aiohttp = LazyModule("aiohttp")
+
+DEFAULT_API_HOST = "https://api.line.me"
+DEFAULT_DATA_API_HOST = "https://api-data.line.me"
 
 
 @dataclass
 class LineConfig(BaseConfig):
     access_token: str
     channel_secret: str
+    # Unset fields take the value from the environment
+    connection_pool_size: int = None
+    retries: int = None
+    retry_backoff: float = None
+    # Replace the LINE API hosts, e.g. with a local stand-in for load tests
+    api_host: str = None
+    data_api_host: str = None
 
     @classmethod
     def from_env(cls) -> "LineConfig":
         return cls(
             access_token=cls.get_required("LINE_CHANNEL_ACCESS_TOKEN"),
             channel_secret=cls.get_required("LINE_CHANNEL_SECRET"),
+            connection_pool_size=cls.get_int("LINE_CONNECTION_POOL_SIZE", 10),
+            retries=cls.get_int("LINE_RETRIES", 3),
+            retry_backoff=cls.get_float("LINE_RETRY_BACKOFF", 0.5),
+            api_host=cls.get_str("LINE_API_HOST"),
+            data_api_host=cls.get_str("LINE_DATA_API_HOST"),
         )
 
     @classmethod
@@ -34,40 +55,257 @@ class LineConfig(BaseConfig):
         return cls(
             access_token=override.access_token or base.access_token,
             channel_secret=override.channel_secret or base.channel_secret,
+            connection_pool_size=override.connection_pool_size
+            or base.connection_pool_size,
+            retries=override.retries if override.retries is not None else base.retries,
+            retry_backoff=(
+                override.retry_backoff
+                if override.retry_backoff is not None
+                else base.retry_backoff
+            ),
+            api_host=override.api_host or base.api_host,
+            data_api_host=override.data_api_host or base.data_api_host,
+        )
+
+    def to_configuration(self) -> Any:
+        configuration = messaging.Configuration(access_token=self.access_token)
+        configuration.connection_pool_maxsize = self.connection_pool_size
+        # Connection errors are retried for every method, error statuses only for
+        # idempotent ones so a reply or push is never sent twice
+        configuration.retries = Retry(
+            total=self.retries,
+            backoff_factor=self.retry_backoff,
+            status_forcelist=(429, 500, 502, 503, 504),
         )
+        configuration.socket_options = HTTPConnection.default_socket_options + [
+            (socket.SOL_SOCKET, socket.SO_KEEPALIVE, 1)
+        ]
+        return configuration
+
+    def get_hosts(self) -> Dict[str, str]:
+        hosts = {}
+        if self.api_host:
+            hosts[DEFAULT_API_HOST] = self.api_host
+        if self.data_api_host:
+            hosts[DEFAULT_DATA_API_HOST] = self.data_api_host
+        return hosts
+
+    def create_api_client(self, api_client_class: type) -> Any:
+        api_client = api_client_class(self.to_configuration())
+        hosts = self.get_hosts()
+        if hosts:
+            # The generated APIs hardcode their hosts, so they are swapped per call
+            call_api = api_client.call_api
+            api_client.call_api = lambda *args, _host=None, **kwargs: call_api(
+                *args, _host=hosts.get(_host, _host), **kwargs
+            )
+        return api_client
+
+
+class LineWebhookHandler(WebhookHandler):
+    # Splits WebhookHandler.handle into parse and per-event dispatch so events
+    # can be processed outside of the webhook request
+    def parse(self, body: str, signature: str) -> Any:
+        return self.parser.parse(body, signature, as_payload=True)
+
+    def dispatch(self, event: Any, payload: Any) -> Any:
+        # Returns whatever the handler returns, a coroutine for async handlers
+        func = None
+        if isinstance(event, MessageEvent):
+            func = self._handlers.get(
+                f"{event.__class__.__name__}_{event.message.__class__.__name__}"
+            )
+        if func is None:
+            func = self._handlers.get(event.__class__.__name__)
+        if func is None:
+            func = self._default
+        if func is None:
+            return None
+        arg_spec = inspect.getfullargspec(func)
+        if arg_spec.varargs is not None or len(arg_spec.args) == 2:
+            return func(event, payload.destination)
+        elif len(arg_spec.args) == 1:
+            return func(event)
+        else:
+            return func()
+
+    def handle(self, body: str, signature: str) -> None:
+        payload = self.parse(body, signature)
+        for event in payload.events:
+            self.dispatch(event, payload)
 
 
 class Line:
+    # Limits of the Messaging API for one request and one text message
+    MAX_MESSAGES_PER_REQUEST = 5
+    MAX_TEXT_LENGTH = 5000
+
     def __init__(self, config: Optional[LineConfig] = None):
         self.config = LineConfig.merge(base=LineConfig.from_env(), override=config)
-        self.configuration = Configuration(access_token=self.config.access_token)
-        self.handler = WebhookHandler(self.config.channel_secret)
+        self.handler = LineWebhookHandler(self.config.channel_secret)
+        # One client per process keeps the connection pool alive across requests,
+        # it is created on first use so requests that send nothing skip the SDK
+        self.lock = threading.Lock()
+        self.api_client: Optional[Any] = None
+        self.messaging_api: Optional[Any] = None
+        self.messaging_blob_api: Optional[Any] = None
 
+    @metrics.external_call("line", "loading")
     def show_loading_animation(self, chat_id: str) -> None:
-        with ApiClient(self.configuration) as api_client:
-            messaging_api = MessagingApi(api_client)
-            messaging_api.show_loading_animation(
-                ShowLoadingAnimationRequest(chatId=chat_id, loadingSeconds=60),
-            )
+        self.get_messaging_api().show_loading_animation(
+            messaging.ShowLoadingAnimationRequest(chatId=chat_id, loadingSeconds=60),
+        )
 
-    def write_audio_by_message(self, message_id: str, audio_path: str) -> None:
-        with ApiClient(self.configuration) as api_client:
-            messaging_blob_api = MessagingApiBlob(api_client)
-            with open(audio_path, "wb") as audio_file:
-                audio_file.write(
-                    messaging_blob_api.get_message_content(message_id=message_id)
-                )
+    @metrics.external_call("line", "content")
+    def get_audio_by_message(self, message_id: str) -> bytes:
+        return self.get_messaging_blob_api().get_message_content(message_id=message_id)
 
+    @metrics.external_call("line", "reply")
     def reply_message(self, reply_token: str, message: Any) -> None:
-        with ApiClient(self.configuration) as api_client:
-            messaging_api = MessagingApi(api_client)
-            messaging_api.reply_message(
-                ReplyMessageRequest(reply_token=reply_token, messages=[message]),
-            )
+        self.get_messaging_api().reply_message(
+            messaging.ReplyMessageRequest(reply_token=reply_token, messages=[message]),
+        )
+
+    @metrics.external_call("line", "reply")
+    def reply_messages(self, reply_token: str, messages: List[Any]) -> None:
+        self.get_messaging_api().reply_message(
+            messaging.ReplyMessageRequest(reply_token=reply_token, messages=messages),
+        )
 
+    @metrics.external_call("line", "push")
     def push_message(self, chat_id: str, message: Any) -> None:
-        with ApiClient(self.configuration) as api_client:
-            messaging_api = MessagingApi(api_client)
-            messaging_api.push_message(
-                PushMessageRequest(to=chat_id, messages=[message]),
+        self.get_messaging_api().push_message(
+            messaging.PushMessageRequest(to=chat_id, messages=[message]),
+        )
+
+    @metrics.external_call("line", "push")
+    def push_messages(self, chat_id: str, messages: List[Any]) -> None:
+        self.get_messaging_api().push_message(
+            messaging.PushMessageRequest(to=chat_id, messages=messages),
+        )
+
+    def close(self) -> None:
+        if self.api_client is not None:
+            self.api_client.close()
+            self.api_client = None
+
+    def get_messaging_api(self) -> Any:
+        self.open()
+        return self.messaging_api
+
+    def get_messaging_blob_api(self) -> Any:
+        self.open()
+        return self.messaging_blob_api
+
+    def open(self) -> None:
+        if self.api_client is not None:
+            return
+        with self.lock:
+            if self.api_client is None:
+                api_client = self.config.create_api_client(messaging.ApiClient)
+                self.messaging_api = messaging.MessagingApi(api_client)
+                self.messaging_blob_api = messaging.MessagingApiBlob(api_client)
+                self.api_client = api_client
+
+
+class AsyncLine:
+    def __init__(self, config: Optional[LineConfig] = None):
+        self.config = LineConfig.merge(base=LineConfig.from_env(), override=config)
+        self.handler = LineWebhookHandler(self.config.channel_secret)
+        # The aiohttp session must be created inside the running event loop
+        self.api_client: Optional[Any] = None
+        self.messaging_api: Optional[Any] = None
+        self.messaging_blob_api: Optional[Any] = None
+
+    @metrics.external_call("line", "loading")
+    async def show_loading_animation(self, chat_id: str) -> None:
+        await self.with_retries(
+            lambda: self.get_messaging_api().show_loading_animation(
+                messaging.ShowLoadingAnimationRequest(
+                    chatId=chat_id, loadingSeconds=60
+                ),
+            )
+        )
+
+    @metrics.external_call("line", "content")
+    async def get_audio_by_message(self, message_id: str) -> bytes:
+        return await self.with_retries(
+            lambda: self.get_messaging_blob_api().get_message_content(
+                message_id=message_id
+            )
+        )
+
+    async def reply_message(self, reply_token: str, message: Any) -> None:
+        await self.reply_messages(reply_token, [message])
+
+    @metrics.external_call("line", "reply")
+    async def reply_messages(self, reply_token: str, messages: List[Any]) -> None:
+        # A reply may have been accepted when the connection broke, and its token
+        # is used up then, so it is only retried if the connection was never made
+        await self.with_retries(
+            lambda: self.get_messaging_api().reply_message(
+                messaging.ReplyMessageRequest(
+                    reply_token=reply_token, messages=messages
+                ),
+            ),
+            aiohttp.ClientConnectorError,
+        )
+
+    async def push_message(self, chat_id: str, message: Any) -> None:
+        await self.push_messages(chat_id, [message])
+
+    @metrics.external_call("line", "push")
+    async def push_messages(self, chat_id: str, messages: List[Any]) -> None:
+        # LINE accepts a push once per retry key and answers a repeat with 409, so
+        # a push whose response was lost is retried without being sent twice
+        retry_key = str(uuid.uuid4())
+        await self.with_retries(
+            lambda: self.send_push(
+                messaging.PushMessageRequest(to=chat_id, messages=messages),
+                retry_key,
+            )
+        )
+
+    async def send_push(self, request: Any, retry_key: str) -> None:
+        try:
+            await self.get_messaging_api().push_message(
+                request, x_line_retry_key=retry_key
             )
+        except messaging.ApiException as error:
+            if error.status != 409:
+                raise
+
+    async def close(self) -> None:
+        if self.api_client is not None:
+            await self.api_client.close()
+            self.api_client = None
+
+    def get_messaging_api(self) -> Any:
+        self.open()
+        return self.messaging_api
+
+    def get_messaging_blob_api(self) -> Any:
+        self.open()
+        return self.messaging_blob_api
+
+    def open(self) -> None:
+        if self.api_client is None:
+            self.api_client = self.config.create_api_client(messaging.AsyncApiClient)
+            self.messaging_api = messaging.AsyncMessagingApi(self.api_client)
+            self.messaging_blob_api = messaging.AsyncMessagingApiBlob(self.api_client)
+
+    async def with_retries(
+        self,
+        request: Callable[[], Awaitable[Any]],
+        retried_error: Optional[type] = None,
+    ) -> Any:
+        # The async client ignores Configuration.retries, so connection errors are
+        # retried here with the same backoff
+        retried_error = retried_error or aiohttp.ClientConnectionError
+        for attempt in range(self.config.retries + 1):
+            try:
+                return await request()
+            except retried_error:
+                if attempt == self.config.retries:
+                    raise
+                await asyncio.sleep(self.config.retry_backoff * (2**attempt))
@@ -0,0 +1,289 @@
+import asyncio
+from concurrent.futures import Future
+from tempfile import SpooledTemporaryFile
+from typing import Any, Awaitable, Callable, List, Mapping, Optional, Tuple
+from api.ai.chatgpt import ChatGPT
+from api.bot.line import AsyncLine, Line
+from api.config.key import ConfigKey
+from api.config.language import lang_dict, reverse_lang_dict
+from api.utils.lazy_module import LazyModule
+from api.utils.segmented_translator import (
+    AsyncSegmentedTranslator,
+    SegmentedTranslator,
+)
+from api.utils.text_segmenter import TextSegmenter
+
+# What the bot replies, shared by the Flask (api/index.py) and the ASGI
+# (api/asgi.py) entry points, which only differ in how they call the services
+
+# Message models are only needed once a reply is sent
+messaging = LazyModule("linebot.v3.messaging")
+
+USER_TRANSLATE_LANGUAGE_KEY = "translate_language"
+USER_AUDIO_LANGUAGE_KEY = "audio_language"
+DEFAULT_USER_SETTINGS = {
+    USER_TRANSLATE_LANGUAGE_KEY: "English",
+    USER_AUDIO_LANGUAGE_KEY: "Traditional Chinese",
+}
+SETTING_COMMANDS = ("/setting", "設定")
+CURRENT_SETTING_COMMANDS = ("/current-setting", "目前設定")
+# Sent back by the quick replies of the setting command, followed by the language
+AUDIO_LANGUAGE_PREFIX = "設定語音辨識後翻譯為 "
+TRANSLATE_LANGUAGE_PREFIX = "設定打字後翻譯為 "
+
+
+def get_settings_changes(user_input: str) -> Optional[dict]:
+    # Settings picked from the quick replies, None if the input sets nothing
+    if AUDIO_LANGUAGE_PREFIX.strip() in user_input:
+        return {USER_AUDIO_LANGUAGE_KEY: lang_dict[user_input.split(" ")[1]]}
+    if TRANSLATE_LANGUAGE_PREFIX.strip() in user_input:
+        return {USER_TRANSLATE_LANGUAGE_KEY: lang_dict[user_input.split(" ")[1]]}
+    return None
+
+
+def create_command_reply(user_input: str, user_settings: Mapping) -> Optional[Any]:
+    # Reply to a setting command, given the settings after its changes. None for
+    # text to translate
+    if user_input in SETTING_COMMANDS:
+        return create_language_menu("請選擇我方使用語言", AUDIO_LANGUAGE_PREFIX)
+    if AUDIO_LANGUAGE_PREFIX.strip() in user_input:
+        return create_language_menu("請選擇對方使用語言", TRANSLATE_LANGUAGE_PREFIX)
+    if TRANSLATE_LANGUAGE_PREFIX.strip() in user_input:
+        return messaging.TextMessage(
+            text=f"設定完畢！\n{format_settings(user_settings)}"
+        )
+    if user_input in CURRENT_SETTING_COMMANDS:
+        return messaging.TextMessage(text=format_settings(user_settings))
+    return None
+
+
+def create_language_menu(text: str, prefix: str) -> Any:
+    return messaging.TextMessage(
+        text=text,
+        quick_reply=messaging.QuickReply(
+            items=[
+                messaging.QuickReplyItem(
+                    action=messaging.MessageAction(
+                        label=language, text=prefix + language
+                    )
+                )
+                for language in lang_dict
+            ]
+        ),
+    )
+
+
+def format_settings(user_settings: Mapping) -> str:
+    audio_language = user_settings[USER_AUDIO_LANGUAGE_KEY]
+    translate_language = user_settings[USER_TRANSLATE_LANGUAGE_KEY]
+    return f"""我方語言：{reverse_lang_dict[audio_language]}（{audio_language}）
+對方語言：{reverse_lang_dict[translate_language]}（{translate_language}）"""
+
+
+def create_audio_rejection(user_audio: bytes) -> Optional[Any]:
+    # Reply to audio whisper cannot take, None if it can be translated
+    if len(user_audio) > ChatGPT.WHISPER_MAX_FILE_SIZE:
+        return messaging.TextMessage(text="語音訊息過長，無法辨識")
+    return None
+
+
+def create_audio_message(url: str, duration: float) -> Any:
+    return messaging.AudioMessage(originalContentUrl=url, duration=int(duration * 1000))
+
+
+def create_text_messages(text_segmenter: TextSegmenter, text: str) -> List[Any]:
+    return [
+        messaging.TextMessage(text=chunk.strip())
+        for chunk in text_segmenter.split_text(text, Line.MAX_TEXT_LENGTH)
+        if chunk.strip()
+    ]
+
+
+def batch_messages(messages: List[Any]) -> List[List[Any]]:
+    # A reply or push carries a limited number of messages
+    return [
+        messages[start : start + Line.MAX_MESSAGES_PER_REQUEST]
+        for start in range(0, len(messages), Line.MAX_MESSAGES_PER_REQUEST)
+    ]
+
+
+def is_streamed_translation(config: Mapping, text: str) -> bool:
+    # Long texts are translated as a stream, so their first sentences are replied
+    # while the rest is generated
+    if not config.get(ConfigKey.APP_STREAMING_REPLY_ENABLED):
+        return False
+    return len(text) >= config.get(ConfigKey.APP_STREAMING_REPLY_MIN_LENGTH)
+
+
+def create_audio_spool(config: Mapping) -> SpooledTemporaryFile:
+    # Synthesized audio is kept in memory unless it is large
+    return SpooledTemporaryFile(
+        max_size=config.get(ConfigKey.AUDIO_SPOOL_MAX_SIZE),
+        dir=config.get(ConfigKey.AUDIO_TEMP_PATH),
+    )
+
+
+class StreamedTranslation:
+    # Collects a streamed translation and hands out its first complete sentences,
+    # to be replied while the rest streams in
+    def __init__(self, text_segmenter: TextSegmenter):
+        self.text_segmenter = text_segmenter
+        self.text = ""
+        self.replied_length = 0
+
+    def add(self, delta: str) -> Optional[str]:
+        # The first sentences are handed out once more output arrives after them,
+        # so a translation that comes back in one piece is replied as a whole
+        first_sentences = None
+        if self.replied_length == 0:
+            sentence_end = self.text_segmenter.find_sentence_end(self.text, final=False)
+            if sentence_end > 0:
+                first_sentences = self.text[:sentence_end]
+                self.replied_length = sentence_end
+        self.text += delta
+        return first_sentences
+
+    def finish(self) -> Tuple[Optional[str], str]:
+        # The text still to reply, if nothing was, and the text to push
+        if self.replied_length == 0:
+            return self.text, ""
+        return None, self.text[self.replied_length :]
+
+
+# Prepares the audio of a translated text, returning its URL and duration
+AudioPreparer = Callable[[str], Future]
+AsyncAudioPreparer = Callable[[str], Awaitable[Tuple[str, float]]]
+
+
+class TranslationReplier:
+    # Translates a text message and replies the translation, split into as many
+    # messages as it takes; those that do not fit into the reply are pushed. The
+    # audio of the translation, when asked for, is prepared while the text is
+    # replied and pushed after it
+    def __init__(
+        self,
+        config: Mapping,
+        line: Line,
+        segmented_translator: SegmentedTranslator,
+    ):
+        self.config = config
+        self.line = line
+        self.segmented_translator = segmented_translator
+        self.chatgpt = segmented_translator.chatgpt
+        self.text_segmenter = segmented_translator.text_segmenter
+
+    def reply_translation(
+        self,
+        reply_token: str,
+        user_id: str,
+        text: str,
+        language: str,
+        prepare_audio: Optional[AudioPreparer] = None,
+    ) -> str:
+        if is_streamed_translation(self.config, text):
+            # Reply the first translated sentences early and push the rest
+            translated_text = self.reply_streamed_translation(
+                reply_token, user_id, text, language
+            )
+            audio = prepare_audio(translated_text) if prepare_audio else None
+        else:
+            translated_text = self.segmented_translator.translate(text, language)
+            audio = prepare_audio(translated_text) if prepare_audio else None
+            self.reply_text(reply_token, user_id, translated_text)
+        if audio is not None:
+            self.line.push_message(user_id, create_audio_message(*audio.result()))
+        return translated_text
+
+    def reply_streamed_translation(
+        self, reply_token: str, user_id: str, text: str, language: str
+    ) -> str:
+        translation = StreamedTranslation(self.text_segmenter)
+        for delta in self.chatgpt.stream_translate(text, language):
+            first_sentences = translation.add(delta)
+            if first_sentences is not None:
+                self.reply_text(reply_token, user_id, first_sentences)
+        rest_to_reply, rest_to_push = translation.finish()
+        if rest_to_reply is not None:
+            self.reply_text(reply_token, user_id, rest_to_reply)
+        else:
+            self.push_text(user_id, rest_to_push)
+        return translation.text
+
+    def reply_text(self, reply_token: str, user_id: str, text: str) -> None:
+        batches = batch_messages(create_text_messages(self.text_segmenter, text))
+        if batches:
+            self.line.reply_messages(reply_token, batches[0])
+            for batch in batches[1:]:
+                self.line.push_messages(user_id, batch)
+
+    def push_text(self, user_id: str, text: str) -> None:
+        for batch in batch_messages(create_text_messages(self.text_segmenter, text)):
+            self.line.push_messages(user_id, batch)
+
+
+class AsyncTranslationReplier:
+    def __init__(
+        self,
+        config: Mapping,
+        line: AsyncLine,
+        segmented_translator: AsyncSegmentedTranslator,
+    ):
+        self.config = config
+        self.line = line
+        self.segmented_translator = segmented_translator
+        self.chatgpt = segmented_translator.chatgpt
+        self.text_segmenter = segmented_translator.text_segmenter
+
+    async def reply_translation(
+        self,
+        reply_token: str,
+        user_id: str,
+        text: str,
+        language: str,
+        prepare_audio: Optional[AsyncAudioPreparer] = None,
+    ) -> str:
+        if is_streamed_translation(self.config, text):
+            # Reply the first translated sentences early and push the rest
+            translated_text = await self.reply_streamed_translation(
+                reply_token, user_id, text, language
+            )
+            if prepare_audio is not None:
+                audio = await prepare_audio(translated_text)
+                await self.line.push_message(user_id, create_audio_message(*audio))
+            return translated_text
+        translated_text = await self.segmented_translator.translate(text, language)
+        if prepare_audio is None:
+            await self.reply_text(reply_token, user_id, translated_text)
+            return translated_text
+        _, audio = await asyncio.gather(
+            self.reply_text(reply_token, user_id, translated_text),
+            prepare_audio(translated_text),
+        )
+        await self.line.push_message(user_id, create_audio_message(*audio))
+        return translated_text
+
+    async def reply_streamed_translation(
+        self, reply_token: str, user_id: str, text: str, language: str
+    ) -> str:
+        translation = StreamedTranslation(self.text_segmenter)
+        async for delta in self.chatgpt.stream_translate(text, language):
+            first_sentences = translation.add(delta)
+            if first_sentences is not None:
+                await self.reply_text(reply_token, user_id, first_sentences)
+        rest_to_reply, rest_to_push = translation.finish()
+        if rest_to_reply is not None:
+            await self.reply_text(reply_token, user_id, rest_to_reply)
+        else:
+            await self.push_text(user_id, rest_to_push)
+        return translation.text
+
+    async def reply_text(self, reply_token: str, user_id: str, text: str) -> None:
+        batches = batch_messages(create_text_messages(self.text_segmenter, text))
+        if batches:
+            await self.line.reply_messages(reply_token, batches[0])
+            for batch in batches[1:]:
+                await self.line.push_messages(user_id, batch)
+
+    async def push_text(self, user_id: str, text: str) -> None:
+        for batch in batch_messages(create_text_messages(self.text_segmenter, text)):
+            await self.line.push_messages(user_id, batch)
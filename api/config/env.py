@@ -4,6 +4,8 @@ from enum import Enum
 
 class EnvironmentConfig:
     TESTING = False
+    # Audio larger than this spills from memory to AUDIO_TEMP_PATH
+    AUDIO_SPOOL_MAX_SIZE = 8 * 1024 * 1024
 
 
 class DevelopmentConfig(EnvironmentConfig):
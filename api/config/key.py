@@ -3,7 +3,15 @@ from enum import Enum
 
 class ConfigKey(str, Enum):
     AUDIO_TEMP_PATH = "AUDIO_TEMP_PATH"
+    AUDIO_SPOOL_MAX_SIZE = "AUDIO_SPOOL_MAX_SIZE"
     APP_ENVIRONMENT = "APP_ENVIRONMENT"
     APP_NAME = "APP_NAME"
     APP_PERSISTENT_USER_SETTINGS_ENABLED = "APP_PERSISTENT_USER_SETTINGS_ENABLED"
+    APP_REMOTE_CACHE_ENABLED = "APP_REMOTE_CACHE_ENABLED"
     APP_PUSH_TRANSLATED_TEXT_AUDIO_ENABLED = "APP_PUSH_TRANSLATED_TEXT_AUDIO_ENABLED"
+    APP_TRANSLATION_CACHE_ENABLED = "APP_TRANSLATION_CACHE_ENABLED"
+    APP_STREAMING_REPLY_ENABLED = "APP_STREAMING_REPLY_ENABLED"
+    APP_STREAMING_REPLY_MIN_LENGTH = "APP_STREAMING_REPLY_MIN_LENGTH"
+    APP_ASYNC_MAX_CONCURRENCY = "APP_ASYNC_MAX_CONCURRENCY"
+    APP_TRACE_ID_ENABLED = "APP_TRACE_ID_ENABLED"
+    APP_METRICS_TOKEN = "APP_METRICS_TOKEN"
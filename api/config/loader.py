@@ -1,4 +1,4 @@
-from flask import Flask
+from flask import Config, Flask
 from api.config.base import BaseConfig
 from api.config.env import *
 from api.config.key import ConfigKey
@@ -16,13 +16,40 @@ class ConfigLoader:
         ]
 
     def apply_to(self, app: Flask):
-        app.config.from_object(self.environment_map.get(self.environment))
-        app.config[ConfigKey.APP_NAME] = BaseConfig.get_str(
+        self.load(app.config)
+
+    def load(self, config: Config):
+        config.from_object(self.environment_map.get(self.environment))
+        config[ConfigKey.APP_NAME] = BaseConfig.get_str(
             ConfigKey.APP_NAME, "gpt-ai-translator"
         )
-        app.config[ConfigKey.APP_PERSISTENT_USER_SETTINGS_ENABLED] = (
-            BaseConfig.get_bool(ConfigKey.APP_PERSISTENT_USER_SETTINGS_ENABLED, False)
+        config[ConfigKey.APP_PERSISTENT_USER_SETTINGS_ENABLED] = BaseConfig.get_bool(
+            ConfigKey.APP_PERSISTENT_USER_SETTINGS_ENABLED, False
+        )
+        # The translation, audio and webhook event caches used the remote tier of
+        # the user settings before they had their own flag
+        config[ConfigKey.APP_REMOTE_CACHE_ENABLED] = BaseConfig.get_bool(
+            ConfigKey.APP_REMOTE_CACHE_ENABLED,
+            config[ConfigKey.APP_PERSISTENT_USER_SETTINGS_ENABLED],
+        )
+        config[ConfigKey.APP_PUSH_TRANSLATED_TEXT_AUDIO_ENABLED] = BaseConfig.get_bool(
+            ConfigKey.APP_PUSH_TRANSLATED_TEXT_AUDIO_ENABLED, False
+        )
+        config[ConfigKey.APP_TRANSLATION_CACHE_ENABLED] = BaseConfig.get_bool(
+            ConfigKey.APP_TRANSLATION_CACHE_ENABLED, True
+        )
+        config[ConfigKey.APP_STREAMING_REPLY_ENABLED] = BaseConfig.get_bool(
+            ConfigKey.APP_STREAMING_REPLY_ENABLED, False
+        )
+        config[ConfigKey.APP_STREAMING_REPLY_MIN_LENGTH] = BaseConfig.get_int(
+            ConfigKey.APP_STREAMING_REPLY_MIN_LENGTH, 200
+        )
+        config[ConfigKey.APP_ASYNC_MAX_CONCURRENCY] = BaseConfig.get_int(
+            ConfigKey.APP_ASYNC_MAX_CONCURRENCY, 500
+        )
+        config[ConfigKey.APP_TRACE_ID_ENABLED] = BaseConfig.get_bool(
+            ConfigKey.APP_TRACE_ID_ENABLED, False
         )
-        app.config[ConfigKey.APP_PUSH_TRANSLATED_TEXT_AUDIO_ENABLED] = (
-            BaseConfig.get_bool(ConfigKey.APP_PUSH_TRANSLATED_TEXT_AUDIO_ENABLED, False)
+        config[ConfigKey.APP_METRICS_TOKEN] = BaseConfig.get_str(
+            ConfigKey.APP_METRICS_TOKEN
         )
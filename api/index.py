@@ -1,51 +1,133 @@
-import os
+import io
+from concurrent.futures import ThreadPoolExecutor
 from dotenv import load_dotenv
-from flask import Flask, request, abort
+from flask import Flask, Response, request, abort
 from linebot.v3.exceptions import InvalidSignatureError
-from linebot.v3.messaging import (
-    TextMessage,
-    AudioMessage,
-    QuickReply,
-    QuickReplyItem,
-    MessageAction,
-)
 from linebot.v3.webhooks import MessageEvent, TextMessageContent, AudioMessageContent
 from api.ai.chatgpt import ChatGPT
 from api.bot.line import Line
+from api.bot.message_handler import (
+    DEFAULT_USER_SETTINGS,
+    USER_AUDIO_LANGUAGE_KEY,
+    USER_TRANSLATE_LANGUAGE_KEY,
+    TranslationReplier,
+    create_audio_rejection,
+    create_audio_spool,
+    create_command_reply,
+    get_settings_changes,
+)
 from api.config.key import ConfigKey
-from api.config.language import lang_dict, reverse_lang_dict
 from api.config.loader import ConfigLoader
 from api.media.tinytag import TinyTagMedia
 from api.storage.cache import CacheConfig, MultiTierCacheAdapter
 from api.storage.minio import MinioStorage
 from api.utils.audio_processor import AudioProcessor
-from api.utils.user_settings_manager import UserSettingsManager
+from api.utils.lazy_module import LazyModule
+from api.utils.event_deduplicator import EventDeduplicator, EventDeduplicatorConfig
+from api.utils.event_dispatcher import EventDispatcher
+from api.utils.metrics import metrics
+from api.utils.pipeline import Pipeline
+from api.utils.segmented_translator import SegmentedTranslator
+from api.utils.text_segmenter import TextSegmenter
+from api.utils.tracing import enable_trace_id_logging
+from api.utils.translation_cache import TranslationCache, TranslationCacheConfig
+from api.utils.user_settings_manager import (
+    UserSettingsManager,
+    UserSettingsConfig,
+)
 
 load_dotenv()
 
+# Message models are only needed once a reply is sent
+messaging = LazyModule("linebot.v3.messaging")
+
 app = Flask(__name__)
 ConfigLoader().apply_to(app)
 app_name = app.config.get(ConfigKey.APP_NAME)
 app_persistent_user_settings_enabled = app.config.get(
     ConfigKey.APP_PERSISTENT_USER_SETTINGS_ENABLED
 )
+app_remote_cache_enabled = app.config.get(ConfigKey.APP_REMOTE_CACHE_ENABLED)
 app_push_translated_text_audio_enabled = app.config.get(
     ConfigKey.APP_PUSH_TRANSLATED_TEXT_AUDIO_ENABLED
 )
+app_translation_cache_enabled = app.config.get(ConfigKey.APP_TRANSLATION_CACHE_ENABLED)
+app_metrics_token = app.config.get(ConfigKey.APP_METRICS_TOKEN)
+if app.config.get(ConfigKey.APP_TRACE_ID_ENABLED):
+    enable_trace_id_logging()
 
-chatgpt = ChatGPT()
+translation_cache_config = TranslationCacheConfig.from_env()
+chatgpt = ChatGPT(
+    translation_cache=(
+        TranslationCache(
+            MultiTierCacheAdapter(
+                CacheConfig(
+                    lru_size=translation_cache_config.lru_size,
+                    remote_cache_enabled=app_remote_cache_enabled,
+                    ttl=translation_cache_config.ttl,
+                    max_bytes=translation_cache_config.max_bytes,
+                    namespace="translation",
+                )
+            ),
+            app_name,
+            translation_cache_config.lock_seconds,
+        )
+        if app_translation_cache_enabled
+        else None
+    )
+)
 line = Line()
+event_deduplicator_config = EventDeduplicatorConfig.from_env()
+event_dispatcher = EventDispatcher(
+    line.handler,
+    deduplicator=(
+        EventDeduplicator(
+            MultiTierCacheAdapter(
+                CacheConfig(
+                    lru_size=event_deduplicator_config.lru_size,
+                    remote_cache_enabled=app_remote_cache_enabled,
+                    ttl=event_deduplicator_config.ttl,
+                    namespace="webhook_events",
+                )
+            ),
+            app_name,
+        )
+        if event_deduplicator_config.ttl > 0
+        else None
+    ),
+)
 audio_processor = AudioProcessor(
-    MinioStorage() if app_push_translated_text_audio_enabled else None,
+    (
+        MinioStorage(expiring_prefixes=AudioProcessor.OBJECT_PREFIXES)
+        if app_push_translated_text_audio_enabled
+        else None
+    ),
     TinyTagMedia() if app_push_translated_text_audio_enabled else None,
     app_name,
+    MultiTierCacheAdapter(
+        CacheConfig(
+            lru_size=translation_cache_config.audio_lru_size,
+            remote_cache_enabled=app_remote_cache_enabled,
+            ttl=translation_cache_config.ttl,
+            max_bytes=translation_cache_config.audio_max_bytes,
+            namespace="audio",
+        )
+    ),
+)
+audio_executor = ThreadPoolExecutor(thread_name_prefix="audio")
+translation_replier = TranslationReplier(
+    app.config, line, SegmentedTranslator(chatgpt, TextSegmenter())
 )
 
-user_translate_language_key = "translate_language"
-user_audio_language_key = "audio_language"
+user_settings_config = UserSettingsConfig.from_env()
 user_settings_manager = UserSettingsManager(
     MultiTierCacheAdapter(
-        CacheConfig(remote_cache_enabled=app_persistent_user_settings_enabled)
+        CacheConfig(
+            remote_cache_enabled=app_persistent_user_settings_enabled,
+            local_ttl=user_settings_config.ttl,
+            max_bytes=user_settings_config.max_bytes,
+            namespace="settings",
+        )
     ),
     app_name,
 )
@@ -56,12 +138,24 @@ def home():
     return "OK"
 
 
+@app.route("/metrics")
+def metrics_endpoint():
+    # Served only when APP_METRICS_TOKEN is set, to scrapes that send it
+    if not app_metrics_token:
+        abort(404)
+    if not metrics.is_scrape_allowed(
+        request.headers.get("Authorization"), app_metrics_token
+    ):
+        abort(401)
+    return Response(metrics.render(), mimetype="text/plain; version=0.0.4")
+
+
 @app.route("/webhook", methods=["POST"])
 def callback():
     signature = request.headers["X-Line-Signature"]
     body = request.get_data(as_text=True)
     try:
-        line.handler.handle(body, signature)
+        event_dispatcher.dispatch(body, signature)
     except InvalidSignatureError:
         abort(400)
     return "OK"
@@ -70,136 +164,103 @@ def callback():
 @line.handler.add(MessageEvent, message=TextMessageContent)
 def handle_text_message(event):
     user_id = event.source.user_id
-    if not (user_exists(user_id)):
-        init_user_lang(user_id)
+    user_settings = user_settings_manager.get_or_init_settings(
+        user_id, DEFAULT_USER_SETTINGS
+    )
     user_input = event.message.text
-    if (user_input == "/setting") or (user_input == "設定"):
-        flex_message = TextMessage(
-            text="請選擇我方使用語言",
-            quick_reply=QuickReply(
-                items=[
-                    create_quick_reply_item(lang, "設定語音辨識後翻譯為 ")
-                    for lang in lang_dict
-                ]
-            ),
-        )
-        line.reply_message(event.reply_token, flex_message)
-
-    elif "設定語音辨識後翻譯為" in user_input:
-        # Set audio language by user
-        user_settings_manager.set_settings(
-            user_id, {user_audio_language_key: lang_dict[user_input.split(" ")[1]]}
-        )
-        flex_message = TextMessage(
-            text="請選擇對方使用語言",
-            quick_reply=QuickReply(
-                items=[
-                    create_quick_reply_item(lang, "設定打字後翻譯為 ")
-                    for lang in lang_dict
-                ]
-            ),
-        )
-        line.reply_message(event.reply_token, flex_message)
-
-    elif "設定打字後翻譯為" in user_input:
-        # Set translate language by user
-        user_settings_manager.set_settings(
-            user_id, {user_translate_language_key: lang_dict[user_input.split(" ")[1]]}
-        )
-        # Format response message
-        user_settings = user_settings_manager.get_settings(user_id)
-        audio_language = user_settings[user_audio_language_key]
-        translate_language = user_settings[user_translate_language_key]
-        response_text = f"""設定完畢！
-我方語言：{reverse_lang_dict[audio_language]}（{audio_language}）
-對方語言：{reverse_lang_dict[translate_language]}（{translate_language}）"""
-        line.reply_message(event.reply_token, TextMessage(text=response_text))
-
-    elif (user_input == "/current-setting") or (user_input == "目前設定"):
-        # Format response message
-        user_settings = user_settings_manager.get_settings(user_id)
-        audio_language = user_settings[user_audio_language_key]
-        translate_language = user_settings[user_translate_language_key]
-        response_text = f"""我方語言：{reverse_lang_dict[audio_language]}（{audio_language}）
-對方語言：{reverse_lang_dict[translate_language]}（{translate_language}）"""
-        line.reply_message(event.reply_token, TextMessage(text=response_text))
-
-    else:
-        # Show loading animation
-        line.show_loading_animation(user_id)
-        # Translate text from user input
-        user_settings = user_settings_manager.get_settings(user_id)
-        translated_text = chatgpt.translate(
-            user_input, user_settings[user_translate_language_key]
-        )
-        # Reply translated text
-        line.reply_message(event.reply_token, TextMessage(text=translated_text))
-        if app_push_translated_text_audio_enabled:
-            translated_text_audio_path = os.path.join(
-                app.config.get(ConfigKey.AUDIO_TEMP_PATH), f"{event.message.id}.mp3"
-            )
-            # Convert translated text to audio file
-            chatgpt.tts(translated_text, translated_text_audio_path)
-            # Operate audio file with remote storage
-            audio_processor.clean_audios(user_id)
-            audio_processor.upload_audio(user_id, translated_text_audio_path)
-            translated_text_audio_url = audio_processor.get_audio_url(
-                user_id, translated_text_audio_path
-            )
-            translated_text_audio_duration = (
-                audio_processor.get_audio_duration(translated_text_audio_path) * 1000
-            )
-            # Push audio message from audio file
-            line.push_message(
-                user_id,
-                AudioMessage(
-                    originalContentUrl=translated_text_audio_url,
-                    duration=int(translated_text_audio_duration),
-                ),
-            )
+    settings_changes = get_settings_changes(user_input)
+    if settings_changes is not None:
+        user_settings = user_settings_manager.set_settings(user_id, settings_changes)
+    command_reply = create_command_reply(user_input, user_settings)
+    if command_reply is not None:
+        line.reply_message(event.reply_token, command_reply)
+        return
+    # Show loading animation
+    line.show_loading_animation(user_id)
+    # Reply translated text, then push its audio when enabled
+    translation_replier.reply_translation(
+        event.reply_token,
+        user_id,
+        user_input,
+        user_settings[USER_TRANSLATE_LANGUAGE_KEY],
+        (
+            prepare_translated_text_audio
+            if app_push_translated_text_audio_enabled
+            else None
+        ),
+    )
 
 
 @line.handler.add(MessageEvent, message=AudioMessageContent)
 def handle_audio_message(event):
     user_id = event.source.user_id
-    if not (user_exists(user_id)):
-        init_user_lang(user_id)
+    user_settings = user_settings_manager.get_or_init_settings(
+        user_id, DEFAULT_USER_SETTINGS
+    )
     message_id = event.message.id
     # Show loading animation
     line.show_loading_animation(user_id)
     # Read audio message for whisper api input
-    user_audio_path = os.path.join(
-        app.config.get(ConfigKey.AUDIO_TEMP_PATH), f"{message_id}.m4a"
-    )
-    line.write_audio_by_message(message_id, user_audio_path)
-    whispered_text = chatgpt.whisper(user_audio_path)
-    if os.path.exists(user_audio_path):
-        os.remove(user_audio_path)
-    # Translate text from whisper api output
-    user_settings = user_settings_manager.get_settings(user_id)
-    translated_text = chatgpt.translate(
-        whispered_text, user_settings[user_audio_language_key]
-    )
+    user_audio = line.get_audio_by_message(message_id)
+    audio_rejection = create_audio_rejection(user_audio)
+    if audio_rejection is not None:
+        line.reply_message(event.reply_token, audio_rejection)
+        return
+    # The audio is already in memory and below the whisper size limit
+    with io.BytesIO(user_audio) as user_audio_file:
+        # Translate text from whisper api output
+        translated_text = chatgpt.whisper_translate(
+            user_audio_file, f"{message_id}.m4a", user_settings[USER_AUDIO_LANGUAGE_KEY]
+        )
     # Reply translated text
-    line.reply_message(event.reply_token, TextMessage(text=translated_text))
-
+    line.reply_message(event.reply_token, messaging.TextMessage(text=translated_text))
 
-def user_exists(user_id):
-    return user_settings_manager.get_settings(user_id) != {}
 
-
-def init_user_lang(user_id):
-    user_settings_manager.set_settings(
-        user_id,
-        {
-            user_translate_language_key: "English",
-            user_audio_language_key: "Traditional Chinese",
-        },
+def prepare_translated_text_audio(translated_text):
+    # Reuse the audio of an identical translated text if it was synthesized before
+    translated_text_audio_key = audio_processor.make_shared_audio_key(
+        translated_text, chatgpt.config.tts_model, chatgpt.config.tts_voice
+    )
+    # Audio is prepared in the pool while the text reply is sent on the request
+    # thread, so the reply never queues behind audio stages waiting for the
+    # scheduler
+    pipeline = Pipeline(audio_executor)
+    pipeline.add(
+        "cached_duration",
+        lambda: audio_processor.get_shared_audio_duration(translated_text_audio_key),
+    )
+    pipeline.add(
+        "duration",
+        lambda cached_duration: (
+            cached_duration
+            if cached_duration is not None
+            else upload_translated_text_audio(
+                translated_text_audio_key, translated_text
+            )
+        ),
+        "cached_duration",
+    )
+    pipeline.add(
+        "url", lambda: audio_processor.get_shared_audio_url(translated_text_audio_key)
+    )
+    return pipeline.add(
+        "audio", lambda url, duration: (url, duration), "url", "duration"
     )
 
 
-def create_quick_reply_item(language, prefix):
-    return QuickReplyItem(action=MessageAction(label=language, text=prefix + language))
+def upload_translated_text_audio(translated_text_audio_key, translated_text):
+    with create_audio_spool(app.config) as translated_text_audio:
+        chatgpt.stream_tts(translated_text, translated_text_audio)
+        # Operate audio with remote storage
+        translated_text_audio_duration = audio_processor.get_stream_duration(
+            translated_text_audio
+        )
+        audio_processor.upload_shared_audio(
+            translated_text_audio_key,
+            translated_text_audio,
+            translated_text_audio_duration,
+        )
+    return translated_text_audio_duration
 
 
 if __name__ == "__main__":
@@ -1,7 +1,14 @@
-from tinytag import TinyTag
+from typing import BinaryIO
+from api.utils.lazy_module import LazyModule
+from api.utils.metrics import metrics
+
+tinytag = LazyModule("tinytag")
 
 
 class TinyTagMedia:
-    def get_audio_duration(self, audio_path: str) -> float:
-        audio = TinyTag.get(audio_path)
-        return audio.duration if audio.duration is not None else 0.0
+    @metrics.external_call("tinytag", "duration")
+    def get_stream_duration(self, audio: BinaryIO) -> float:
+        audio.seek(0)
+        tag = tinytag.TinyTag.get(file_obj=audio)
+        audio.seek(0)
+        return tag.duration if tag.duration is not None else 0.0
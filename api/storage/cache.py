@@ -1,40 +1,237 @@
-import json
+import asyncio
+import logging
+import math
+import random
+import sqlite3
+import sys
+import threading
+import time
 from dataclasses import dataclass
 from api.config.base import BaseConfig
-from typing import Any, Optional
-from cachetools import LRUCache
-from upstash_redis import Redis
+from typing import Any, Callable, Dict, Iterable, List, Optional, Tuple, Union
+from cachetools import LRUCache, TLRUCache
+from api.storage.codec import CacheCodec
+from api.utils.lazy_module import LazyModule
+from api.utils.metrics import Metrics, metrics
+from api.utils.single_flight import SingleFlight
+
+# Clients of the remote tiers are only imported by the backend in use
+redis = LazyModule("redis")
+redis_asyncio = LazyModule("redis.asyncio")
+upstash_redis = LazyModule("upstash_redis")
+upstash_redis_asyncio = LazyModule("upstash_redis.asyncio")
+
+logger = logging.getLogger(__name__)
+
+# Stored in the local tier for keys the remote tier does not have
+NEGATIVE_ENTRY = object()
+# Deletes a lock only if it still belongs to the given token
+RELEASE_LOCK_SCRIPT = (
+    "if redis.call('get', KEYS[1]) == ARGV[1] then "
+    "return redis.call('del', KEYS[1]) else return 0 end"
+)
+# Writes each value only if the version key stored next to it still holds the
+# expected version, and announces the new version on the invalidation channel.
+# KEYS holds each key and its version key, ARGV the TTL (0 for none), the channel
+# and then the expected version, new version and value of each key. Returns the
+# key, stored version and stored value of each key that was not written
+COMPARE_AND_SET_SCRIPT = """
+local ttl = tonumber(ARGV[1])
+local conflicts = {}
+for i = 1, #KEYS, 2 do
+  local arg = 3 + (i - 1) / 2 * 3
+  local version = redis.call('get', KEYS[i + 1]) or '0'
+  if version == ARGV[arg] then
+    if ttl > 0 then
+      redis.call('set', KEYS[i], ARGV[arg + 2], 'EX', ttl)
+      redis.call('set', KEYS[i + 1], ARGV[arg + 1], 'EX', ttl)
+    else
+      redis.call('set', KEYS[i], ARGV[arg + 2])
+      redis.call('set', KEYS[i + 1], ARGV[arg + 1])
+    end
+    redis.call('publish', ARGV[2], ARGV[arg + 1] .. ' ' .. KEYS[i])
+  else
+    table.insert(conflicts, KEYS[i])
+    table.insert(conflicts, version)
+    table.insert(conflicts, redis.call('get', KEYS[i]) or false)
+  end
+end
+return conflicts
+"""
+INVALIDATION_CHANNEL = "cache.invalidations"
+# Expected version, new version and value of a compare-and-set write
+VersionedWrite = Tuple[int, int, Any]
+# Called with the key and the new version of every compare-and-set write
+InvalidationCallback = Callable[[str, int], None]
+
+
+def get_version_key(key: str) -> str:
+    return f"{key}.version"
+
+
+def make_compare_and_set_args(
+    values: Dict[str, VersionedWrite], seconds: Optional[int], codec: CacheCodec
+) -> Tuple[List[str], List[str]]:
+    keys, args = [], [str(seconds or 0), INVALIDATION_CHANNEL]
+    for key, (expected_version, version, value) in values.items():
+        keys += [key, get_version_key(key)]
+        args += [str(expected_version), str(version), codec.encode(value)]
+    return keys, args
+
+
+def read_compare_and_set_conflicts(
+    result: List[Optional[str]], codec: CacheCodec
+) -> Dict[str, Tuple[int, Any]]:
+    return {
+        result[index]: (int(result[index + 1]), codec.decode(result[index + 2]))
+        for index in range(0, len(result), 3)
+    }
+
+
+def read_invalidation(message: dict) -> Tuple[str, int]:
+    version, _, key = message["data"].partition(" ")
+    return key, int(version)
+
+
+def log_subscription_error(error: BaseException, *args: Any) -> None:
+    # The subscription reconnects on the next poll
+    logger.warning("Cache invalidation subscription failed: %s", error)
+    time.sleep(1)
+
+
+async def log_async_subscription_error(error: BaseException, *args: Any) -> None:
+    logger.warning("Cache invalidation subscription failed: %s", error)
+    await asyncio.sleep(1)
+
+
+def get_value_size(value: Any) -> int:
+    # Approximate memory held by a cached value, including nested containers
+    size = sys.getsizeof(value)
+    if isinstance(value, dict):
+        size += sum(get_value_size(k) + get_value_size(v) for k, v in value.items())
+    elif isinstance(value, (list, tuple, set)):
+        size += sum(get_value_size(item) for item in value)
+    return size
+
+
+class EvictionCountingMixin:
+    # Counts entries dropped to make room, expired entries are not included
+    evictions = 0
+
+    def popitem(self):
+        item = super().popitem()
+        self.evictions += 1
+        return item
+
+
+class CountingLRUCache(EvictionCountingMixin, LRUCache):
+    pass
+
+
+class CountingTLRUCache(EvictionCountingMixin, TLRUCache):
+    pass
 
 
 class LRUWrapper:
-    def __init__(self, maxsize: float):
-        self.cache = LRUCache(maxsize=maxsize)
+    # With max_bytes the cache is bounded by the approximate size of its values
+    # instead of the number of entries
+    def __init__(
+        self,
+        maxsize: float,
+        ttl: Optional[int] = None,
+        ttl_jitter: float = 0.0,
+        negative_ttl: Optional[int] = None,
+        max_bytes: int = 0,
+        namespace: str = "default",
+        timer: Callable[[], float] = time.monotonic,
+    ):
+        self.ttl = ttl
+        self.ttl_jitter = ttl_jitter
+        self.negative_ttl = negative_ttl
+        self.namespace = namespace
+        self.lock = threading.Lock()
+        size_options = (
+            {"maxsize": max_bytes, "getsizeof": get_value_size}
+            if max_bytes > 0
+            else {"maxsize": maxsize}
+        )
+        self.cache = (
+            CountingTLRUCache(ttu=self.get_expiry, timer=timer, **size_options)
+            if ttl or negative_ttl
+            else CountingLRUCache(**size_options)
+        )
+        metrics.add_collector(self.export_stats)
 
     def get(self, key: str) -> Optional[Any]:
-        return self.cache.get(key)
+        with self.lock:
+            return self.cache.get(key)
 
     def set(self, key: str, value: Any) -> None:
-        self.cache[key] = value
+        with self.lock:
+            evictions = self.cache.evictions
+            try:
+                self.cache[key] = value
+            except ValueError:
+                # Larger than the whole budget, keep it only in the remote tier
+                self.cache.pop(key, None)
+                metrics.increment("cache_oversized_total", namespace=self.namespace)
+                return
+            evicted = self.cache.evictions - evictions
+        if evicted:
+            metrics.increment(
+                "cache_evictions_total", evicted, namespace=self.namespace
+            )
+
+    def set_missing(self, key: str) -> None:
+        if self.negative_ttl:
+            self.set(key, NEGATIVE_ENTRY)
+
+    def get_expiry(self, key: str, value: Any, now: float) -> float:
+        if value is NEGATIVE_ENTRY:
+            return now + self.negative_ttl
+        if not self.ttl:
+            return math.inf
+        # Spread the expiry of entries stored together so they are not all read
+        # from the remote tier again at the same moment
+        return now + self.ttl * random.uniform(1 - self.ttl_jitter, 1 + self.ttl_jitter)
 
     def delete(self, key: str) -> None:
-        self.cache.pop(key, None)
+        with self.lock:
+            self.cache.pop(key, None)
+
+    def stats(self) -> dict:
+        # Size is in bytes when the cache has a byte budget, in entries otherwise
+        with self.lock:
+            if isinstance(self.cache, TLRUCache):
+                self.cache.expire()
+            return {
+                "namespace": self.namespace,
+                "entries": len(self.cache),
+                "size": self.cache.currsize,
+                "max_size": self.cache.maxsize,
+                "evictions": self.cache.evictions,
+            }
+
+    def export_stats(self, registry: Metrics) -> None:
+        # Read on every scrape, so expired entries no longer count towards the size
+        stats = self.stats()
+        # Evictions are already counted by cache_evictions_total
+        for name in ("entries", "size", "max_size"):
+            registry.set_gauge(
+                f"cache_local_{name}", stats[name], namespace=self.namespace
+            )
 
 
 class UpstashRedisWrapper:
-    def __init__(self, url: str, token: str):
-        self.redis = Redis(url=url, token=token)
+    def __init__(self, url: str, token: str, codec: CacheCodec):
+        self.codec = codec
+        self.redis = upstash_redis.Redis(url=url, token=token)
 
     def get(self, key: str) -> Optional[Any]:
-        serialized_value = self.redis.get(key)
-        if serialized_value is None:
-            return None
-        try:
-            return json.loads(serialized_value)
-        except json.JSONDecodeError:
-            return serialized_value
+        return self.codec.decode(self.redis.get(key))
 
     def set(self, key: str, value: Any, seconds: Optional[int] = None) -> None:
-        serialized_value = json.dumps(value, default=str)
+        serialized_value = self.codec.encode(value)
         if seconds is not None:
             self.redis.set(key, serialized_value, ex=seconds)
         else:
@@ -43,24 +240,598 @@ class UpstashRedisWrapper:
     def delete(self, key: str) -> None:
         self.redis.delete(key)
 
+    def get_many(self, keys: Iterable[str]) -> Dict[str, Any]:
+        keys = list(keys)
+        if not keys:
+            return {}
+        return {
+            key: self.codec.decode(serialized_value)
+            for key, serialized_value in zip(keys, self.redis.mget(*keys))
+            if serialized_value is not None
+        }
+
+    def set_many(self, values: Dict[str, Any], seconds: Optional[int] = None) -> None:
+        if not values:
+            return
+        if seconds is None:
+            self.redis.mset(
+                {key: self.codec.encode(value) for key, value in values.items()}
+            )
+            return
+        # MSET cannot expire keys, so send one SET per key in a single pipeline
+        pipeline = self.redis.pipeline()
+        for key, value in values.items():
+            pipeline.set(key, self.codec.encode(value), ex=seconds)
+        pipeline.exec()
+
+    def delete_many(self, keys: Iterable[str]) -> None:
+        keys = list(keys)
+        if keys:
+            self.redis.delete(*keys)
+
+    def acquire_lock(self, key: str, token: str, seconds: int) -> bool:
+        return bool(self.redis.set(key, token, nx=True, ex=seconds))
+
+    def release_lock(self, key: str, token: str) -> None:
+        self.redis.eval(RELEASE_LOCK_SCRIPT, keys=[key], args=[token])
+
+    def compare_and_set_many(
+        self, values: Dict[str, VersionedWrite], seconds: Optional[int] = None
+    ) -> Dict[str, Tuple[int, Any]]:
+        if not values:
+            return {}
+        keys, args = make_compare_and_set_args(values, seconds, self.codec)
+        result = self.redis.eval(COMPARE_AND_SET_SCRIPT, keys=keys, args=args)
+        return read_compare_and_set_conflicts(result, self.codec)
+
+    def subscribe(self, callback: InvalidationCallback) -> bool:
+        # The REST API cannot hold a subscription
+        return False
+
+
+class AsyncUpstashRedisWrapper:
+    def __init__(self, url: str, token: str, codec: CacheCodec):
+        self.codec = codec
+        self.redis = upstash_redis_asyncio.Redis(url=url, token=token)
+
+    async def acquire_lock(self, key: str, token: str, seconds: int) -> bool:
+        return bool(await self.redis.set(key, token, nx=True, ex=seconds))
+
+    async def release_lock(self, key: str, token: str) -> None:
+        await self.redis.eval(RELEASE_LOCK_SCRIPT, keys=[key], args=[token])
+
+    async def compare_and_set_many(
+        self, values: Dict[str, VersionedWrite], seconds: Optional[int] = None
+    ) -> Dict[str, Tuple[int, Any]]:
+        if not values:
+            return {}
+        keys, args = make_compare_and_set_args(values, seconds, self.codec)
+        result = await self.redis.eval(COMPARE_AND_SET_SCRIPT, keys=keys, args=args)
+        return read_compare_and_set_conflicts(result, self.codec)
+
+    async def subscribe(self, callback: InvalidationCallback) -> bool:
+        return False
+
+    async def get(self, key: str) -> Optional[Any]:
+        return self.codec.decode(await self.redis.get(key))
+
+    async def set(self, key: str, value: Any, seconds: Optional[int] = None) -> None:
+        serialized_value = self.codec.encode(value)
+        if seconds is not None:
+            await self.redis.set(key, serialized_value, ex=seconds)
+        else:
+            await self.redis.set(key, serialized_value)
+
+    async def delete(self, key: str) -> None:
+        await self.redis.delete(key)
+
+    async def get_many(self, keys: Iterable[str]) -> Dict[str, Any]:
+        keys = list(keys)
+        if not keys:
+            return {}
+        return {
+            key: self.codec.decode(serialized_value)
+            for key, serialized_value in zip(keys, await self.redis.mget(*keys))
+            if serialized_value is not None
+        }
+
+    async def set_many(
+        self, values: Dict[str, Any], seconds: Optional[int] = None
+    ) -> None:
+        if not values:
+            return
+        if seconds is None:
+            await self.redis.mset(
+                {key: self.codec.encode(value) for key, value in values.items()}
+            )
+            return
+        # MSET cannot expire keys, so send one SET per key in a single pipeline
+        pipeline = self.redis.pipeline()
+        for key, value in values.items():
+            pipeline.set(key, self.codec.encode(value), ex=seconds)
+        await pipeline.exec()
+
+    async def delete_many(self, keys: Iterable[str]) -> None:
+        keys = list(keys)
+        if keys:
+            await self.redis.delete(*keys)
+
+
+class RedisWrapper:
+    # Native Redis over RESP, with a pool of persistent TCP connections
+    def __init__(self, url: str, pool_size: int, codec: CacheCodec):
+        self.codec = codec
+        self.redis = redis.Redis(
+            connection_pool=redis.BlockingConnectionPool.from_url(
+                url, max_connections=pool_size, decode_responses=True
+            )
+        )
+
+    def get(self, key: str) -> Optional[Any]:
+        return self.codec.decode(self.redis.get(key))
+
+    def set(self, key: str, value: Any, seconds: Optional[int] = None) -> None:
+        self.redis.set(key, self.codec.encode(value), ex=seconds)
+
+    def delete(self, key: str) -> None:
+        self.redis.delete(key)
+
+    def get_many(self, keys: Iterable[str]) -> Dict[str, Any]:
+        keys = list(keys)
+        if not keys:
+            return {}
+        return {
+            key: self.codec.decode(serialized_value)
+            for key, serialized_value in zip(keys, self.redis.mget(keys))
+            if serialized_value is not None
+        }
+
+    def set_many(self, values: Dict[str, Any], seconds: Optional[int] = None) -> None:
+        if not values:
+            return
+        pipeline = self.redis.pipeline(transaction=False)
+        for key, value in values.items():
+            pipeline.set(key, self.codec.encode(value), ex=seconds)
+        pipeline.execute()
+
+    def delete_many(self, keys: Iterable[str]) -> None:
+        keys = list(keys)
+        if keys:
+            self.redis.delete(*keys)
+
+    def acquire_lock(self, key: str, token: str, seconds: int) -> bool:
+        return bool(self.redis.set(key, token, nx=True, ex=seconds))
+
+    def release_lock(self, key: str, token: str) -> None:
+        self.redis.eval(RELEASE_LOCK_SCRIPT, 1, key, token)
+
+    def compare_and_set_many(
+        self, values: Dict[str, VersionedWrite], seconds: Optional[int] = None
+    ) -> Dict[str, Tuple[int, Any]]:
+        if not values:
+            return {}
+        keys, args = make_compare_and_set_args(values, seconds, self.codec)
+        result = self.redis.eval(COMPARE_AND_SET_SCRIPT, len(keys), *keys, *args)
+        return read_compare_and_set_conflicts(result, self.codec)
+
+    def subscribe(self, callback: InvalidationCallback) -> bool:
+        # The subscription holds one connection of the pool in a daemon thread
+        pubsub = self.redis.pubsub(ignore_subscribe_messages=True)
+        pubsub.subscribe(
+            **{
+                INVALIDATION_CHANNEL: lambda message: callback(
+                    *read_invalidation(message)
+                )
+            }
+        )
+        pubsub.run_in_thread(
+            sleep_time=1, daemon=True, exception_handler=log_subscription_error
+        )
+        return True
+
+
+class AsyncRedisWrapper:
+    def __init__(self, url: str, pool_size: int, codec: CacheCodec):
+        self.codec = codec
+        self.redis = redis_asyncio.Redis(
+            connection_pool=redis_asyncio.BlockingConnectionPool.from_url(
+                url, max_connections=pool_size, decode_responses=True
+            )
+        )
+
+    async def get(self, key: str) -> Optional[Any]:
+        return self.codec.decode(await self.redis.get(key))
+
+    async def set(self, key: str, value: Any, seconds: Optional[int] = None) -> None:
+        await self.redis.set(key, self.codec.encode(value), ex=seconds)
+
+    async def delete(self, key: str) -> None:
+        await self.redis.delete(key)
+
+    async def get_many(self, keys: Iterable[str]) -> Dict[str, Any]:
+        keys = list(keys)
+        if not keys:
+            return {}
+        return {
+            key: self.codec.decode(serialized_value)
+            for key, serialized_value in zip(keys, await self.redis.mget(keys))
+            if serialized_value is not None
+        }
+
+    async def set_many(
+        self, values: Dict[str, Any], seconds: Optional[int] = None
+    ) -> None:
+        if not values:
+            return
+        pipeline = self.redis.pipeline(transaction=False)
+        for key, value in values.items():
+            pipeline.set(key, self.codec.encode(value), ex=seconds)
+        await pipeline.execute()
+
+    async def delete_many(self, keys: Iterable[str]) -> None:
+        keys = list(keys)
+        if keys:
+            await self.redis.delete(*keys)
+
+    async def acquire_lock(self, key: str, token: str, seconds: int) -> bool:
+        return bool(await self.redis.set(key, token, nx=True, ex=seconds))
+
+    async def release_lock(self, key: str, token: str) -> None:
+        await self.redis.eval(RELEASE_LOCK_SCRIPT, 1, key, token)
+
+    async def compare_and_set_many(
+        self, values: Dict[str, VersionedWrite], seconds: Optional[int] = None
+    ) -> Dict[str, Tuple[int, Any]]:
+        if not values:
+            return {}
+        keys, args = make_compare_and_set_args(values, seconds, self.codec)
+        result = await self.redis.eval(COMPARE_AND_SET_SCRIPT, len(keys), *keys, *args)
+        return read_compare_and_set_conflicts(result, self.codec)
+
+    async def subscribe(self, callback: InvalidationCallback) -> bool:
+        # The subscription holds one connection of the pool in a task of the loop
+        pubsub = self.redis.pubsub(ignore_subscribe_messages=True)
+        await pubsub.subscribe(
+            **{
+                INVALIDATION_CHANNEL: lambda message: callback(
+                    *read_invalidation(message)
+                )
+            }
+        )
+        self.subscription = asyncio.ensure_future(
+            pubsub.run(exception_handler=log_async_subscription_error)
+        )
+        return True
+
+
+class SharedMemoryWrapper:
+    # Cache shared by the worker processes of one host, kept in an SQLite database
+    # that should live on a memory-backed file system such as /dev/shm. Expired
+    # rows are purged every PURGE_INTERVAL seconds, and past max_rows the oldest
+    # written rows are dropped, as the memory they take is not otherwise bounded
+    PURGE_INTERVAL = 60
+
+    def __init__(self, path: str, codec: CacheCodec, max_rows: int = 0):
+        self.path = path
+        self.codec = codec
+        self.max_rows = max_rows
+        self.connections = threading.local()
+        self.purged_at = time.monotonic()
+        self.connect().execute(
+            "CREATE TABLE IF NOT EXISTS entries "
+            "(key TEXT PRIMARY KEY, value TEXT NOT NULL, expires_at REAL)"
+        )
+
+    def connect(self) -> sqlite3.Connection:
+        # SQLite connections cannot be shared between threads
+        connection = getattr(self.connections, "connection", None)
+        if connection is None:
+            connection = sqlite3.connect(self.path, timeout=5, isolation_level=None)
+            connection.execute("PRAGMA journal_mode=WAL")
+            connection.execute("PRAGMA synchronous=OFF")
+            self.connections.connection = connection
+        return connection
+
+    def get(self, key: str) -> Optional[Any]:
+        return self.get_many([key]).get(key)
+
+    def set(self, key: str, value: Any, seconds: Optional[int] = None) -> None:
+        self.set_many({key: value}, seconds)
+
+    def delete(self, key: str) -> None:
+        self.delete_many([key])
+
+    def get_many(self, keys: Iterable[str]) -> Dict[str, Any]:
+        keys = list(keys)
+        if not keys:
+            return {}
+        rows = self.connect().execute(
+            "SELECT key, value FROM entries WHERE key IN "
+            f"({', '.join('?' * len(keys))}) "
+            "AND (expires_at IS NULL OR expires_at > ?)",
+            (*keys, time.time()),
+        )
+        return {
+            key: self.codec.decode(serialized_value) for key, serialized_value in rows
+        }
+
+    def set_many(self, values: Dict[str, Any], seconds: Optional[int] = None) -> None:
+        if not values:
+            return
+        expires_at = time.time() + seconds if seconds is not None else None
+        connection = self.connect()
+        connection.executemany(
+            "INSERT OR REPLACE INTO entries (key, value, expires_at) VALUES (?, ?, ?)",
+            [
+                (key, self.codec.encode(value), expires_at)
+                for key, value in values.items()
+            ],
+        )
+        self.prune(connection)
+
+    def prune(self, connection: sqlite3.Connection) -> None:
+        # Replaced rows get a new rowid, so the rowids follow the order of the
+        # writes and the rows older than the last max_rows writes go first
+        if self.max_rows:
+            connection.execute(
+                "DELETE FROM entries WHERE rowid <= "
+                "(SELECT MAX(rowid) FROM entries) - ?",
+                (self.max_rows,),
+            )
+        if time.monotonic() - self.purged_at >= self.PURGE_INTERVAL:
+            self.purged_at = time.monotonic()
+            connection.execute(
+                "DELETE FROM entries WHERE expires_at <= ?", (time.time(),)
+            )
+
+    def delete_many(self, keys: Iterable[str]) -> None:
+        self.connect().executemany(
+            "DELETE FROM entries WHERE key = ?", [(key,) for key in keys]
+        )
+
+    def acquire_lock(self, key: str, token: str, seconds: int) -> bool:
+        now = time.time()
+        connection = self.connect()
+        connection.execute(
+            "DELETE FROM entries WHERE key = ? AND expires_at <= ?", (key, now)
+        )
+        cursor = connection.execute(
+            "INSERT OR IGNORE INTO entries (key, value, expires_at) VALUES (?, ?, ?)",
+            (key, self.codec.encode(token), now + seconds),
+        )
+        self.prune(connection)
+        return cursor.rowcount == 1
+
+    def release_lock(self, key: str, token: str) -> None:
+        self.connect().execute(
+            "DELETE FROM entries WHERE key = ? AND value = ?",
+            (key, self.codec.encode(token)),
+        )
+
+    def compare_and_set_many(
+        self, values: Dict[str, VersionedWrite], seconds: Optional[int] = None
+    ) -> Dict[str, Tuple[int, Any]]:
+        if not values:
+            return {}
+        expires_at = time.time() + seconds if seconds is not None else None
+        connection = self.connect()
+        conflicts = {}
+        rows = []
+        # Taken for writing up front, so no other process writes in between
+        connection.execute("BEGIN IMMEDIATE")
+        try:
+            stored_values = self.get_many(
+                [name for key in values for name in (key, get_version_key(key))]
+            )
+            for key, (expected_version, version, value) in values.items():
+                stored_version = stored_values.get(get_version_key(key), 0)
+                if stored_version != expected_version:
+                    conflicts[key] = (stored_version, stored_values.get(key))
+                    continue
+                rows.append((key, self.codec.encode(value), expires_at))
+                rows.append(
+                    (get_version_key(key), self.codec.encode(version), expires_at)
+                )
+            connection.executemany(
+                "INSERT OR REPLACE INTO entries (key, value, expires_at) "
+                "VALUES (?, ?, ?)",
+                rows,
+            )
+            connection.execute("COMMIT")
+        except BaseException:
+            connection.execute("ROLLBACK")
+            raise
+        self.prune(connection)
+        return conflicts
+
+    def subscribe(self, callback: InvalidationCallback) -> bool:
+        # Workers on one host share the file, only their local tiers go stale
+        return False
+
+
+class AsyncSharedMemoryWrapper:
+    # Local SQLite calls are short enough to run on the event loop
+    def __init__(self, path: str, codec: CacheCodec, max_rows: int = 0):
+        self.wrapper = SharedMemoryWrapper(path, codec, max_rows)
+
+    async def get(self, key: str) -> Optional[Any]:
+        return self.wrapper.get(key)
+
+    async def set(self, key: str, value: Any, seconds: Optional[int] = None) -> None:
+        self.wrapper.set(key, value, seconds)
+
+    async def delete(self, key: str) -> None:
+        self.wrapper.delete(key)
+
+    async def get_many(self, keys: Iterable[str]) -> Dict[str, Any]:
+        return self.wrapper.get_many(keys)
+
+    async def set_many(
+        self, values: Dict[str, Any], seconds: Optional[int] = None
+    ) -> None:
+        self.wrapper.set_many(values, seconds)
+
+    async def delete_many(self, keys: Iterable[str]) -> None:
+        self.wrapper.delete_many(keys)
+
+    async def acquire_lock(self, key: str, token: str, seconds: int) -> bool:
+        return self.wrapper.acquire_lock(key, token, seconds)
+
+    async def release_lock(self, key: str, token: str) -> None:
+        self.wrapper.release_lock(key, token)
+
+    async def compare_and_set_many(
+        self, values: Dict[str, VersionedWrite], seconds: Optional[int] = None
+    ) -> Dict[str, Tuple[int, Any]]:
+        return self.wrapper.compare_and_set_many(values, seconds)
+
+    async def subscribe(self, callback: InvalidationCallback) -> bool:
+        return False
+
+
+RemoteCacheWrapper = Union[UpstashRedisWrapper, RedisWrapper, SharedMemoryWrapper]
+AsyncRemoteCacheWrapper = Union[
+    AsyncUpstashRedisWrapper, AsyncRedisWrapper, AsyncSharedMemoryWrapper
+]
+
 
 class RemoteCacheProvider:
-    def __init__(self, enabled: bool, wrapper: Optional[UpstashRedisWrapper] = None):
+    # Remote calls are timed as external calls of the backend, e.g. "upstash"
+    def __init__(
+        self,
+        enabled: bool,
+        wrapper: Optional[RemoteCacheWrapper] = None,
+        service: str = "cache",
+    ):
         self.enabled = enabled
         self.wrapper = wrapper
+        self.service = service
 
     def get(self, key: str) -> Optional[Any]:
         if self.enabled and self.wrapper:
-            return self.wrapper.get(key)
+            with metrics.external_call(self.service, "get"):
+                return self.wrapper.get(key)
         return None
 
     def set(self, key: str, value: Any, seconds: Optional[int] = None):
         if self.enabled and self.wrapper:
-            self.wrapper.set(key, value, seconds)
+            with metrics.external_call(self.service, "set"):
+                self.wrapper.set(key, value, seconds)
 
     def delete(self, key: str) -> None:
         if self.enabled and self.wrapper:
-            self.wrapper.delete(key)
+            with metrics.external_call(self.service, "delete"):
+                self.wrapper.delete(key)
+
+    def get_many(self, keys: Iterable[str]) -> Dict[str, Any]:
+        if self.enabled and self.wrapper:
+            with metrics.external_call(self.service, "get_many"):
+                return self.wrapper.get_many(keys)
+        return {}
+
+    def set_many(self, values: Dict[str, Any], seconds: Optional[int] = None):
+        if self.enabled and self.wrapper:
+            with metrics.external_call(self.service, "set_many"):
+                self.wrapper.set_many(values, seconds)
+
+    def delete_many(self, keys: Iterable[str]) -> None:
+        if self.enabled and self.wrapper:
+            with metrics.external_call(self.service, "delete_many"):
+                self.wrapper.delete_many(keys)
+
+    def acquire_lock(self, key: str, token: str, seconds: int) -> bool:
+        # Without a remote tier there is nobody to compete with
+        if self.enabled and self.wrapper:
+            with metrics.external_call(self.service, "acquire_lock"):
+                return self.wrapper.acquire_lock(key, token, seconds)
+        return True
+
+    def release_lock(self, key: str, token: str) -> None:
+        if self.enabled and self.wrapper:
+            with metrics.external_call(self.service, "release_lock"):
+                self.wrapper.release_lock(key, token)
+
+    def compare_and_set_many(
+        self, values: Dict[str, VersionedWrite], seconds: Optional[int] = None
+    ) -> Dict[str, Tuple[int, Any]]:
+        if self.enabled and self.wrapper:
+            with metrics.external_call(self.service, "compare_and_set_many"):
+                return self.wrapper.compare_and_set_many(values, seconds)
+        return {}
+
+    def subscribe(self, callback: InvalidationCallback) -> bool:
+        # Whether the callback hears of the writes of other workers
+        if self.enabled and self.wrapper:
+            return self.wrapper.subscribe(callback)
+        return False
+
+
+class AsyncRemoteCacheProvider:
+    def __init__(
+        self,
+        enabled: bool,
+        wrapper: Optional[AsyncRemoteCacheWrapper] = None,
+        service: str = "cache",
+    ):
+        self.enabled = enabled
+        self.wrapper = wrapper
+        self.service = service
+
+    async def get(self, key: str) -> Optional[Any]:
+        if self.enabled and self.wrapper:
+            with metrics.external_call(self.service, "get"):
+                return await self.wrapper.get(key)
+        return None
+
+    async def set(self, key: str, value: Any, seconds: Optional[int] = None):
+        if self.enabled and self.wrapper:
+            with metrics.external_call(self.service, "set"):
+                await self.wrapper.set(key, value, seconds)
+
+    async def delete(self, key: str) -> None:
+        if self.enabled and self.wrapper:
+            with metrics.external_call(self.service, "delete"):
+                await self.wrapper.delete(key)
+
+    async def get_many(self, keys: Iterable[str]) -> Dict[str, Any]:
+        if self.enabled and self.wrapper:
+            with metrics.external_call(self.service, "get_many"):
+                return await self.wrapper.get_many(keys)
+        return {}
+
+    async def set_many(self, values: Dict[str, Any], seconds: Optional[int] = None):
+        if self.enabled and self.wrapper:
+            with metrics.external_call(self.service, "set_many"):
+                await self.wrapper.set_many(values, seconds)
+
+    async def delete_many(self, keys: Iterable[str]) -> None:
+        if self.enabled and self.wrapper:
+            with metrics.external_call(self.service, "delete_many"):
+                await self.wrapper.delete_many(keys)
+
+    async def acquire_lock(self, key: str, token: str, seconds: int) -> bool:
+        if self.enabled and self.wrapper:
+            with metrics.external_call(self.service, "acquire_lock"):
+                return await self.wrapper.acquire_lock(key, token, seconds)
+        return True
+
+    async def release_lock(self, key: str, token: str) -> None:
+        if self.enabled and self.wrapper:
+            with metrics.external_call(self.service, "release_lock"):
+                await self.wrapper.release_lock(key, token)
+
+    async def compare_and_set_many(
+        self, values: Dict[str, VersionedWrite], seconds: Optional[int] = None
+    ) -> Dict[str, Tuple[int, Any]]:
+        if self.enabled and self.wrapper:
+            with metrics.external_call(self.service, "compare_and_set_many"):
+                return await self.wrapper.compare_and_set_many(values, seconds)
+        return {}
+
+    async def subscribe(self, callback: InvalidationCallback) -> bool:
+        if self.enabled and self.wrapper:
+            return await self.wrapper.subscribe(callback)
+        return False
 
 
 @dataclass
@@ -69,6 +840,87 @@ class CacheConfig(BaseConfig):
     remote_cache_enabled: bool = False
     upstash_redis_rest_url: str = None
     upstash_redis_rest_token: str = None
+    ttl: Optional[int] = None
+    # Remote tier: "upstash" (REST), "redis" (native protocol) or "shared_memory"
+    # (shared by the worker processes of one host)
+    backend: str = None
+    redis_url: str = None
+    redis_pool_size: int = None
+    shared_memory_path: str = None
+    shared_memory_max_rows: int = 0
+    # Values in the remote tier are JSON, compressed with zlib when the encoded
+    # value reaches compression_threshold bytes (0 disables)
+    compression_threshold: int = 0
+    # How long the local tier serves a value before it is read from the remote
+    # tier again; only used when the remote tier is enabled
+    local_ttl: Optional[int] = None
+    ttl_jitter: float = None
+    # How long the local tier remembers that the remote tier has no value
+    negative_ttl: int = 0
+    # Budget of the local tier in bytes, replacing lru_size when set; namespace
+    # names the cache in stats and metrics
+    max_bytes: int = 0
+    namespace: str = None
+
+    def get_local_ttl(self) -> Optional[int]:
+        if self.remote_cache_enabled and self.local_ttl:
+            return self.local_ttl
+        return self.ttl
+
+    def create_local(self) -> LRUWrapper:
+        return LRUWrapper(
+            maxsize=self.lru_size,
+            ttl=self.get_local_ttl(),
+            ttl_jitter=self.ttl_jitter,
+            negative_ttl=self.negative_ttl if self.remote_cache_enabled else None,
+            max_bytes=self.max_bytes,
+            namespace=self.namespace,
+        )
+
+    def create_codec(self) -> CacheCodec:
+        return CacheCodec(compression_threshold=self.compression_threshold)
+
+    def create_remote_wrapper(self) -> RemoteCacheWrapper:
+        if self.backend == "redis":
+            return RedisWrapper(
+                url=self.redis_url or self.get_required("REDIS_URL"),
+                pool_size=self.redis_pool_size,
+                codec=self.create_codec(),
+            )
+        if self.backend == "shared_memory":
+            return SharedMemoryWrapper(
+                path=self.shared_memory_path,
+                codec=self.create_codec(),
+                max_rows=self.shared_memory_max_rows,
+            )
+        if self.backend == "upstash":
+            return UpstashRedisWrapper(
+                url=self.upstash_redis_rest_url,
+                token=self.upstash_redis_rest_token,
+                codec=self.create_codec(),
+            )
+        raise ValueError(f"不支援的快取後端：{self.backend}")
+
+    def create_async_remote_wrapper(self) -> AsyncRemoteCacheWrapper:
+        if self.backend == "redis":
+            return AsyncRedisWrapper(
+                url=self.redis_url or self.get_required("REDIS_URL"),
+                pool_size=self.redis_pool_size,
+                codec=self.create_codec(),
+            )
+        if self.backend == "shared_memory":
+            return AsyncSharedMemoryWrapper(
+                path=self.shared_memory_path,
+                codec=self.create_codec(),
+                max_rows=self.shared_memory_max_rows,
+            )
+        if self.backend == "upstash":
+            return AsyncUpstashRedisWrapper(
+                url=self.upstash_redis_rest_url,
+                token=self.upstash_redis_rest_token,
+                codec=self.create_codec(),
+            )
+        raise ValueError(f"不支援的快取後端：{self.backend}")
 
     @classmethod
     def from_env(cls) -> "CacheConfig":
@@ -77,6 +929,19 @@ class CacheConfig(BaseConfig):
             remote_cache_enabled=False,
             upstash_redis_rest_url=cls.get_str("UPSTASH_REDIS_REST_URL"),
             upstash_redis_rest_token=cls.get_str("UPSTASH_REDIS_REST_TOKEN"),
+            backend=cls.get_str("CACHE_BACKEND", default="upstash"),
+            redis_url=cls.get_str("REDIS_URL"),
+            redis_pool_size=cls.get_int("REDIS_POOL_SIZE", default=10),
+            shared_memory_path=cls.get_str(
+                "SHARED_MEMORY_CACHE_PATH", default="/dev/shm/cache.db"
+            ),
+            shared_memory_max_rows=cls.get_int(
+                "SHARED_MEMORY_CACHE_MAX_ROWS", default=100000
+            ),
+            compression_threshold=cls.get_int("CACHE_COMPRESSION_THRESHOLD", default=0),
+            ttl_jitter=cls.get_float("CACHE_TTL_JITTER", default=0.1),
+            negative_ttl=cls.get_int("CACHE_NEGATIVE_TTL", default=0),
+            namespace="default",
         )
 
     @classmethod
@@ -93,34 +958,245 @@ class CacheConfig(BaseConfig):
             or base.upstash_redis_rest_url,
             upstash_redis_rest_token=override.upstash_redis_rest_token
             or base.upstash_redis_rest_token,
+            ttl=override.ttl or base.ttl,
+            backend=override.backend or base.backend,
+            redis_url=override.redis_url or base.redis_url,
+            redis_pool_size=override.redis_pool_size or base.redis_pool_size,
+            shared_memory_path=override.shared_memory_path or base.shared_memory_path,
+            shared_memory_max_rows=override.shared_memory_max_rows
+            or base.shared_memory_max_rows,
+            compression_threshold=override.compression_threshold
+            or base.compression_threshold,
+            local_ttl=override.local_ttl or base.local_ttl,
+            ttl_jitter=(
+                override.ttl_jitter
+                if override.ttl_jitter is not None
+                else base.ttl_jitter
+            ),
+            negative_ttl=override.negative_ttl or base.negative_ttl,
+            max_bytes=override.max_bytes or base.max_bytes,
+            namespace=override.namespace or base.namespace,
         )
 
 
 class MultiTierCacheAdapter:
     def __init__(self, config: Optional[CacheConfig] = None):
         self.config = CacheConfig.merge(base=CacheConfig.from_env(), override=config)
-        self.local = LRUWrapper(maxsize=self.config.lru_size)
+        self.local = self.config.create_local()
         self.remote = RemoteCacheProvider(
             self.config.remote_cache_enabled,
-            UpstashRedisWrapper(
-                url=self.config.upstash_redis_rest_url,
-                token=self.config.upstash_redis_rest_token,
+            (
+                self.config.create_remote_wrapper()
+                if self.config.remote_cache_enabled
+                else None
             ),
+            self.config.backend,
         )
+        self.remote_single_flight = SingleFlight("cache_get")
 
     def get(self, key):
         value = self.local.get(key)
+        if value is NEGATIVE_ENTRY:
+            self.count_lookups("negative")
+            return None
         if value is not None:
+            self.count_lookups("local")
             return value
+        # Concurrent misses for the same key share one remote read
+        value = self.remote_single_flight.do(key, lambda: self.load(key))
+        self.count_lookups("remote" if value is not None else "miss")
+        return value
+
+    def load(self, key):
         value = self.remote.get(key)
         if value is not None:
             self.local.set(key, value)
+        else:
+            self.local.set_missing(key)
         return value
 
-    def set(self, key, value):
+    def set(self, key, value, seconds=None):
         self.local.set(key, value)
-        self.remote.set(key, value)
+        self.remote.set(key, value, seconds or self.config.ttl)
 
     def delete(self, key):
         self.local.delete(key)
         self.remote.delete(key)
+
+    def get_many(self, keys):
+        # Keys missing locally are fetched from the remote tier in one round trip
+        values = {}
+        missing_keys = []
+        for key in keys:
+            value = self.local.get(key)
+            if value is NEGATIVE_ENTRY:
+                continue
+            if value is not None:
+                values[key] = value
+            else:
+                missing_keys.append(key)
+        self.count_lookups("local", len(values))
+        remote_values = self.remote.get_many(missing_keys) if missing_keys else {}
+        for key, value in remote_values.items():
+            self.local.set(key, value)
+            values[key] = value
+        self.count_lookups("remote", len(remote_values))
+        self.count_lookups("miss", len(missing_keys) - len(remote_values))
+        return values
+
+    def set_many(self, values, seconds=None):
+        for key, value in values.items():
+            self.local.set(key, value)
+        self.remote.set_many(values, seconds or self.config.ttl)
+
+    def delete_many(self, keys):
+        keys = list(keys)
+        for key in keys:
+            self.local.delete(key)
+        self.remote.delete_many(keys)
+
+    def stats(self):
+        return self.local.stats()
+
+    def count_lookups(self, result, count=1):
+        # Counts which tier answered, per namespace, to derive hit rates
+        if count:
+            metrics.increment(
+                "cache_lookups_total",
+                count,
+                namespace=self.config.namespace,
+                result=result,
+            )
+
+    def compare_and_set_many(self, values, seconds=None):
+        # Values are written only where the remote tier still holds the expected
+        # version; returns the stored version and value of the other keys
+        conflicts = self.remote.compare_and_set_many(values, seconds or self.config.ttl)
+        for key, (_, _, value) in values.items():
+            if key not in conflicts:
+                self.local.set(key, value)
+        return conflicts
+
+    def subscribe(self, callback):
+        return self.remote.subscribe(callback)
+
+    def acquire_lock(self, key, token, seconds):
+        return self.remote.acquire_lock(key, token, seconds)
+
+    def release_lock(self, key, token):
+        self.remote.release_lock(key, token)
+
+
+class AsyncMultiTierCacheAdapter:
+    def __init__(self, config: Optional[CacheConfig] = None):
+        self.config = CacheConfig.merge(base=CacheConfig.from_env(), override=config)
+        self.local = self.config.create_local()
+        self.remote = AsyncRemoteCacheProvider(
+            self.config.remote_cache_enabled,
+            (
+                self.config.create_async_remote_wrapper()
+                if self.config.remote_cache_enabled
+                else None
+            ),
+            self.config.backend,
+        )
+        self.remote_tasks: Dict[str, asyncio.Task] = {}
+
+    async def get(self, key):
+        value = self.local.get(key)
+        if value is NEGATIVE_ENTRY:
+            self.count_lookups("negative")
+            return None
+        if value is not None:
+            self.count_lookups("local")
+            return value
+        # Concurrent misses for the same key share one remote read
+        task = self.remote_tasks.get(key)
+        if task is None:
+            task = asyncio.ensure_future(self.load(key))
+            self.remote_tasks[key] = task
+            task.add_done_callback(lambda _: self.remote_tasks.pop(key, None))
+        else:
+            metrics.increment("single_flight_shared_total", operation="cache_get")
+        value = await asyncio.shield(task)
+        self.count_lookups("remote" if value is not None else "miss")
+        return value
+
+    async def load(self, key):
+        value = await self.remote.get(key)
+        if value is not None:
+            self.local.set(key, value)
+        else:
+            self.local.set_missing(key)
+        return value
+
+    async def set(self, key, value, seconds=None):
+        self.local.set(key, value)
+        await self.remote.set(key, value, seconds or self.config.ttl)
+
+    async def delete(self, key):
+        self.local.delete(key)
+        await self.remote.delete(key)
+
+    async def get_many(self, keys):
+        # Keys missing locally are fetched from the remote tier in one round trip
+        values = {}
+        missing_keys = []
+        for key in keys:
+            value = self.local.get(key)
+            if value is NEGATIVE_ENTRY:
+                continue
+            if value is not None:
+                values[key] = value
+            else:
+                missing_keys.append(key)
+        self.count_lookups("local", len(values))
+        remote_values = await self.remote.get_many(missing_keys) if missing_keys else {}
+        for key, value in remote_values.items():
+            self.local.set(key, value)
+            values[key] = value
+        self.count_lookups("remote", len(remote_values))
+        self.count_lookups("miss", len(missing_keys) - len(remote_values))
+        return values
+
+    async def set_many(self, values, seconds=None):
+        for key, value in values.items():
+            self.local.set(key, value)
+        await self.remote.set_many(values, seconds or self.config.ttl)
+
+    async def delete_many(self, keys):
+        keys = list(keys)
+        for key in keys:
+            self.local.delete(key)
+        await self.remote.delete_many(keys)
+
+    def stats(self):
+        return self.local.stats()
+
+    def count_lookups(self, result, count=1):
+        # Counts which tier answered, per namespace, to derive hit rates
+        if count:
+            metrics.increment(
+                "cache_lookups_total",
+                count,
+                namespace=self.config.namespace,
+                result=result,
+            )
+
+    async def compare_and_set_many(self, values, seconds=None):
+        conflicts = await self.remote.compare_and_set_many(
+            values, seconds or self.config.ttl
+        )
+        for key, (_, _, value) in values.items():
+            if key not in conflicts:
+                self.local.set(key, value)
+        return conflicts
+
+    async def subscribe(self, callback):
+        return await self.remote.subscribe(callback)
+
+    async def acquire_lock(self, key, token, seconds):
+        return await self.remote.acquire_lock(key, token, seconds)
+
+    async def release_lock(self, key, token):
+        await self.remote.release_lock(key, token)
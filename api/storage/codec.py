@@ -0,0 +1,54 @@
+import base64
+import json
+import zlib
+from typing import Any, Optional
+
+# Tagged values start with this marker, a format letter and a compression letter
+FORMAT_MARKER = "\x01"
+JSON = "j"
+ZLIB = "z"
+TAG_LENGTH = 3
+
+
+class CacheCodec:
+    # Encodes cached values as JSON text, which every remote tier can store.
+    # Values are written untagged as before, unless compressing them with zlib
+    # still saves space once base64 encoded. Untagged values are always read as
+    # JSON, and tagged values of formats no longer written are read as a miss
+    def __init__(self, compression_threshold: int = 0):
+        self.compression_threshold = compression_threshold
+
+    def encode(self, value: Any) -> str:
+        serialized_value = json.dumps(
+            value, default=str, ensure_ascii=False, separators=(",", ":")
+        )
+        if not self.compression_threshold:
+            return serialized_value
+        payload = serialized_value.encode()
+        if len(payload) < self.compression_threshold:
+            return serialized_value
+        compressed_value = (
+            FORMAT_MARKER
+            + JSON
+            + ZLIB
+            + base64.b64encode(zlib.compress(payload)).decode()
+        )
+        if len(compressed_value) < len(payload):
+            return compressed_value
+        return serialized_value
+
+    def decode(self, serialized_value: Optional[str]) -> Optional[Any]:
+        if serialized_value is None:
+            return None
+        if not serialized_value.startswith(FORMAT_MARKER):
+            try:
+                return json.loads(serialized_value)
+            except json.JSONDecodeError:
+                return serialized_value
+        format, compression = serialized_value[1], serialized_value[2]
+        if format != JSON:
+            return None
+        payload = base64.b64decode(serialized_value[TAG_LENGTH:])
+        if compression == ZLIB:
+            payload = zlib.decompress(payload)
+        return json.loads(payload)
@@ -1,7 +1,28 @@
+import logging
+import threading
 from dataclasses import dataclass
 from api.config.base import BaseConfig
-from typing import Optional
-from minio import Minio
+from typing import Any, BinaryIO, Iterable, List, NamedTuple, Optional
+from api.utils.lazy_module import LazyModule
+from api.utils.metrics import metrics
+
+minio = LazyModule("minio")
+minio_commonconfig = LazyModule("minio.commonconfig")
+minio_deleteobjects = LazyModule("minio.deleteobjects")
+minio_error = LazyModule("minio.error")
+minio_lifecycleconfig = LazyModule("minio.lifecycleconfig")
+
+logger = logging.getLogger(__name__)
+
+# Catch-all rule set by earlier versions on the whole bucket
+LEGACY_EXPIRATION_RULE_ID = "expire-all"
+SECONDS_PER_DAY = 86400
+
+
+class FileInfo(NamedTuple):
+    metadata: dict
+    # Unix time the file may be deleted from, None if it does not expire
+    expires_at: Optional[float]
 
 
 @dataclass
@@ -10,6 +31,11 @@ class MinioConfig(BaseConfig):
     access_key: str
     secret_key: str
     bucket_name: str = None
+    # Files under the expiring prefixes are deleted by the bucket's lifecycle
+    # after this many days, as nothing else deletes them. Below 1 the lifecycle
+    # is left to the operator and the files are kept
+    expiration_days: int = None
+    secure: bool = True
 
     @classmethod
     def from_env(cls) -> "MinioConfig":
@@ -18,6 +44,8 @@ class MinioConfig(BaseConfig):
             access_key=cls.get_required("MINIO_ACCESS_KEY"),
             secret_key=cls.get_required("MINIO_SECRET_KEY"),
             bucket_name=cls.get_str("MINIO_BUCKET"),
+            expiration_days=cls.get_int("MINIO_EXPIRATION_DAYS", 7),
+            secure=cls.get_bool("MINIO_SECURE", True),
         )
 
     @classmethod
@@ -31,36 +59,207 @@ class MinioConfig(BaseConfig):
             access_key=override.access_key or base.access_key,
             secret_key=override.secret_key or base.secret_key,
             bucket_name=override.bucket_name or base.bucket_name,
+            expiration_days=(
+                override.expiration_days
+                if override.expiration_days is not None
+                else base.expiration_days
+            ),
+            secure=override.secure and base.secure,
         )
 
 
 class MinioStorage:
-    def __init__(self, config: Optional[MinioConfig] = None):
+    def __init__(
+        self,
+        config: Optional[MinioConfig] = None,
+        expiring_prefixes: Iterable[str] = (),
+    ):
         self.config = MinioConfig.merge(base=MinioConfig.from_env(), override=config)
-        self.client = Minio(
-            self.config.endpoint,
-            access_key=self.config.access_key,
-            secret_key=self.config.secret_key,
-        )
+        # Only the files under these prefixes expire, the bucket may be shared
+        self.expiring_prefixes = list(expiring_prefixes)
+        if self.expiring_prefixes and self.config.expiration_days < 1:
+            logger.warning(
+                "MINIO_EXPIRATION_DAYS is %s, files under %s are not expired by "
+                "the bucket's lifecycle and are kept until deleted by the operator",
+                self.config.expiration_days,
+                ", ".join(self.expiring_prefixes),
+            )
+            self.expiring_prefixes = []
+        # The SDK is imported and the client built on first use
+        self.lock = threading.Lock()
+        self.minio_client: Optional[Any] = None
         self.bucket_name = self.config.bucket_name
+        # Buckets already known to exist in this process, checked and set up
+        # under their own lock so concurrent first uploads do it once
+        self.bucket_lock = threading.Lock()
+        self.ready_buckets = set()
 
+    @property
+    def client(self) -> Any:
+        if self.minio_client is None:
+            with self.lock:
+                if self.minio_client is None:
+                    self.minio_client = minio.Minio(
+                        self.config.endpoint,
+                        access_key=self.config.access_key,
+                        secret_key=self.config.secret_key,
+                        secure=self.config.secure,
+                    )
+        return self.minio_client
+
+    @metrics.external_call("minio", "delete")
     def clean_files(
         self, bucket_name: str, prefix: str, recursive: bool = True
     ) -> None:
         bucket_name = self.resolve_bucket_name(bucket_name)
         objects = self.client.list_objects(bucket_name, prefix, recursive)
-        for object in objects:
-            self.client.remove_object(bucket_name, object.object_name)
+        # The deletion only goes on while the errors are read, so all of them are
+        # read before failing
+        errors = [
+            f"{error.name}（{error.code}）"
+            for error in self.client.remove_objects(
+                bucket_name,
+                (
+                    minio_deleteobjects.DeleteObject(object.object_name)
+                    for object in objects
+                ),
+            )
+        ]
+        if errors:
+            raise RuntimeError(f"{len(errors)} 個檔案刪除失敗：{'、'.join(errors)}")
+
+    @metrics.external_call("minio", "list")
+    def list_folders(self, bucket_name: str, prefix: str = "") -> List[str]:
+        # Folders directly under prefix, named with their trailing "/"
+        bucket_name = self.resolve_bucket_name(bucket_name)
+        return [
+            object.object_name
+            for object in self.client.list_objects(bucket_name, prefix or None)
+            if object.is_dir
+        ]
+
+    @metrics.external_call("minio", "upload")
+    def upload_stream(
+        self,
+        bucket_name: str,
+        object_name: str,
+        data: BinaryIO,
+        length: int,
+        content_type: str = "application/octet-stream",
+        metadata: Optional[dict] = None,
+    ) -> None:
+        bucket_name = self.resolve_bucket_name(bucket_name)
+        self.ensure_bucket(bucket_name)
+        self.client.put_object(
+            bucket_name,
+            object_name,
+            data,
+            length,
+            content_type=content_type,
+            metadata=metadata,
+        )
 
-    def upload_file(self, bucket_name: str, object_name: str, file_path: str) -> None:
+    @metrics.external_call("minio", "stat")
+    def get_file_info(self, bucket_name: str, object_name: str) -> Optional[FileInfo]:
         bucket_name = self.resolve_bucket_name(bucket_name)
-        if not self.client.bucket_exists(bucket_name):
-            self.client.make_bucket(bucket_name)
-        self.client.fput_object(bucket_name, object_name, file_path)
+        try:
+            stat = self.client.stat_object(bucket_name, object_name)
+        except minio_error.S3Error as error:
+            if error.code in ("NoSuchKey", "NoSuchBucket", "NoSuchObject"):
+                return None
+            raise
+        prefix = "x-amz-meta-"
+        metadata = {
+            key.lower()[len(prefix) :]: value
+            for key, value in (stat.metadata or {}).items()
+            if key.lower().startswith(prefix)
+        }
+        last_modified = stat.last_modified.timestamp() if stat.last_modified else None
+        return FileInfo(
+            metadata,
+            (
+                self.get_expiry_time(object_name, last_modified)
+                if last_modified is not None
+                else None
+            ),
+        )
+
+    def get_expiry_time(
+        self, object_name: str, last_modified: float
+    ) -> Optional[float]:
+        # Earliest time the bucket's lifecycle may delete the file, None if the
+        # file does not expire
+        if not any(object_name.startswith(prefix) for prefix in self.expiring_prefixes):
+            return None
+        return last_modified + self.config.expiration_days * SECONDS_PER_DAY
 
     def get_file_url(self, bucket_name: str, object_name: str) -> str:
         bucket_name = self.resolve_bucket_name(bucket_name)
         return self.client.presigned_get_object(bucket_name, object_name)
 
+    @metrics.external_call("minio", "lifecycle")
+    def set_files_expiration(
+        self, bucket_name: str, prefixes: List[str], days: int
+    ) -> None:
+        # Rules of other prefixes, e.g. set by the operator, are kept
+        bucket_name = self.resolve_bucket_name(bucket_name)
+        rule_ids = {self.make_expiration_rule_id(prefix) for prefix in prefixes}
+        rule_ids.add(LEGACY_EXPIRATION_RULE_ID)
+        config = self.client.get_bucket_lifecycle(bucket_name)
+        current_rules = config.rules if config else []
+        expirations = {
+            rule.rule_id: (rule.rule_filter.prefix, rule.expiration.days)
+            for rule in current_rules
+            if rule.rule_id in rule_ids and rule.rule_filter and rule.expiration
+        }
+        if LEGACY_EXPIRATION_RULE_ID not in expirations and expirations == {
+            self.make_expiration_rule_id(prefix): (prefix, days) for prefix in prefixes
+        }:
+            # Set by an earlier process, most starts do not write the lifecycle
+            return
+        rules = [rule for rule in current_rules if rule.rule_id not in rule_ids]
+        rules.extend(
+            minio_lifecycleconfig.Rule(
+                minio_commonconfig.ENABLED,
+                rule_filter=minio_commonconfig.Filter(prefix=prefix),
+                rule_id=self.make_expiration_rule_id(prefix),
+                expiration=minio_lifecycleconfig.Expiration(days=days),
+            )
+            for prefix in prefixes
+        )
+        self.client.set_bucket_lifecycle(
+            bucket_name, minio_lifecycleconfig.LifecycleConfig(rules)
+        )
+
+    @staticmethod
+    def make_expiration_rule_id(prefix: str) -> str:
+        return f"expire-{prefix.strip('/').replace('/', '-')}"
+
+    def ensure_bucket(self, bucket_name: str) -> None:
+        if bucket_name in self.ready_buckets:
+            return
+        with self.bucket_lock:
+            if bucket_name in self.ready_buckets:
+                return
+            if not self.client.bucket_exists(bucket_name):
+                self.client.make_bucket(bucket_name)
+            if self.expiring_prefixes:
+                # Let the bucket expire old files instead of deleting them per
+                # request. Uploads do not depend on it, so a failure, e.g. a key
+                # without lifecycle permissions, is only logged
+                try:
+                    self.set_files_expiration(
+                        bucket_name,
+                        self.expiring_prefixes,
+                        self.config.expiration_days,
+                    )
+                except Exception as error:
+                    logger.warning(
+                        "Setting the expiration of bucket %s failed: %s",
+                        bucket_name,
+                        error,
+                    )
+            self.ready_buckets.add(bucket_name)
+
     def resolve_bucket_name(self, bucket_name: str) -> str:
         return self.bucket_name or bucket_name
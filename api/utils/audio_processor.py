@@ -1,46 +1,112 @@
 import os
+import time
 import hashlib
+from typing import BinaryIO, Optional
+from api.storage.cache import MultiTierCacheAdapter
 from api.storage.minio import MinioStorage
 from api.media.tinytag import TinyTagMedia
 
+# Audio deleted by the bucket's lifecycle within this time is synthesized again,
+# so the pushed URL still works while the user may play it
+SHARED_AUDIO_MIN_LIFETIME_SECONDS = 3600
+
 
 class AudioProcessor:
+    # Object name prefix of the synthesized audio shared by all users, which the
+    # bucket's lifecycle expires
+    SHARED_AUDIO_PREFIX = "tts/"
+    OBJECT_PREFIXES = (SHARED_AUDIO_PREFIX,)
+
     def __init__(
         self,
         minio_storage: MinioStorage | None,
         tinytag_media: TinyTagMedia | None,
         app_name: str,
+        cache: MultiTierCacheAdapter | None = None,
     ):
         self.minio_storage = minio_storage
         self.tinytag_media = tinytag_media
         self.app_name = app_name
+        self.cache = cache
 
-    def clean_audios(self, user_id: str) -> None:
+    def get_stream_duration(self, audio: BinaryIO) -> float:
+        if self.tinytag_media:
+            return self.tinytag_media.get_stream_duration(audio)
+        return 0.0
+
+    def make_shared_audio_key(self, text: str, model: str, voice: str) -> str:
+        return hashlib.sha256("\0".join((text, model, voice)).encode()).hexdigest()
+
+    def get_shared_audio_duration(self, audio_key: str) -> Optional[float]:
+        # Duration of an already synthesized audio, or None if it was never
+        # uploaded or is about to be deleted by the bucket's lifecycle
+        if self.cache:
+            entry = self.cache.get(self.get_shared_audio_cache_key(audio_key))
+            # Entries of earlier versions only hold the duration, the storage is
+            # asked again for the expiry
+            if isinstance(entry, dict) and self.is_alive(entry["expires_at"]):
+                return entry["duration"]
         if self.minio_storage:
-            bucket_name = self.app_name
-            self.minio_storage.clean_files(
-                bucket_name, hashlib.sha256(user_id.encode()).hexdigest()
+            info = self.minio_storage.get_file_info(
+                self.app_name, self.get_shared_audio_object_name(audio_key)
             )
+            if (
+                info is not None
+                and "duration" in info.metadata
+                and self.is_alive(info.expires_at)
+            ):
+                duration = float(info.metadata["duration"])
+                self.cache_shared_audio(audio_key, duration, info.expires_at)
+                return duration
+        return None
 
-    def upload_audio(self, user_id: str, audio_path: str) -> None:
+    def upload_shared_audio(
+        self, audio_key: str, audio: BinaryIO, duration: float
+    ) -> None:
         if self.minio_storage:
-            bucket_name = self.app_name
-            self.minio_storage.upload_file(
-                bucket_name,
-                f"/{hashlib.sha256(user_id.encode()).hexdigest()}/{os.path.basename(audio_path)}",
-                audio_path,
+            object_name = self.get_shared_audio_object_name(audio_key)
+            length = audio.seek(0, os.SEEK_END)
+            audio.seek(0)
+            self.minio_storage.upload_stream(
+                self.app_name,
+                object_name,
+                audio,
+                length,
+                content_type="audio/mpeg",
+                metadata={"duration": str(duration)},
+            )
+            self.cache_shared_audio(
+                audio_key,
+                duration,
+                self.minio_storage.get_expiry_time(object_name, time.time()),
             )
 
-    def get_audio_url(self, user_id: str, audio_path: str) -> str:
+    def cache_shared_audio(
+        self, audio_key: str, duration: float, expires_at: Optional[float]
+    ) -> None:
+        if self.cache:
+            self.cache.set(
+                self.get_shared_audio_cache_key(audio_key),
+                {"duration": duration, "expires_at": expires_at},
+            )
+
+    def get_shared_audio_cache_key(self, audio_key: str) -> str:
+        return f"{self.app_name}.audio.{audio_key}"
+
+    def get_shared_audio_url(self, audio_key: str) -> str:
         if self.minio_storage:
-            bucket_name = self.app_name
             return self.minio_storage.get_file_url(
-                bucket_name,
-                f"/{hashlib.sha256(user_id.encode()).hexdigest()}/{os.path.basename(audio_path)}",
+                self.app_name, self.get_shared_audio_object_name(audio_key)
             )
         return ""
 
-    def get_audio_duration(self, audio_path: str) -> float:
-        if self.tinytag_media:
-            return self.tinytag_media.get_audio_duration(audio_path)
-        return 0.0
+    @staticmethod
+    def is_alive(expires_at: Optional[float]) -> bool:
+        return (
+            expires_at is None
+            or expires_at - time.time() > SHARED_AUDIO_MIN_LIFETIME_SECONDS
+        )
+
+    @classmethod
+    def get_shared_audio_object_name(cls, audio_key: str) -> str:
+        return f"{cls.SHARED_AUDIO_PREFIX}{audio_key}.mp3"
@@ -0,0 +1,136 @@
+import threading
+from dataclasses import dataclass
+from typing import Any, Dict, List, Optional
+from api.config.base import BaseConfig
+from api.storage.cache import AsyncMultiTierCacheAdapter, MultiTierCacheAdapter
+from api.utils.metrics import metrics
+
+# Stored as the lock token of claimed redeliveries
+CLAIM_TOKEN = "1"
+
+
+@dataclass
+class EventDeduplicatorConfig(BaseConfig):
+    ttl: int = 86400
+    lru_size: int = 10000
+
+    @classmethod
+    def from_env(cls) -> "EventDeduplicatorConfig":
+        return cls(
+            ttl=cls.get_int("WEBHOOK_DEDUP_TTL", default=86400),
+            lru_size=cls.get_int("WEBHOOK_DEDUP_LRU_SIZE", default=10000),
+        )
+
+    @classmethod
+    def merge(
+        cls,
+        base: "EventDeduplicatorConfig",
+        override: Optional["EventDeduplicatorConfig"],
+    ) -> "EventDeduplicatorConfig":
+        if override is None:
+            return base
+        return cls(
+            ttl=override.ttl or base.ttl,
+            lru_size=override.lru_size or base.lru_size,
+        )
+
+
+def is_redelivery(event: Any) -> bool:
+    delivery_context = getattr(event, "delivery_context", None)
+    return bool(delivery_context and delivery_context.is_redelivery)
+
+
+class EventDeduplicator:
+    # Remembers the webhookEventId of every accepted event for the cache TTL, so
+    # an event LINE delivers again is handled once. Only redeliveries can be
+    # duplicates: they are claimed atomically in the remote tier, while first
+    # deliveries are just recorded, in one round trip per webhook
+    def __init__(self, cache: MultiTierCacheAdapter, app_name: str):
+        self.cache = cache
+        self.app_name = app_name
+        self.lock = threading.Lock()
+
+    def filter(self, events: List[Any]) -> List[Any]:
+        accepted = []
+        claims: Dict[str, bool] = {}
+        for event in events:
+            key = self.make_key(event)
+            if key is None:
+                accepted.append(event)
+                continue
+            redelivery = is_redelivery(event)
+            if not self.claim_locally(key) or (
+                redelivery
+                and not self.cache.acquire_lock(key, CLAIM_TOKEN, self.cache.config.ttl)
+            ):
+                metrics.increment(
+                    "webhook_events_duplicate_total", redelivery=redelivery
+                )
+                continue
+            if not redelivery:
+                claims[key] = True
+            accepted.append(event)
+        if claims:
+            self.cache.remote.set_many(claims, self.cache.config.ttl)
+        return accepted
+
+    def claim_locally(self, key: str) -> bool:
+        with self.lock:
+            if self.cache.local.get(key) is not None:
+                return False
+            self.cache.local.set(key, True)
+            return True
+
+    def release(self, event: Any) -> None:
+        # A failed event may be handled again if LINE redelivers it
+        key = self.make_key(event)
+        if key is not None:
+            self.cache.delete(key)
+
+    def make_key(self, event: Any) -> Optional[str]:
+        event_id = getattr(event, "webhook_event_id", None)
+        return f"{self.app_name}.{event_id}.event" if event_id else None
+
+
+class AsyncEventDeduplicator:
+    def __init__(self, cache: AsyncMultiTierCacheAdapter, app_name: str):
+        self.cache = cache
+        self.app_name = app_name
+
+    async def filter(self, events: List[Any]) -> List[Any]:
+        accepted = []
+        claims: Dict[str, bool] = {}
+        for event in events:
+            key = self.make_key(event)
+            if key is None:
+                accepted.append(event)
+                continue
+            redelivery = is_redelivery(event)
+            # The local check and claim run without awaiting in between
+            if self.cache.local.get(key) is not None:
+                claimed = False
+            else:
+                self.cache.local.set(key, True)
+                claimed = not redelivery or await self.cache.acquire_lock(
+                    key, CLAIM_TOKEN, self.cache.config.ttl
+                )
+            if not claimed:
+                metrics.increment(
+                    "webhook_events_duplicate_total", redelivery=redelivery
+                )
+                continue
+            if not redelivery:
+                claims[key] = True
+            accepted.append(event)
+        if claims:
+            await self.cache.remote.set_many(claims, self.cache.config.ttl)
+        return accepted
+
+    async def release(self, event: Any) -> None:
+        key = self.make_key(event)
+        if key is not None:
+            await self.cache.delete(key)
+
+    def make_key(self, event: Any) -> Optional[str]:
+        event_id = getattr(event, "webhook_event_id", None)
+        return f"{self.app_name}.{event_id}.event" if event_id else None
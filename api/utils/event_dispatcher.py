@@ -0,0 +1,332 @@
+import atexit
+import contextvars
+import logging
+import queue
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass
+from enum import Enum
+from typing import Any, Dict, List, Optional
+from api.bot.line import LineWebhookHandler
+from api.config.base import BaseConfig
+from api.utils.event_deduplicator import EventDeduplicator
+from api.utils.metrics import metrics
+from api.utils.tracing import trace
+
+logger = logging.getLogger(__name__)
+
+
+class DispatchMode(Enum):
+    SYNC = "SYNC"
+    THREAD = "THREAD"
+
+
+@dataclass
+class DispatcherConfig(BaseConfig):
+    mode: DispatchMode = DispatchMode.SYNC
+    workers: int = 4
+    queue_size: int = 100
+    enqueue_timeout: float = 0.5
+    # How long an event waits for room in the queue behind earlier events of its
+    # chat, which it may not overtake, before it is given up
+    blocked_timeout: float = 10.0
+    shutdown_timeout: float = 10.0
+
+    @classmethod
+    def from_env(cls) -> "DispatcherConfig":
+        return cls(
+            mode=DispatchMode[
+                cls.get_str("WEBHOOK_DISPATCH_MODE", DispatchMode.SYNC.value).upper()
+            ],
+            workers=cls.get_int("WEBHOOK_WORKERS", 4),
+            queue_size=cls.get_int("WEBHOOK_QUEUE_SIZE", 100),
+            enqueue_timeout=cls.get_float("WEBHOOK_ENQUEUE_TIMEOUT", 0.5),
+            blocked_timeout=cls.get_float("WEBHOOK_BLOCKED_TIMEOUT", 10.0),
+            shutdown_timeout=cls.get_float("WEBHOOK_SHUTDOWN_TIMEOUT", 10.0),
+        )
+
+    @classmethod
+    def merge(
+        cls, base: "DispatcherConfig", override: Optional["DispatcherConfig"]
+    ) -> "DispatcherConfig":
+        if override is None:
+            return base
+        return cls(
+            mode=override.mode or base.mode,
+            workers=override.workers or base.workers,
+            queue_size=override.queue_size or base.queue_size,
+            enqueue_timeout=override.enqueue_timeout or base.enqueue_timeout,
+            blocked_timeout=override.blocked_timeout or base.blocked_timeout,
+            shutdown_timeout=override.shutdown_timeout or base.shutdown_timeout,
+        )
+
+
+def get_chat_id(event: Any) -> Optional[str]:
+    # Events of one chat are handled in order, other chats run concurrently
+    source = getattr(event, "source", None)
+    return (
+        getattr(source, "group_id", None)
+        or getattr(source, "room_id", None)
+        or getattr(source, "user_id", None)
+    )
+
+
+def get_sender_id(event: Any) -> Optional[str]:
+    # Group members are told apart when LINE provides their user ID
+    source = getattr(event, "source", None)
+    return getattr(source, "user_id", None) or get_chat_id(event)
+
+
+def group_by_chat(events: List[Any]) -> List[List[Any]]:
+    groups: Dict[Any, List[Any]] = {}
+    for index, event in enumerate(events):
+        # Events without a chat have nothing to be ordered with
+        groups.setdefault(get_chat_id(event) or index, []).append(event)
+    return list(groups.values())
+
+
+class ChatState:
+    def __init__(self):
+        # Events of the chat that are queued or being handled
+        self.pending = 0
+        # Held while an event of the chat is queued, so they are queued in order
+        self.submit_lock = threading.Lock()
+        # Set once the event handled in the request thread is done, the worker
+        # waits for it before handling the events that came after it
+        self.inline_done: Optional[threading.Event] = None
+
+
+class EventDispatcher:
+    def __init__(
+        self,
+        handler: LineWebhookHandler,
+        config: Optional[DispatcherConfig] = None,
+        deduplicator: Optional[EventDeduplicator] = None,
+    ):
+        self.handler = handler
+        self.config = DispatcherConfig.merge(
+            base=DispatcherConfig.from_env(), override=config
+        )
+        self.deduplicator = deduplicator
+        # One queue per worker, a chat always goes to the same one so its events
+        # stay in order
+        queue_size = max(self.config.queue_size // self.config.workers, 1)
+        self.queues: List[queue.Queue] = [
+            queue.Queue(maxsize=queue_size) for _ in range(self.config.workers)
+        ]
+        self.workers: List[threading.Thread] = []
+        # Chats with events that are queued or being handled
+        self.chats: Dict[str, ChatState] = {}
+        self.executor: Optional[ThreadPoolExecutor] = None
+        self.lock = threading.Lock()
+        self.closed = False
+        # Requests past the closed check, shutdown waits for them before it
+        # stops the workers
+        self.dispatching = 0
+        self.dispatched = threading.Condition(self.lock)
+
+    def dispatch(self, body: str, signature: str) -> None:
+        # Signature is validated here so an invalid request still gets a 400
+        payload = self.handler.parse(body, signature)
+        events = payload.events
+        if self.deduplicator is not None:
+            events = self.deduplicator.filter(events)
+        with self.lock:
+            closed = self.closed
+            if not closed:
+                self.dispatching += 1
+        if closed:
+            self.process_all(events, payload)
+            return
+        try:
+            if self.config.mode == DispatchMode.SYNC:
+                self.process_groups(group_by_chat(events), payload)
+            else:
+                for event in events:
+                    self.submit(event, payload)
+        finally:
+            with self.lock:
+                self.dispatching -= 1
+                self.dispatched.notify_all()
+
+    def process_groups(self, groups: List[List[Any]], payload: Any) -> None:
+        # The first chat is handled in the request thread, the others alongside
+        futures = [
+            self.get_executor().submit(
+                contextvars.copy_context().run, self.process_all, group, payload
+            )
+            for group in groups[1:]
+        ]
+        if groups:
+            self.process_all(groups[0], payload)
+        for future in futures:
+            future.result()
+
+    def process_all(self, events: List[Any], payload: Any) -> None:
+        for event in events:
+            self.process(event, payload)
+
+    def submit(self, event: Any, payload: Any) -> None:
+        self.start()
+        chat_id = get_chat_id(event)
+        event_queue = self.get_queue(event)
+        item = (event, payload, time.perf_counter())
+        if chat_id is None:
+            # Nothing to be ordered with, so a full queue is simply bypassed
+            if not self.enqueue(event_queue, item, self.config.enqueue_timeout):
+                metrics.increment("webhook_events_inline_total")
+                self.process(event, payload)
+            self.update_queue_depth()
+            return
+        chat = self.add_pending(chat_id, 1)
+        with chat.submit_lock:
+            if self.enqueue(event_queue, item, self.config.enqueue_timeout):
+                inline_done = None
+            else:
+                # Backpressure: the queue stayed full. The event is processed in
+                # the request thread instead of being dropped, unless earlier
+                # events of its chat are still pending, then it waits for its
+                # turn in the queue
+                with self.lock:
+                    inline_done = threading.Event() if chat.pending == 1 else None
+                    if inline_done is not None:
+                        chat.inline_done = inline_done
+                if inline_done is None:
+                    metrics.increment("webhook_events_blocked_total")
+                    if not self.enqueue(event_queue, item, self.config.blocked_timeout):
+                        self.drop(event)
+                        self.add_pending(chat_id, -1)
+        if inline_done is not None:
+            # Later events of the chat may be queued meanwhile, the worker holds
+            # them until this one is done
+            metrics.increment("webhook_events_inline_total")
+            try:
+                self.process(event, payload)
+            finally:
+                inline_done.set()
+                self.add_pending(chat_id, -1)
+        self.update_queue_depth()
+
+    @staticmethod
+    def enqueue(event_queue: queue.Queue, item: Any, timeout: float) -> bool:
+        try:
+            event_queue.put(item, timeout=timeout)
+        except queue.Full:
+            return False
+        metrics.increment("webhook_events_enqueued_total")
+        return True
+
+    def drop(self, event: Any) -> None:
+        # The workers are stuck, the event is released so a redelivery of it is
+        # handled
+        metrics.increment("webhook_events_dropped_total")
+        logger.error("Webhook queue stayed full, dropped event")
+        if self.deduplicator is not None:
+            self.deduplicator.release(event)
+
+    def process(self, event: Any, payload: Any) -> None:
+        # LINE's event ID makes the logs of one event easy to find
+        with trace(getattr(event, "webhook_event_id", None), get_sender_id(event)):
+            try:
+                with metrics.timer("webhook_handle_seconds"):
+                    self.handler.dispatch(event, payload)
+            except Exception:
+                metrics.increment("webhook_events_failed_total")
+                logger.exception("Failed to handle webhook event")
+                if self.deduplicator is not None:
+                    self.deduplicator.release(event)
+
+    def get_queue(self, event: Any) -> queue.Queue:
+        chat_id = get_chat_id(event)
+        if chat_id is None:
+            return min(self.queues, key=queue.Queue.qsize)
+        return self.queues[hash(chat_id) % len(self.queues)]
+
+    def add_pending(self, chat_id: str, count: int) -> ChatState:
+        with self.lock:
+            chat = self.chats.get(chat_id)
+            if chat is None:
+                chat = self.chats[chat_id] = ChatState()
+            chat.pending += count
+            if not chat.pending:
+                del self.chats[chat_id]
+        return chat
+
+    def wait_for_inline(self, chat_id: Optional[str]) -> None:
+        with self.lock:
+            chat = self.chats.get(chat_id) if chat_id is not None else None
+            inline_done = chat.inline_done if chat is not None else None
+        if inline_done is not None:
+            inline_done.wait()
+
+    def get_executor(self) -> ThreadPoolExecutor:
+        if self.executor is None:
+            with self.lock:
+                if self.executor is None:
+                    self.executor = ThreadPoolExecutor(
+                        max_workers=self.config.workers,
+                        thread_name_prefix="webhook-sync",
+                    )
+        return self.executor
+
+    def update_queue_depth(self) -> None:
+        metrics.set_gauge("webhook_queue_depth", sum(q.qsize() for q in self.queues))
+
+    def start(self) -> None:
+        if self.workers:
+            return
+        with self.lock:
+            if self.workers:
+                return
+            for index, event_queue in enumerate(self.queues):
+                worker = threading.Thread(
+                    target=self.run,
+                    args=(event_queue,),
+                    name=f"webhook-worker-{index}",
+                    daemon=True,
+                )
+                worker.start()
+                self.workers.append(worker)
+            atexit.register(self.shutdown)
+
+    def run(self, event_queue: queue.Queue) -> None:
+        while True:
+            item = event_queue.get()
+            try:
+                if item is None:
+                    return
+                event, payload, enqueued_at = item
+                metrics.observe(
+                    "webhook_queue_wait_seconds", time.perf_counter() - enqueued_at
+                )
+                self.update_queue_depth()
+                chat_id = get_chat_id(event)
+                self.wait_for_inline(chat_id)
+                self.process(event, payload)
+                if chat_id is not None:
+                    self.add_pending(chat_id, -1)
+            finally:
+                event_queue.task_done()
+
+    def shutdown(self) -> None:
+        # Stop accepting new work, let workers drain their queues, then stop them
+        deadline = time.monotonic() + self.config.shutdown_timeout
+        with self.lock:
+            if self.closed:
+                return
+            self.closed = True
+            # Events of requests already past the closed check go in first
+            self.dispatched.wait_for(
+                lambda: self.dispatching == 0,
+                timeout=max(deadline - time.monotonic(), 0),
+            )
+        for event_queue in self.queues[: len(self.workers)]:
+            try:
+                event_queue.put(None, timeout=max(deadline - time.monotonic(), 0))
+            except queue.Full:
+                break
+        for worker in self.workers:
+            worker.join(timeout=max(deadline - time.monotonic(), 0))
+        if self.executor is not None:
+            self.executor.shutdown(wait=False)
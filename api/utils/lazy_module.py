@@ -0,0 +1,16 @@
+import importlib
+from types import ModuleType
+from typing import Any, Optional
+
+
+class LazyModule:
+    # Stands in for a module and imports it on first attribute access, so heavy
+    # SDKs are only loaded by the code paths that use them
+    def __init__(self, name: str):
+        self.name = name
+        self.module: Optional[ModuleType] = None
+
+    def __getattr__(self, attribute: str) -> Any:
+        if self.module is None:
+            self.module = importlib.import_module(self.name)
+        return getattr(self.module, attribute)
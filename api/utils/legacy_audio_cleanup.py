@@ -0,0 +1,63 @@
+"""Delete the audio earlier versions stored per user in the Minio bucket.
+
+Audio was uploaded under "<SHA-256 of the user ID>/", then under
+"users/<SHA-256 of the user ID>/", and deleted on the user's next message. It is
+now shared under "tts/" and expired by the bucket's lifecycle, so the per-user
+folders left by those versions are never read or deleted again.
+
+Usage: python -m api.utils.legacy_audio_cleanup [--dry-run]
+"""
+
+import argparse
+import os
+import re
+from typing import List
+from dotenv import load_dotenv
+from flask import Config
+from api.config.key import ConfigKey
+from api.config.loader import ConfigLoader
+from api.storage.minio import MinioStorage
+
+# Object names of the first version started with "/", which some servers keep
+LEGACY_PARENT_FOLDERS = ("", "/", "users/")
+USER_FOLDER_PATTERN = re.compile(r"[0-9a-f]{64}/")
+
+
+def find_legacy_folders(storage: MinioStorage, bucket_name: str) -> List[str]:
+    return [
+        folder
+        for parent in LEGACY_PARENT_FOLDERS
+        for folder in storage.list_folders(bucket_name, parent)
+        if USER_FOLDER_PATTERN.fullmatch(folder[len(parent) :])
+    ]
+
+
+def clean_legacy_folders(
+    storage: MinioStorage, bucket_name: str, dry_run: bool = False
+) -> List[str]:
+    # Returns the folders found, deleted unless dry_run is set
+    folders = find_legacy_folders(storage, bucket_name)
+    if not dry_run:
+        for folder in folders:
+            storage.clean_files(bucket_name, folder)
+    return folders
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument(
+        "--dry-run", action="store_true", help="list the folders without deleting"
+    )
+    args = parser.parse_args()
+    load_dotenv()
+    config = Config(os.getcwd())
+    ConfigLoader().load(config)
+    folders = clean_legacy_folders(
+        MinioStorage(), config.get(ConfigKey.APP_NAME), args.dry_run
+    )
+    action = "found" if args.dry_run else "deleted"
+    print(f"{len(folders)} per-user folders {action}")
+
+
+if __name__ == "__main__":
+    main()
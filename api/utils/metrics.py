@@ -0,0 +1,187 @@
+import bisect
+import functools
+import hmac
+import inspect
+import threading
+import time
+import weakref
+from contextlib import contextmanager
+from typing import Callable, Dict, Iterator, List, Optional, Tuple
+
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+MetricKey = Tuple[str, Tuple[Tuple[str, str], ...]]
+
+
+class Histogram:
+    def __init__(self, buckets: Tuple[float, ...] = DEFAULT_BUCKETS):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value: float) -> None:
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+
+
+class Metrics:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.counters: Dict[MetricKey, float] = {}
+        self.gauges: Dict[MetricKey, float] = {}
+        self.histograms: Dict[MetricKey, Histogram] = {}
+        self.collectors: List[weakref.WeakMethod] = []
+
+    def increment(self, name: str, value: float = 1, **labels: str) -> None:
+        key = self.make_key(name, labels)
+        with self.lock:
+            self.counters[key] = self.counters.get(key, 0) + value
+
+    def set_gauge(self, name: str, value: float, **labels: str) -> None:
+        key = self.make_key(name, labels)
+        with self.lock:
+            self.gauges[key] = value
+
+    def observe(self, name: str, value: float, **labels: str) -> None:
+        key = self.make_key(name, labels)
+        with self.lock:
+            histogram = self.histograms.get(key)
+            if histogram is None:
+                histogram = self.histograms[key] = Histogram()
+            histogram.observe(value)
+
+    @contextmanager
+    def timer(self, name: str, **labels: str) -> Iterator[None]:
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(name, time.perf_counter() - start, **labels)
+
+    def external_call(self, service: str, operation: str) -> "ExternalCall":
+        return ExternalCall(self, service, operation)
+
+    def add_collector(self, collector: Callable[["Metrics"], None]) -> None:
+        # A bound method called before every snapshot and render, to set gauges
+        # that are read from its object rather than updated as things happen. The
+        # object is held weakly so the registry does not keep it alive
+        with self.lock:
+            self.collectors.append(weakref.WeakMethod(collector))
+
+    def collect(self) -> None:
+        with self.lock:
+            self.collectors = [ref for ref in self.collectors if ref() is not None]
+            collectors = [ref() for ref in self.collectors]
+        for collector in collectors:
+            if collector is not None:
+                collector(self)
+
+    def snapshot(self) -> dict:
+        self.collect()
+        with self.lock:
+            return {
+                "counters": dict(self.counters),
+                "gauges": dict(self.gauges),
+                "histograms": {
+                    key: {"count": h.count, "sum": h.sum}
+                    for key, h in self.histograms.items()
+                },
+            }
+
+    def render(self) -> str:
+        # Prometheus text exposition format, one TYPE line per metric name
+        self.collect()
+        with self.lock:
+            counters = sorted(self.counters.items())
+            gauges = sorted(self.gauges.items())
+            histograms = sorted(
+                (key, (h.buckets, list(h.counts), h.sum, h.count))
+                for key, h in self.histograms.items()
+            )
+        lines = []
+        for kind, items in (("counter", counters), ("gauge", gauges)):
+            previous_name = None
+            for (name, labels), value in items:
+                if name != previous_name:
+                    lines.append(f"# TYPE {name} {kind}")
+                    previous_name = name
+                lines.append(f"{name}{self.format_labels(labels)} {value}")
+        previous_name = None
+        for (name, labels), (buckets, counts, total, count) in histograms:
+            if name != previous_name:
+                lines.append(f"# TYPE {name} histogram")
+                previous_name = name
+            cumulative = 0
+            for bound, bucket_count in zip((*buckets, "+Inf"), counts):
+                cumulative += bucket_count
+                bucket_labels = self.format_labels((*labels, ("le", str(bound))))
+                lines.append(f"{name}_bucket{bucket_labels} {cumulative}")
+            lines.append(f"{name}_sum{self.format_labels(labels)} {total}")
+            lines.append(f"{name}_count{self.format_labels(labels)} {count}")
+        return "\n".join(lines) + "\n"
+
+    @staticmethod
+    def is_scrape_allowed(authorization: Optional[str], token: Optional[str]) -> bool:
+        # Scrapes must send the configured token as a bearer token
+        if not token or not authorization:
+            return False
+        return hmac.compare_digest(authorization.encode(), f"Bearer {token}".encode())
+
+    @staticmethod
+    def format_labels(labels: Tuple[Tuple[str, str], ...]) -> str:
+        if not labels:
+            return ""
+        escaped = (
+            (k, v.replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n"))
+            for k, v in labels
+        )
+        return "{" + ",".join(f'{k}="{v}"' for k, v in escaped) + "}"
+
+    @staticmethod
+    def make_key(name: str, labels: Dict[str, str]) -> MetricKey:
+        return name, tuple(sorted((k, str(v)) for k, v in labels.items()))
+
+
+class ExternalCall:
+    # Records the duration of a call to an external service and whether it failed.
+    # Used as a context manager, or as a decorator that times every call
+    def __init__(self, registry: Metrics, service: str, operation: str):
+        self.registry = registry
+        self.service = service
+        self.operation = operation
+        self.start = 0.0
+
+    def __enter__(self) -> "ExternalCall":
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback) -> None:
+        labels = {"service": self.service, "operation": self.operation}
+        self.registry.observe(
+            "external_call_seconds", time.perf_counter() - self.start, **labels
+        )
+        if exc_type is not None:
+            self.registry.increment("external_call_errors_total", **labels)
+
+    def __call__(self, func: Callable) -> Callable:
+        registry, service, operation = self.registry, self.service, self.operation
+        if inspect.iscoroutinefunction(func):
+
+            @functools.wraps(func)
+            async def async_wrapper(*args, **kwargs):
+                with ExternalCall(registry, service, operation):
+                    return await func(*args, **kwargs)
+
+            return async_wrapper
+
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            with ExternalCall(registry, service, operation):
+                return func(*args, **kwargs)
+
+        return wrapper
+
+
+metrics = Metrics()
@@ -0,0 +1,60 @@
+import contextvars
+import threading
+from concurrent.futures import Executor, Future, wait
+from typing import Any, Callable, Dict
+
+
+class Pipeline:
+    # Runs each stage on the executor as soon as the stages it depends on are done,
+    # passing their results as arguments; a failed dependency fails its dependents
+    def __init__(self, executor: Executor):
+        self.executor = executor
+        self.stages: Dict[str, Future] = {}
+
+    def add(self, name: str, func: Callable[..., Any], *dependencies: str) -> Future:
+        future: Future = Future()
+        self.stages[name] = future
+        dependency_futures = [self.stages[dependency] for dependency in dependencies]
+        state = {"pending": len(dependency_futures), "failed": False}
+        lock = threading.Lock()
+        # Stages keep the trace ID and other context of the caller
+        context = contextvars.copy_context()
+
+        def run() -> None:
+            if not future.set_running_or_notify_cancel():
+                return
+            try:
+                future.set_result(
+                    func(*(dependency.result() for dependency in dependency_futures))
+                )
+            except BaseException as error:
+                future.set_exception(error)
+
+        def on_dependency_done(dependency: Future) -> None:
+            failed = dependency.cancelled() or dependency.exception() is not None
+            with lock:
+                if state["failed"]:
+                    return
+                if failed:
+                    state["failed"] = True
+                else:
+                    state["pending"] -= 1
+                    if state["pending"] > 0:
+                        return
+            if not failed:
+                self.executor.submit(context.run, run)
+            elif future.set_running_or_notify_cancel():
+                error = None if dependency.cancelled() else dependency.exception()
+                future.set_exception(error or RuntimeError(f"{name} cancelled"))
+
+        if not dependency_futures:
+            self.executor.submit(context.run, run)
+        for dependency in dependency_futures:
+            dependency.add_done_callback(on_dependency_done)
+        return future
+
+    def wait(self, timeout: float | None = None) -> None:
+        wait(self.stages.values(), timeout)
+
+    def result(self, name: str, timeout: float | None = None) -> Any:
+        return self.stages[name].result(timeout)
@@ -0,0 +1,252 @@
+import asyncio
+import math
+import threading
+import time
+from collections import OrderedDict, deque
+from enum import IntEnum
+from typing import Deque, Dict, List, Optional, Tuple
+from api.utils.metrics import metrics
+
+# A budget is slowed down by half on every rate limit response, down to this
+# fraction, and recovers by RATE_RECOVERY on every successful request
+MIN_RATE_FACTOR = 0.1
+RATE_RECOVERY = 0.05
+
+
+class Priority(IntEnum):
+    # Lower values are granted first
+    INTERACTIVE = 0
+    BACKGROUND = 1
+
+
+def parse_budgets(value: str) -> Dict[str, Tuple[int, int]]:
+    # "gpt-5-nano=500/200000,whisper-1=50" gives the requests and the tokens per
+    # minute of each model, 0 or a missing value for no limit
+    budgets = {}
+    for item in filter(None, (part.strip() for part in value.split(","))):
+        model, _, limits = item.partition("=")
+        requests, _, tokens = limits.partition("/")
+        try:
+            budgets[model.strip()] = (int(requests or 0), int(tokens or 0))
+        except ValueError:
+            raise ValueError(f"無效的速率限制設定：{item}") from None
+    return budgets
+
+
+class TokenBucket:
+    # Holds up to one minute of budget and refills continuously
+    def __init__(self, per_minute: int):
+        self.capacity = per_minute
+        self.level = float(per_minute)
+        self.rate = per_minute / 60
+        self.updated = time.monotonic()
+
+    def wait_time(self, amount: int, rate_factor: float, now: float) -> float:
+        rate = self.rate * rate_factor
+        # A bucket created after now was taken has not refilled, nor drained
+        elapsed = max(0.0, now - self.updated)
+        self.level = min(self.capacity, self.level + elapsed * rate)
+        self.updated = max(self.updated, now)
+        # A request larger than the whole budget waits for a full bucket
+        missing = min(amount, self.capacity) - self.level
+        return missing / rate if missing > 0 else 0.0
+
+    def take(self, amount: int) -> None:
+        self.level -= min(amount, self.capacity)
+
+
+class Budget:
+    def __init__(self, requests_per_minute: int = 0, tokens_per_minute: int = 0):
+        self.requests = (
+            TokenBucket(requests_per_minute) if requests_per_minute else None
+        )
+        self.tokens = TokenBucket(tokens_per_minute) if tokens_per_minute else None
+        self.rate_factor = 1.0
+        self.paused_until = 0.0
+
+    def wait_time(self, tokens: int, now: float) -> float:
+        wait = self.paused_until - now
+        if self.requests is not None:
+            wait = max(wait, self.requests.wait_time(1, self.rate_factor, now))
+        if self.tokens is not None:
+            wait = max(wait, self.tokens.wait_time(tokens, self.rate_factor, now))
+        return max(wait, 0.0)
+
+    def take(self, tokens: int) -> None:
+        if self.requests is not None:
+            self.requests.take(1)
+        if self.tokens is not None:
+            self.tokens.take(tokens)
+
+    def slow_down(self, retry_after: float, now: float) -> None:
+        # Nothing is sent until the server allows it again, and then slower, as
+        # the budget is shared with whatever else uses the same API key
+        self.paused_until = max(self.paused_until, now + retry_after)
+        self.rate_factor = max(MIN_RATE_FACTOR, self.rate_factor / 2)
+        for bucket in (self.requests, self.tokens):
+            if bucket is not None:
+                bucket.level = min(bucket.level, 0.0)
+
+    def speed_up(self) -> None:
+        self.rate_factor = min(1.0, self.rate_factor + RATE_RECOVERY)
+
+
+class Waiter:
+    def __init__(self, model: str, priority: Priority, user: str, tokens: int):
+        self.model = model
+        self.priority = priority
+        self.user = user
+        self.tokens = tokens
+        self.granted = False
+        self.start = time.perf_counter()
+        # Set for coroutines, threads wait on the scheduler's condition
+        self.loop: Optional[asyncio.AbstractEventLoop] = None
+        self.event: Optional[asyncio.Event] = None
+
+    def grant(self) -> None:
+        self.granted = True
+        if self.loop is not None:
+            self.loop.call_soon_threadsafe(self.event.set)
+
+
+class RequestScheduler:
+    # Lets a request start once a concurrency slot is free and the budgets of its
+    # model allow it. Higher priorities go first, and within a priority the users
+    # take turns, so one busy user cannot hold everyone else back
+    def __init__(
+        self,
+        name: str,
+        max_concurrency: int = 0,
+        budgets: Optional[Dict[str, Tuple[int, int]]] = None,
+    ):
+        self.name = name
+        self.max_concurrency = max_concurrency
+        self.limits = budgets or {}
+        self.budgets: Dict[str, Budget] = {}
+        self.condition = threading.Condition()
+        self.queues: List["OrderedDict[str, Deque[Waiter]]"] = [
+            OrderedDict() for _ in Priority
+        ]
+        self.queued = 0
+        self.running = 0
+
+    def acquire(
+        self, model: str, priority: Priority, user: Optional[str], tokens: int
+    ) -> None:
+        waiter = Waiter(model, priority, user or "", tokens)
+        with self.condition:
+            self.enqueue(waiter)
+            while True:
+                delay = self.grant()
+                if waiter.granted:
+                    break
+                self.condition.wait(None if math.isinf(delay) else delay)
+        self.observe_wait(waiter)
+
+    async def acquire_async(
+        self, model: str, priority: Priority, user: Optional[str], tokens: int
+    ) -> None:
+        waiter = Waiter(model, priority, user or "", tokens)
+        waiter.loop = asyncio.get_running_loop()
+        waiter.event = asyncio.Event()
+        with self.condition:
+            self.enqueue(waiter)
+        try:
+            while True:
+                with self.condition:
+                    delay = self.grant()
+                if waiter.granted:
+                    break
+                try:
+                    await asyncio.wait_for(
+                        waiter.event.wait(), None if math.isinf(delay) else delay
+                    )
+                except asyncio.TimeoutError:
+                    pass
+        except asyncio.CancelledError:
+            with self.condition:
+                if waiter.granted:
+                    self.running -= 1
+                    self.grant()
+                else:
+                    self.dequeue(waiter)
+            raise
+        self.observe_wait(waiter)
+
+    def release(self) -> None:
+        with self.condition:
+            self.running -= 1
+            self.grant()
+
+    def slow_down(self, model: str, retry_after: float) -> None:
+        with self.condition:
+            self.get_budget(model).slow_down(retry_after, time.monotonic())
+
+    def speed_up(self, model: str) -> None:
+        with self.condition:
+            budget = self.budgets.get(model)
+            if budget is not None:
+                budget.speed_up()
+
+    def grant(self) -> float:
+        # Called with the condition held. Returns how long until a waiter held
+        # back by its model's budget may go
+        now = time.monotonic()
+        blocked: Dict[str, float] = {}
+        granted = False
+        while self.max_concurrency <= 0 or self.running < self.max_concurrency:
+            waiter = self.next_waiter(now, blocked)
+            if waiter is None:
+                break
+            self.get_budget(waiter.model).take(waiter.tokens)
+            self.dequeue(waiter)
+            self.running += 1
+            waiter.grant()
+            granted = True
+        if granted:
+            self.condition.notify_all()
+        return min(blocked.values(), default=math.inf)
+
+    def next_waiter(self, now: float, blocked: Dict[str, float]) -> Optional[Waiter]:
+        for queue in self.queues:
+            # Users are kept in the order they were last served
+            for waiters in queue.values():
+                waiter = waiters[0]
+                if waiter.model in blocked:
+                    continue
+                wait = self.get_budget(waiter.model).wait_time(waiter.tokens, now)
+                if wait <= 0:
+                    return waiter
+                # Later waiters must not use up the budget the first one waits for
+                blocked[waiter.model] = wait
+        return None
+
+    def enqueue(self, waiter: Waiter) -> None:
+        self.queues[waiter.priority].setdefault(waiter.user, deque()).append(waiter)
+        self.queued += 1
+        metrics.set_gauge("request_scheduler_queued", self.queued, scheduler=self.name)
+
+    def dequeue(self, waiter: Waiter) -> None:
+        queue = self.queues[waiter.priority]
+        waiters = queue[waiter.user]
+        waiters.remove(waiter)
+        if waiters:
+            queue.move_to_end(waiter.user)
+        else:
+            del queue[waiter.user]
+        self.queued -= 1
+        metrics.set_gauge("request_scheduler_queued", self.queued, scheduler=self.name)
+
+    def get_budget(self, model: str) -> Budget:
+        budget = self.budgets.get(model)
+        if budget is None:
+            budget = self.budgets[model] = Budget(*self.limits.get(model, (0, 0)))
+        return budget
+
+    def observe_wait(self, waiter: Waiter) -> None:
+        metrics.observe(
+            "request_scheduler_wait_seconds",
+            time.perf_counter() - waiter.start,
+            scheduler=self.name,
+            priority=waiter.priority.name.lower(),
+        )
@@ -0,0 +1,123 @@
+import asyncio
+import contextvars
+import re
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass
+from typing import Optional
+from api.ai.chatgpt import AsyncChatGPT, ChatGPT
+from api.config.base import BaseConfig
+from api.utils.text_segmenter import TextSegmenter
+
+SURROUNDING_WHITESPACE_PATTERN = re.compile(r"^(\s*)(.*?)(\s*)$", re.DOTALL)
+
+
+@dataclass
+class SegmentedTranslatorConfig(BaseConfig):
+    threshold: int = 0
+    segment_size: int = 500
+    concurrency: int = 4
+
+    @classmethod
+    def from_env(cls) -> "SegmentedTranslatorConfig":
+        return cls(
+            threshold=cls.get_int("TRANSLATION_SEGMENT_THRESHOLD", 0),
+            segment_size=cls.get_int("TRANSLATION_SEGMENT_SIZE", 500),
+            concurrency=cls.get_int("TRANSLATION_SEGMENT_CONCURRENCY", 4),
+        )
+
+    @classmethod
+    def merge(
+        cls,
+        base: "SegmentedTranslatorConfig",
+        override: Optional["SegmentedTranslatorConfig"],
+    ) -> "SegmentedTranslatorConfig":
+        if override is None:
+            return base
+        return cls(
+            threshold=override.threshold or base.threshold,
+            segment_size=override.segment_size or base.segment_size,
+            concurrency=override.concurrency or base.concurrency,
+        )
+
+
+class SegmentedTranslator:
+    def __init__(
+        self,
+        chatgpt: ChatGPT,
+        text_segmenter: TextSegmenter,
+        config: Optional[SegmentedTranslatorConfig] = None,
+    ):
+        self.chatgpt = chatgpt
+        self.text_segmenter = text_segmenter
+        self.config = SegmentedTranslatorConfig.merge(
+            base=SegmentedTranslatorConfig.from_env(), override=config
+        )
+        # Shared by all requests so the number of concurrent segment calls is bounded
+        self.executor = ThreadPoolExecutor(
+            max_workers=self.config.concurrency, thread_name_prefix="segment"
+        )
+
+    def translate(self, text: str, language: str) -> str:
+        if self.config.threshold <= 0 or len(text) < self.config.threshold:
+            return self.chatgpt.translate(text, language)
+        segments = self.text_segmenter.split_paragraphs(text, self.config.segment_size)
+        self.chatgpt.prefetch_translations(
+            [segment for segment in segments if segment.strip()], language
+        )
+        # Each segment goes through ChatGPT.translate and its cache, so a re-sent
+        # text with small edits only translates the segments that changed. Segments
+        # keep the trace ID and user of the caller
+        futures = [
+            self.executor.submit(
+                contextvars.copy_context().run,
+                self.translate_segment,
+                segment,
+                language,
+            )
+            for segment in segments
+        ]
+        return "".join(future.result() for future in futures)
+
+    def translate_segment(self, segment: str, language: str) -> str:
+        leading, content, trailing = SURROUNDING_WHITESPACE_PATTERN.match(
+            segment
+        ).groups()
+        if not content:
+            return segment
+        return leading + self.chatgpt.translate(content, language) + trailing
+
+
+class AsyncSegmentedTranslator:
+    def __init__(
+        self,
+        chatgpt: AsyncChatGPT,
+        text_segmenter: TextSegmenter,
+        config: Optional[SegmentedTranslatorConfig] = None,
+    ):
+        self.chatgpt = chatgpt
+        self.text_segmenter = text_segmenter
+        self.config = SegmentedTranslatorConfig.merge(
+            base=SegmentedTranslatorConfig.from_env(), override=config
+        )
+        # Shared by all requests so the number of concurrent segment calls is bounded
+        self.semaphore = asyncio.Semaphore(self.config.concurrency)
+
+    async def translate(self, text: str, language: str) -> str:
+        if self.config.threshold <= 0 or len(text) < self.config.threshold:
+            return await self.chatgpt.translate(text, language)
+        segments = self.text_segmenter.split_paragraphs(text, self.config.segment_size)
+        # Segments run as tasks, which keep the trace ID and user of the caller
+        return "".join(
+            await asyncio.gather(
+                *(self.translate_segment(segment, language) for segment in segments)
+            )
+        )
+
+    async def translate_segment(self, segment: str, language: str) -> str:
+        leading, content, trailing = SURROUNDING_WHITESPACE_PATTERN.match(
+            segment
+        ).groups()
+        if not content:
+            return segment
+        async with self.semaphore:
+            return leading + await self.chatgpt.translate(content, language) + trailing
@@ -0,0 +1,32 @@
+import threading
+from concurrent.futures import Future
+from typing import Any, Callable, Dict, Hashable
+from api.utils.metrics import metrics
+
+
+class SingleFlight:
+    # Concurrent calls with the same key share the result of the first one
+    def __init__(self, name: str):
+        self.name = name
+        self.lock = threading.Lock()
+        self.calls: Dict[Hashable, Future] = {}
+
+    def do(self, key: Hashable, func: Callable[[], Any]) -> Any:
+        with self.lock:
+            future = self.calls.get(key)
+            leader = future is None
+            if leader:
+                future = self.calls[key] = Future()
+        if not leader:
+            metrics.increment("single_flight_shared_total", operation=self.name)
+            return future.result()
+        try:
+            result = func()
+            future.set_result(result)
+            return result
+        except BaseException as error:
+            future.set_exception(error)
+            raise
+        finally:
+            with self.lock:
+                self.calls.pop(key, None)
@@ -0,0 +1,67 @@
+import re
+from typing import List
+
+# A sentence ends after CJK or Latin end punctuation (optionally followed by closing
+# quotes or brackets) or at a line break. Latin punctuation only ends a sentence
+# when whitespace follows, so "3.50" or "e.g." inside a word do not
+CLOSING_MARKS = r"[」』）)\"'”’]*"
+SENTENCE_END_PATTERN = re.compile(
+    rf"(?:[。！？…]+{CLOSING_MARKS}|[.!?]+{CLOSING_MARKS}(?=\s|$))\s*|\n+"
+)
+# The end of a partial text is no sentence end for Latin punctuation, since what
+# follows ("3." then "50") has not arrived yet
+PARTIAL_SENTENCE_END_PATTERN = re.compile(
+    rf"(?:[。！？…]+{CLOSING_MARKS}|[.!?]+{CLOSING_MARKS}(?=\s))\s*|\n+"
+)
+# Split after the line breaks that end a paragraph, keeping them with it
+PARAGRAPH_END_PATTERN = re.compile(r"(?<=\n)(?=[^\n])")
+
+
+class TextSegmenter:
+    def find_sentence_end(self, text: str, final: bool = True) -> int:
+        # Index right after the last complete sentence, 0 if there is none. A text
+        # that is still being streamed is not final
+        pattern = SENTENCE_END_PATTERN if final else PARTIAL_SENTENCE_END_PATTERN
+        end = 0
+        for match in pattern.finditer(text):
+            end = match.end()
+        return end
+
+    def split_sentences(self, text: str) -> List[str]:
+        sentences = []
+        start = 0
+        for match in SENTENCE_END_PATTERN.finditer(text):
+            sentences.append(text[start : match.end()])
+            start = match.end()
+        if start < len(text):
+            sentences.append(text[start:])
+        return sentences
+
+    def split_paragraphs(self, text: str, max_length: int) -> List[str]:
+        # Paragraphs are packed separately so an edit only changes the chunks of
+        # the paragraph it is in
+        chunks = []
+        for paragraph in PARAGRAPH_END_PATTERN.split(text):
+            if paragraph:
+                chunks.extend(self.split_text(paragraph, max_length))
+        return chunks
+
+    def split_text(self, text: str, max_length: int) -> List[str]:
+        # Pack whole sentences into chunks of at most max_length characters, only
+        # cutting inside a sentence when it is longer than max_length by itself
+        chunks = []
+        chunk = ""
+        for sentence in self.split_sentences(text):
+            while len(sentence) > max_length:
+                if chunk:
+                    chunks.append(chunk)
+                    chunk = ""
+                chunks.append(sentence[:max_length])
+                sentence = sentence[max_length:]
+            if len(chunk) + len(sentence) > max_length:
+                chunks.append(chunk)
+                chunk = ""
+            chunk += sentence
+        if chunk:
+            chunks.append(chunk)
+        return chunks
@@ -0,0 +1,55 @@
+import contextvars
+import logging
+import uuid
+from contextlib import contextmanager
+from typing import Iterator, Optional
+
+LOG_FORMAT = "%(asctime)s %(levelname)s [%(trace_id)s] %(name)s: %(message)s"
+
+trace_id_var: contextvars.ContextVar[Optional[str]] = contextvars.ContextVar(
+    "trace_id", default=None
+)
+user_id_var: contextvars.ContextVar[Optional[str]] = contextvars.ContextVar(
+    "user_id", default=None
+)
+
+
+def get_trace_id() -> Optional[str]:
+    return trace_id_var.get()
+
+
+def get_user_id() -> Optional[str]:
+    return user_id_var.get()
+
+
+@contextmanager
+def trace(
+    trace_id: Optional[str] = None, user_id: Optional[str] = None
+) -> Iterator[str]:
+    # Everything logged inside, in this thread or task, carries the trace ID, and
+    # outgoing requests know which user they are made for
+    trace_id = trace_id or uuid.uuid4().hex[:16]
+    token = trace_id_var.set(trace_id)
+    user_token = user_id_var.set(user_id)
+    try:
+        yield trace_id
+    finally:
+        user_id_var.reset(user_token)
+        trace_id_var.reset(token)
+
+
+def enable_trace_id_logging() -> None:
+    # Every log record gets a trace_id attribute ("-" outside a trace), so any
+    # handler can use %(trace_id)s; the root logger is set up with it if needed
+    factory = logging.getLogRecordFactory()
+    if getattr(factory, "adds_trace_id", False):
+        return
+
+    def record_factory(*args, **kwargs) -> logging.LogRecord:
+        record = factory(*args, **kwargs)
+        record.trace_id = trace_id_var.get() or "-"
+        return record
+
+    record_factory.adds_trace_id = True
+    logging.setLogRecordFactory(record_factory)
+    logging.basicConfig(format=LOG_FORMAT)
@@ -0,0 +1,92 @@
+import contextvars
+import threading
+from concurrent.futures import Future, ThreadPoolExecutor
+from typing import Callable, Dict, List, Tuple
+from api.utils.metrics import metrics
+
+# The text, the future of its translation and the context of the caller
+PendingTranslation = Tuple[str, Future, contextvars.Context]
+
+
+class TranslationBatcher:
+    # Collects translations requested within a short window and sends each target
+    # language as one batch request, falling back to concurrent requests per text
+    # when its response cannot be used
+    def __init__(
+        self,
+        window_ms: int,
+        max_size: int,
+        translate_batch: Callable[[List[str], str], List[str]],
+        translate_one: Callable[[str, str], str],
+    ):
+        self.window = window_ms / 1000
+        self.max_size = max_size
+        self.translate_batch = translate_batch
+        self.translate_one = translate_one
+        self.lock = threading.Lock()
+        self.pending: Dict[str, List[PendingTranslation]] = {}
+        self.executor = ThreadPoolExecutor(
+            max_workers=max_size, thread_name_prefix="translation-fallback"
+        )
+
+    def translate(self, text: str, language: str) -> str:
+        future: Future = Future()
+        with self.lock:
+            batch = self.pending.get(language)
+            if batch is None:
+                batch = self.pending[language] = []
+                timer = threading.Timer(self.window, self.flush, (language, batch))
+                timer.daemon = True
+                timer.start()
+            batch.append((text, future, contextvars.copy_context()))
+            full = len(batch) >= self.max_size
+            if full:
+                del self.pending[language]
+        if full:
+            self.send(language, batch)
+        return future.result()
+
+    def flush(self, language: str, batch: List[PendingTranslation]) -> None:
+        with self.lock:
+            # The batch may already have been sent because it filled up
+            if self.pending.get(language) is not batch:
+                return
+            del self.pending[language]
+        self.send(language, batch)
+
+    def send(self, language: str, batch: List[PendingTranslation]) -> None:
+        metrics.increment("translation_batches_total")
+        metrics.increment("translation_batched_texts_total", len(batch))
+        if len(batch) == 1:
+            text, future, context = batch[0]
+            context.run(self.translate_into, text, language, future)
+            return
+        # The batch request runs in the context of the first caller, so it keeps
+        # that trace ID and the scheduler charges the batch to that user
+        context = batch[0][2]
+        try:
+            results = context.run(
+                self.translate_batch, [text for text, _, _ in batch], language
+            )
+        except ValueError:
+            metrics.increment("translation_batch_fallbacks_total")
+            # Each text is then requested in the context of its caller
+            for text, future, context in batch:
+                self.executor.submit(
+                    context.run, self.translate_into, text, language, future
+                )
+            return
+        except BaseException as error:
+            # Rate limits, quotas and connection errors would only be repeated
+            # once per text, so every caller gets the error instead
+            for _, future, _ in batch:
+                future.set_exception(error)
+            return
+        for (_, future, _), result in zip(batch, results):
+            future.set_result(result)
+
+    def translate_into(self, text: str, language: str, future: Future) -> None:
+        try:
+            future.set_result(self.translate_one(text, language))
+        except BaseException as error:
+            future.set_exception(error)
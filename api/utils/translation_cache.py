@@ -0,0 +1,197 @@
+import asyncio
+import hashlib
+import time
+import unicodedata
+import uuid
+from dataclasses import dataclass
+from typing import Awaitable, Callable, Iterable, Optional
+from api.config.base import BaseConfig
+from api.storage.cache import AsyncMultiTierCacheAdapter, MultiTierCacheAdapter
+from api.utils.metrics import metrics
+
+
+@dataclass
+class TranslationCacheConfig(BaseConfig):
+    lru_size: float = 1000.0
+    ttl: int = 86400
+    lock_seconds: int = 0
+    max_bytes: int = 0
+    audio_lru_size: float = 1000.0
+    audio_max_bytes: int = 0
+
+    @classmethod
+    def from_env(cls) -> "TranslationCacheConfig":
+        return cls(
+            lru_size=cls.get_float("TRANSLATION_CACHE_SIZE", default=1000.0),
+            ttl=cls.get_int("TRANSLATION_CACHE_TTL", default=86400),
+            lock_seconds=cls.get_int("TRANSLATION_CACHE_LOCK_SECONDS", default=0),
+            max_bytes=cls.get_int("TRANSLATION_CACHE_MAX_BYTES", default=0),
+            audio_lru_size=cls.get_float("AUDIO_CACHE_SIZE", default=1000.0),
+            audio_max_bytes=cls.get_int("AUDIO_CACHE_MAX_BYTES", default=0),
+        )
+
+    @classmethod
+    def merge(
+        cls,
+        base: "TranslationCacheConfig",
+        override: Optional["TranslationCacheConfig"],
+    ) -> "TranslationCacheConfig":
+        if override is None:
+            return base
+        return cls(
+            lru_size=override.lru_size or base.lru_size,
+            ttl=override.ttl or base.ttl,
+            lock_seconds=override.lock_seconds or base.lock_seconds,
+            max_bytes=override.max_bytes or base.max_bytes,
+            audio_lru_size=override.audio_lru_size or base.audio_lru_size,
+            audio_max_bytes=override.audio_max_bytes or base.audio_max_bytes,
+        )
+
+
+def make_translation_key(
+    app_name: str, text: str, language: str, model: str, temperature: float
+) -> str:
+    normalized_text = unicodedata.normalize("NFC", text).strip()
+    digest = hashlib.sha256(
+        "\0".join((normalized_text, language, model, repr(temperature))).encode()
+    ).hexdigest()
+    return f"{app_name}.translation.{digest}"
+
+
+class TranslationCache:
+    LOCK_POLL_INTERVAL = 0.2
+
+    def __init__(
+        self, cache: MultiTierCacheAdapter, app_name: str, lock_seconds: int = 0
+    ):
+        self.cache = cache
+        self.app_name = app_name
+        self.lock_seconds = lock_seconds
+
+    def get(
+        self, text: str, language: str, model: str, temperature: float
+    ) -> Optional[str]:
+        value = self.cache.get(self.make_key(text, language, model, temperature))
+        metrics.increment(
+            "translation_cache_requests_total",
+            result="miss" if value is None else "hit",
+        )
+        return value
+
+    def set(
+        self, text: str, language: str, model: str, temperature: float, value: str
+    ) -> None:
+        self.cache.set(self.make_key(text, language, model, temperature), value)
+
+    def prefetch(
+        self, texts: Iterable[str], language: str, model: str, temperature: float
+    ) -> None:
+        # Load the stored entries of several texts into the local tier in one round
+        # trip so the following gets are answered locally
+        self.cache.get_many(
+            {self.make_key(text, language, model, temperature) for text in texts}
+        )
+
+    def load(
+        self,
+        text: str,
+        language: str,
+        model: str,
+        temperature: float,
+        translate: Callable[[], str],
+    ) -> str:
+        # Translate and store a missing entry. With lock_seconds, workers sharing the
+        # remote tier take a lock first and the others wait for the stored result
+        key = self.make_key(text, language, model, temperature)
+        if self.lock_seconds <= 0:
+            value = translate()
+            self.cache.set(key, value)
+            return value
+        lock_key = f"{key}.lock"
+        token = uuid.uuid4().hex
+        if not self.cache.acquire_lock(lock_key, token, self.lock_seconds):
+            metrics.increment("translation_cache_lock_waits_total")
+            deadline = time.monotonic() + self.lock_seconds
+            while time.monotonic() < deadline:
+                time.sleep(self.LOCK_POLL_INTERVAL)
+                # Read the remote tier directly, past any negative local entry
+                value = self.cache.load(key)
+                if value is not None:
+                    return value
+            # The lock holder did not finish in time, translate without it
+            value = translate()
+            self.cache.set(key, value)
+            return value
+        try:
+            value = translate()
+            self.cache.set(key, value)
+            return value
+        finally:
+            self.cache.release_lock(lock_key, token)
+
+    def make_key(self, text: str, language: str, model: str, temperature: float) -> str:
+        return make_translation_key(self.app_name, text, language, model, temperature)
+
+
+class AsyncTranslationCache:
+    LOCK_POLL_INTERVAL = 0.2
+
+    def __init__(
+        self, cache: AsyncMultiTierCacheAdapter, app_name: str, lock_seconds: int = 0
+    ):
+        self.cache = cache
+        self.app_name = app_name
+        self.lock_seconds = lock_seconds
+
+    async def get(
+        self, text: str, language: str, model: str, temperature: float
+    ) -> Optional[str]:
+        value = await self.cache.get(self.make_key(text, language, model, temperature))
+        metrics.increment(
+            "translation_cache_requests_total",
+            result="miss" if value is None else "hit",
+        )
+        return value
+
+    async def set(
+        self, text: str, language: str, model: str, temperature: float, value: str
+    ) -> None:
+        await self.cache.set(self.make_key(text, language, model, temperature), value)
+
+    async def load(
+        self,
+        text: str,
+        language: str,
+        model: str,
+        temperature: float,
+        translate: Callable[[], Awaitable[str]],
+    ) -> str:
+        # The same lock as TranslationCache.load, so sync and async workers that
+        # share the remote tier also wait for each other
+        key = self.make_key(text, language, model, temperature)
+        if self.lock_seconds <= 0:
+            value = await translate()
+            await self.cache.set(key, value)
+            return value
+        lock_key = f"{key}.lock"
+        token = uuid.uuid4().hex
+        if not await self.cache.acquire_lock(lock_key, token, self.lock_seconds):
+            metrics.increment("translation_cache_lock_waits_total")
+            deadline = time.monotonic() + self.lock_seconds
+            while time.monotonic() < deadline:
+                await asyncio.sleep(self.LOCK_POLL_INTERVAL)
+                value = await self.cache.load(key)
+                if value is not None:
+                    return value
+            value = await translate()
+            await self.cache.set(key, value)
+            return value
+        try:
+            value = await translate()
+            await self.cache.set(key, value)
+            return value
+        finally:
+            await self.cache.release_lock(lock_key, token)
+
+    def make_key(self, text: str, language: str, model: str, temperature: float) -> str:
+        return make_translation_key(self.app_name, text, language, model, temperature)
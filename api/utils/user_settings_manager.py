@@ -1,17 +1,375 @@
-from api.storage.cache import MultiTierCacheAdapter
+import asyncio
+import atexit
+import logging
+import threading
+import time
+from dataclasses import dataclass
+from typing import Any, Dict, Optional, Tuple
+from api.config.base import BaseConfig
+from api.storage.cache import (
+    NEGATIVE_ENTRY,
+    AsyncMultiTierCacheAdapter,
+    MultiTierCacheAdapter,
+)
+from api.utils.metrics import metrics
+
+logger = logging.getLogger(__name__)
+
+# Longest wait before retrying a failed flush
+MAX_FLUSH_RETRY_SECONDS = 30.0
+# Writes that keep losing to other workers give up after this many attempts
+MAX_WRITE_ATTEMPTS = 5
+# Version the changes were made on, the changed settings, and the new entry
+PendingSettings = Tuple[int, dict, dict]
+
+
+@dataclass
+class UserSettingsConfig(BaseConfig):
+    ttl: int = 30
+    write_behind_ms: int = 0
+    max_bytes: int = 0
+
+    @classmethod
+    def from_env(cls) -> "UserSettingsConfig":
+        return cls(
+            ttl=cls.get_int("USER_SETTINGS_TTL", default=30),
+            write_behind_ms=cls.get_int("USER_SETTINGS_WRITE_BEHIND_MS", default=0),
+            max_bytes=cls.get_int("USER_SETTINGS_CACHE_MAX_BYTES", default=0),
+        )
+
+    @classmethod
+    def merge(
+        cls, base: "UserSettingsConfig", override: Optional["UserSettingsConfig"]
+    ) -> "UserSettingsConfig":
+        if override is None:
+            return base
+        return cls(
+            ttl=override.ttl or base.ttl,
+            write_behind_ms=override.write_behind_ms or base.write_behind_ms,
+            max_bytes=override.max_bytes or base.max_bytes,
+        )
+
+
+def make_settings_entry(settings: dict) -> dict:
+    # Nanoseconds since the epoch, so the entries of all workers can be ordered
+    return {"version": time.time_ns(), "settings": settings}
+
+
+def read_settings_entry(entry: Optional[Any]) -> Tuple[int, dict]:
+    if not entry:
+        return 0, {}
+    if "version" in entry and "settings" in entry:
+        return entry["version"], entry["settings"]
+    # Entries stored before versioning hold the settings themselves
+    return 0, entry
+
+
+def get_newer_entry(entry: Optional[Any], other: Optional[Any]) -> Optional[Any]:
+    if not other:
+        return entry
+    if not entry:
+        return other
+    return (
+        other
+        if read_settings_entry(other)[0] > read_settings_entry(entry)[0]
+        else entry
+    )
+
+
+def is_newer_write(cached_entry: Optional[Any], version: int) -> bool:
+    # Whether a write announced by another worker replaces the cached entry
+    if cached_entry is None:
+        return False
+    if cached_entry is NEGATIVE_ENTRY:
+        return True
+    return version > read_settings_entry(cached_entry)[0]
+
+
+def resolve_writes(
+    pending: Dict[str, PendingSettings], stored_entries: Dict[str, Any]
+) -> Dict[str, dict]:
+    # Another worker may have written since the changes were made. A stored entry
+    # newer than the change is kept; one newer than what the change was made on
+    # gets the changed settings applied on top, so its other settings survive
+    entries = {}
+    for key, (base_version, changes, entry) in pending.items():
+        stored_version, stored_settings = read_settings_entry(stored_entries.get(key))
+        if stored_version > entry["version"]:
+            metrics.increment("user_settings_stale_writes_total")
+            continue
+        if stored_version > base_version:
+            entry = {
+                "version": entry["version"],
+                "settings": {**entry["settings"], **stored_settings, **changes},
+            }
+        entries[key] = entry
+    return entries
 
 
 class UserSettingsManager:
-    def __init__(self, cache: MultiTierCacheAdapter, app_name: str):
+    # Settings are read through the multi-tier cache. Entries are written with a
+    # compare-and-set on the version they were made on, and resolved against the
+    # stored entry when another worker wrote first. Backends that announce writes
+    # drop stale entries from the local tier at once; with the others, changes of
+    # other workers are picked up after local_ttl. With write_behind_ms set,
+    # writes are applied locally at once and sent to the remote tier together
+    # after the window, and again later if that fails
+    def __init__(
+        self,
+        cache: MultiTierCacheAdapter,
+        app_name: str,
+        config: Optional[UserSettingsConfig] = None,
+    ):
         self.cache = cache
         self.app_name = app_name
+        self.config = UserSettingsConfig.merge(
+            base=UserSettingsConfig.from_env(), override=config
+        )
+        self.lock = threading.Lock()
+        self.pending: Dict[str, PendingSettings] = {}
+        self.timer: Optional[threading.Timer] = None
+        self.flush_failures = 0
+        if self.config.write_behind_ms > 0:
+            atexit.register(self.flush)
+        # Subscribing connects to the remote tier, so it waits for the first call
+        # instead of slowing down the cold start
+        self.subscribed = False
+
+    def subscribe(self) -> None:
+        if self.subscribed:
+            return
+        with self.lock:
+            if self.subscribed:
+                return
+            try:
+                self.cache.subscribe(self.invalidate)
+            except Exception:
+                # The local entries then expire with their TTL and a later call
+                # tries again
+                logger.exception("Failed to subscribe to user settings changes")
+                return
+            self.subscribed = True
+
+    def set_settings(self, user_id: str, settings: dict) -> dict:
+        self.subscribe()
+        key = self.make_key(user_id)
+        version, current_settings = self.load_entry(key)
+        return self.update_entry(key, version, current_settings, settings)
+
+    def get_or_init_settings(self, user_id: str, defaults: dict) -> dict:
+        # Reads the settings once per event, and stores the defaults for new users
+        # without reading them again
+        self.subscribe()
+        key = self.make_key(user_id)
+        version, settings = self.load_entry(key)
+        if settings:
+            return settings
+        # Settings another worker stored meanwhile win over the defaults
+        return self.update_entry(key, version, {}, defaults, changes={})
 
-    def set_settings(self, user_id: str, settings: dict) -> None:
-        key = f"{self.app_name}.{user_id}.settings"
-        current_settings = self.cache.get(key) or {}
-        updated_settings = {**current_settings, **settings}
-        self.cache.set(key, updated_settings)
+    def update_entry(
+        self,
+        key: str,
+        version: int,
+        current_settings: dict,
+        settings: dict,
+        changes: Optional[dict] = None,
+    ) -> dict:
+        changes = settings if changes is None else changes
+        entry = make_settings_entry({**current_settings, **settings})
+        self.cache.local.set(key, entry)
+        if self.config.write_behind_ms <= 0:
+            entries = self.write({key: (version, changes, entry)})
+            return read_settings_entry(entries[key])[1]
+        with self.lock:
+            previous = self.pending.get(key)
+            if previous is not None:
+                # Changes not flushed yet are sent along with this one
+                version, previous_changes, _ = previous
+                changes = {**previous_changes, **changes}
+            self.pending[key] = (version, changes, entry)
+            self.schedule_flush()
+        return entry["settings"]
+
+    def schedule_flush(self) -> None:
+        # Called with the lock held. Retries after failures back off
+        if self.timer is None:
+            delay = min(
+                self.config.write_behind_ms / 1000 * 2**self.flush_failures,
+                MAX_FLUSH_RETRY_SECONDS,
+            )
+            self.timer = threading.Timer(delay, self.flush)
+            self.timer.daemon = True
+            self.timer.start()
 
     def get_settings(self, user_id: str) -> dict:
-        key = f"{self.app_name}.{user_id}.settings"
-        return self.cache.get(key) or {}
+        self.subscribe()
+        _, settings = self.load_entry(self.make_key(user_id))
+        return settings
+
+    def load_entry(self, key: str) -> Tuple[int, dict]:
+        # A write that has not reached the remote tier yet wins over an older entry
+        with self.lock:
+            pending = self.pending.get(key)
+        entry = self.cache.get(key)
+        if pending is not None:
+            entry = get_newer_entry(entry, pending[2])
+        return read_settings_entry(entry)
+
+    def write(self, pending: Dict[str, PendingSettings]) -> Dict[str, dict]:
+        # Returns the entry each key holds afterwards. Nothing is read first: an
+        # entry is written if the remote tier still holds the version it was made
+        # on, and only the keys another worker wrote meanwhile are resolved
+        # against what it stored and tried again
+        entries = {}
+        expected_versions = {
+            key: base_version for key, (base_version, _, _) in pending.items()
+        }
+        stored_entries: Dict[str, Any] = {}
+        for _ in range(MAX_WRITE_ATTEMPTS):
+            resolved_entries = resolve_writes(pending, stored_entries)
+            for key in pending.keys() - resolved_entries.keys():
+                self.cache.local.set(key, stored_entries[key])
+                entries[key] = stored_entries[key]
+            conflicts = self.cache.compare_and_set_many(
+                {
+                    key: (expected_versions[key], entry["version"], entry)
+                    for key, entry in resolved_entries.items()
+                }
+            )
+            for key in resolved_entries.keys() - conflicts.keys():
+                entries[key] = resolved_entries[key]
+            if not conflicts:
+                return entries
+            metrics.increment("user_settings_write_conflicts_total", len(conflicts))
+            pending = {key: pending[key] for key in conflicts}
+            expected_versions = {
+                key: version for key, (version, _) in conflicts.items()
+            }
+            stored_entries = {key: entry for key, (_, entry) in conflicts.items()}
+        raise RuntimeError(f"使用者設定寫入衝突次數過多：{', '.join(pending)}")
+
+    def invalidate(self, key: str, version: int) -> None:
+        # Another worker wrote the entry, it is read from the remote tier next time
+        if is_newer_write(self.cache.local.get(key), version):
+            self.cache.local.delete(key)
+            metrics.increment("user_settings_invalidations_total")
+
+    def flush(self) -> None:
+        with self.lock:
+            self.timer = None
+            pending = dict(self.pending)
+        if not pending:
+            return
+        try:
+            self.write(pending)
+        except Exception:
+            # The entries stay pending and are sent with the next flush
+            logger.exception("Failed to flush user settings")
+            metrics.increment("user_settings_flush_failures_total")
+            with self.lock:
+                self.flush_failures += 1
+                self.schedule_flush()
+            return
+        with self.lock:
+            self.flush_failures = 0
+            # Keep the entries that were replaced while flushing for the next flush
+            for key, item in pending.items():
+                if self.pending.get(key) is item:
+                    del self.pending[key]
+        metrics.increment("user_settings_flushes_total")
+        metrics.increment("user_settings_flushed_total", len(pending))
+
+    def make_key(self, user_id: str) -> str:
+        return f"{self.app_name}.{user_id}.settings"
+
+
+class AsyncUserSettingsManager:
+    def __init__(self, cache: AsyncMultiTierCacheAdapter, app_name: str):
+        self.cache = cache
+        self.app_name = app_name
+        # Subscribing needs the event loop, so it waits for the first call
+        self.subscribed = False
+        self.subscribe_lock = asyncio.Lock()
+
+    async def subscribe(self) -> None:
+        if self.subscribed:
+            return
+        async with self.subscribe_lock:
+            if self.subscribed:
+                return
+            try:
+                await self.cache.subscribe(self.invalidate)
+            except Exception:
+                logger.exception("Failed to subscribe to user settings changes")
+                return
+            self.subscribed = True
+
+    async def set_settings(self, user_id: str, settings: dict) -> dict:
+        await self.subscribe()
+        key = self.make_key(user_id)
+        version, current_settings = read_settings_entry(await self.cache.get(key))
+        return await self.update_entry(key, version, current_settings, settings)
+
+    async def get_or_init_settings(self, user_id: str, defaults: dict) -> dict:
+        await self.subscribe()
+        key = self.make_key(user_id)
+        version, settings = read_settings_entry(await self.cache.get(key))
+        if settings:
+            return settings
+        return await self.update_entry(key, version, {}, defaults, changes={})
+
+    async def update_entry(
+        self,
+        key: str,
+        version: int,
+        current_settings: dict,
+        settings: dict,
+        changes: Optional[dict] = None,
+    ) -> dict:
+        changes = settings if changes is None else changes
+        entry = make_settings_entry({**current_settings, **settings})
+        entries = await self.write({key: (version, changes, entry)})
+        return read_settings_entry(entries[key])[1]
+
+    async def write(self, pending: Dict[str, PendingSettings]) -> Dict[str, dict]:
+        entries = {}
+        expected_versions = {
+            key: base_version for key, (base_version, _, _) in pending.items()
+        }
+        stored_entries: Dict[str, Any] = {}
+        for _ in range(MAX_WRITE_ATTEMPTS):
+            resolved_entries = resolve_writes(pending, stored_entries)
+            for key in pending.keys() - resolved_entries.keys():
+                self.cache.local.set(key, stored_entries[key])
+                entries[key] = stored_entries[key]
+            conflicts = await self.cache.compare_and_set_many(
+                {
+                    key: (expected_versions[key], entry["version"], entry)
+                    for key, entry in resolved_entries.items()
+                }
+            )
+            for key in resolved_entries.keys() - conflicts.keys():
+                entries[key] = resolved_entries[key]
+            if not conflicts:
+                return entries
+            metrics.increment("user_settings_write_conflicts_total", len(conflicts))
+            pending = {key: pending[key] for key in conflicts}
+            expected_versions = {
+                key: version for key, (version, _) in conflicts.items()
+            }
+            stored_entries = {key: entry for key, (_, entry) in conflicts.items()}
+        raise RuntimeError(f"使用者設定寫入衝突次數過多：{', '.join(pending)}")
+
+    def invalidate(self, key: str, version: int) -> None:
+        if is_newer_write(self.cache.local.get(key), version):
+            self.cache.local.delete(key)
+            metrics.increment("user_settings_invalidations_total")
+
+    async def get_settings(self, user_id: str) -> dict:
+        await self.subscribe()
+        _, settings = read_settings_entry(await self.cache.get(self.make_key(user_id)))
+        return settings
+
+    def make_key(self, user_id: str) -> str:
+        return f"{self.app_name}.{user_id}.settings"
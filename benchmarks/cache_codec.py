@@ -0,0 +1,70 @@
+"""Compare the size and speed of the cache encodings on typical cached values.
+
+Usage: python -m benchmarks.cache_codec [iterations]
+"""
+
+import json
+import sys
+import time
+from api.storage.codec import CacheCodec
+
+SAMPLES = {
+    "settings": {
+        "version": 1760000000000000000,
+        "settings": {
+            "translate_language": "English",
+            "audio_language": "Traditional Chinese",
+        },
+    },
+    "short translation": "今天天氣很好，我們去公園散步吧。",
+    "long translation": "這是一段用來測試快取編碼效率的長篇翻譯結果。" * 40,
+    "english translation": "The quick brown fox jumps over the lazy dog. " * 40,
+    "audio metadata": {"duration": 12.345, "content_type": "audio/mpeg"},
+}
+
+
+class LegacyCodec:
+    # The encoding used before codecs were configurable
+    def encode(self, value):
+        return json.dumps(value, default=str)
+
+    def decode(self, serialized_value):
+        return json.loads(serialized_value)
+
+
+CODECS = {
+    "legacy json": LegacyCodec(),
+    "json": CacheCodec(),
+    "json + zlib": CacheCodec(compression_threshold=256),
+}
+
+
+def measure(codec, value, iterations: int):
+    encoded = codec.encode(value)
+    start = time.perf_counter()
+    for _ in range(iterations):
+        codec.encode(value)
+    encode_seconds = time.perf_counter() - start
+    start = time.perf_counter()
+    for _ in range(iterations):
+        codec.decode(encoded)
+    decode_seconds = time.perf_counter() - start
+    return len(encoded.encode()), encode_seconds, decode_seconds
+
+
+def main(iterations: int) -> None:
+    print(
+        f"{'sample':<20} {'codec':<15} {'bytes':>7} {'encode/s':>10} {'decode/s':>10}"
+    )
+    for sample_name, value in SAMPLES.items():
+        for codec_name, codec in CODECS.items():
+            size, encode_seconds, decode_seconds = measure(codec, value, iterations)
+            print(
+                f"{sample_name:<20} {codec_name:<15} {size:>7} "
+                f"{iterations / encode_seconds:>10.0f} "
+                f"{iterations / decode_seconds:>10.0f}"
+            )
+
+
+if __name__ == "__main__":
+    main(int(sys.argv[1]) if len(sys.argv) > 1 else 10000)
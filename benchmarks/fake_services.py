@@ -0,0 +1,494 @@
+"""Local stand-ins for the LINE, OpenAI, MinIO and Upstash HTTP APIs and for Redis.
+
+Each service answers just enough of its API for this app, after an optional
+injected latency, and records how often and how long each route was served.
+"""
+
+import json
+import re
+import threading
+import time
+import uuid
+from email.utils import formatdate
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from socketserver import StreamRequestHandler, ThreadingTCPServer
+from typing import BinaryIO, Callable, Dict, List, Optional, Tuple
+from urllib.parse import parse_qs, unquote, urlparse
+from api.storage.cache import COMPARE_AND_SET_SCRIPT
+
+Response = Tuple[int, Dict[str, str], bytes]
+
+# One silent MPEG-1 Layer III frame (128 kbps, 44.1 kHz, about 26 ms)
+MP3_FRAME = b"\xff\xfb\x90\x64" + b"\x00" * 413
+
+
+def json_response(value, status: int = 200) -> Response:
+    return status, {"Content-Type": "application/json"}, json.dumps(value).encode()
+
+
+class RouteStats:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.counts: Dict[str, int] = {}
+        self.seconds: Dict[str, float] = {}
+
+    def record(self, route: str, seconds: float) -> None:
+        with self.lock:
+            self.counts[route] = self.counts.get(route, 0) + 1
+            self.seconds[route] = self.seconds.get(route, 0.0) + seconds
+
+    def snapshot(self) -> Dict[str, Tuple[int, float]]:
+        with self.lock:
+            return {
+                route: (count, self.seconds[route])
+                for route, count in self.counts.items()
+            }
+
+
+class FakeService:
+    name = "service"
+
+    def __init__(self, latency: float = 0.0):
+        self.latency = latency
+        self.stats = RouteStats()
+        self.server: Optional[ThreadingHTTPServer] = None
+
+    @property
+    def url(self) -> str:
+        host, port = self.server.server_address[:2]
+        return f"http://{host}:{port}"
+
+    def start(self) -> "FakeService":
+        service = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1"
+
+            def handle_request(self):
+                start = time.perf_counter()
+                parsed = urlparse(self.path)
+                length = int(self.headers.get("Content-Length") or 0)
+                body = self.rfile.read(length) if length else b""
+                if service.latency:
+                    time.sleep(service.latency)
+                route, (status, headers, content) = service.route(
+                    self.command,
+                    parsed.path,
+                    parse_qs(parsed.query, keep_blank_values=True),
+                    self.headers,
+                    body,
+                )
+                # Counted before the response, so a client sees it once answered
+                service.stats.record(
+                    f"{service.name} {route}", time.perf_counter() - start
+                )
+                self.send_response(status)
+                for name, value in headers.items():
+                    self.send_header(name, value)
+                if "Content-Length" not in headers:
+                    self.send_header("Content-Length", str(len(content)))
+                self.end_headers()
+                if self.command != "HEAD":
+                    self.wfile.write(content)
+
+            do_GET = do_POST = do_PUT = do_HEAD = do_DELETE = handle_request
+
+            def log_message(self, format, *args):
+                pass
+
+        self.server = ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+        self.server.daemon_threads = True
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+        return self
+
+    def stop(self) -> None:
+        self.server.shutdown()
+        self.server.server_close()
+
+    def route(self, method, path, query, headers, body) -> Tuple[str, Response]:
+        raise NotImplementedError
+
+
+class FakeLine(FakeService):
+    name = "line"
+
+    def __init__(self, latency: float = 0.0, audio_size: int = 32 * 1024):
+        super().__init__(latency)
+        self.audio = b"\x00" * audio_size
+        self.lock = threading.Lock()
+        self.replies: List[dict] = []
+        self.pushes: List[dict] = []
+        self.push_retry_keys: List[Optional[str]] = []
+        # Statuses answered to the next requests of a route instead of serving them
+        self.failures: Dict[str, List[int]] = {}
+
+    def route(self, method, path, query, headers, body):
+        route = self.get_route_name(path)
+        with self.lock:
+            if route == "push":
+                self.push_retry_keys.append(headers.get("X-Line-Retry-Key"))
+            statuses = self.failures.get(route)
+            status = statuses.pop(0) if statuses else None
+        if status is not None:
+            return route, json_response({"message": "Injected failure"}, status)
+        if route == "loading":
+            return route, json_response({}, 202)
+        if route in ("reply", "push"):
+            request = json.loads(body)
+            with self.lock:
+                (self.replies if route == "reply" else self.pushes).append(request)
+            return route, json_response(self.make_sent_messages(request))
+        if route == "content":
+            return route, (200, {"Content-Type": "audio/x-m4a"}, self.audio)
+        return route, json_response({"message": "Not found"}, 404)
+
+    @staticmethod
+    def get_route_name(path: str) -> str:
+        if path == "/v2/bot/chat/loading/start":
+            return "loading"
+        if path in ("/v2/bot/message/reply", "/v2/bot/message/push"):
+            return path.rsplit("/", 1)[1]
+        if re.fullmatch(r"/v2/bot/message/[^/]+/content", path):
+            return "content"
+        return "unknown"
+
+    @staticmethod
+    def make_sent_messages(request: dict) -> dict:
+        return {
+            "sentMessages": [
+                {"id": uuid.uuid4().hex, "quoteToken": uuid.uuid4().hex}
+                for _ in request["messages"]
+            ]
+        }
+
+
+class FakeOpenAI(FakeService):
+    name = "openai"
+
+    def __init__(self, latency: float = 0.0, audio_frames: int = 100):
+        super().__init__(latency)
+        self.speech = MP3_FRAME * audio_frames
+
+    def route(self, method, path, query, headers, body):
+        if path == "/v1/responses":
+            request = json.loads(body)
+            text = f"[translated] {request['input']}"
+            if request.get("stream"):
+                return "responses stream", self.make_stream(text)
+            return "responses", json_response(
+                {
+                    "id": f"resp_{uuid.uuid4().hex}",
+                    "object": "response",
+                    "created_at": int(time.time()),
+                    "model": request["model"],
+                    "status": "completed",
+                    "output": [
+                        {
+                            "type": "message",
+                            "id": f"msg_{uuid.uuid4().hex}",
+                            "status": "completed",
+                            "role": "assistant",
+                            "content": [
+                                {"type": "output_text", "text": text, "annotations": []}
+                            ],
+                        }
+                    ],
+                    "parallel_tool_calls": False,
+                    "tool_choice": "auto",
+                    "tools": [],
+                }
+            )
+        if path == "/v1/audio/speech":
+            return "speech", (200, {"Content-Type": "audio/mpeg"}, self.speech)
+        if path == "/v1/audio/transcriptions":
+            return "transcriptions", json_response({"text": "今天天氣很好"})
+        if path == "/v1/audio/translations":
+            return "translations", json_response({"text": "The weather is nice"})
+        return "unknown", json_response({"error": {"message": "Not found"}}, 404)
+
+    @staticmethod
+    def make_stream(text: str) -> Response:
+        # Server-sent events with one delta per word
+        events = [
+            {
+                "type": "response.output_text.delta",
+                "item_id": "msg_0",
+                "output_index": 0,
+                "content_index": 0,
+                "delta": delta,
+            }
+            for delta in re.findall(r"\S+\s*", text)
+        ]
+        events.append({"type": "response.completed"})
+        content = "".join(
+            f"event: {event['type']}\ndata: {json.dumps(event)}\n\n" for event in events
+        )
+        return 200, {"Content-Type": "text/event-stream"}, content.encode()
+
+
+class FakeMinio(FakeService):
+    name = "minio"
+
+    def __init__(self, latency: float = 0.0):
+        super().__init__(latency)
+        self.lock = threading.Lock()
+        self.objects: Dict[str, Tuple[bytes, Dict[str, str]]] = {}
+        self.lifecycle: Optional[bytes] = None
+
+    def route(self, method, path, query, headers, body):
+        bucket, _, object_name = unquote(path).lstrip("/").partition("/")
+        if not object_name:
+            if "location" in query:
+                return "location", (
+                    200,
+                    {"Content-Type": "application/xml"},
+                    b"<LocationConstraint>us-east-1</LocationConstraint>",
+                )
+            if "lifecycle" in query:
+                if method == "PUT":
+                    self.lifecycle = body
+                    return "lifecycle", (200, {}, b"")
+                if self.lifecycle is None:
+                    return "lifecycle", (
+                        404,
+                        {"Content-Type": "application/xml"},
+                        b"<Error><Code>NoSuchLifecycleConfiguration</Code>"
+                        b"<Message>The lifecycle configuration does not exist</Message>"
+                        b"</Error>",
+                    )
+                return "lifecycle", (
+                    200,
+                    {"Content-Type": "application/xml"},
+                    self.lifecycle,
+                )
+            return "bucket", (200, {}, b"")
+        if method == "PUT":
+            metadata = {
+                name: value
+                for name, value in headers.items()
+                if name.lower().startswith("x-amz-meta-")
+            }
+            with self.lock:
+                self.objects[object_name] = (body, metadata)
+            return "put", (200, {"ETag": f'"{uuid.uuid4().hex}"'}, b"")
+        with self.lock:
+            stored = self.objects.get(object_name)
+        if stored is None:
+            return "missing", (404, {"Content-Length": "0"}, b"")
+        content, metadata = stored
+        headers = {
+            "ETag": '"0"',
+            "Last-Modified": formatdate(usegmt=True),
+            "Content-Type": "audio/mpeg",
+            **metadata,
+        }
+        if method == "HEAD":
+            return "stat", (200, {**headers, "Content-Length": str(len(content))}, b"")
+        return "get", (200, headers, content)
+
+
+class RedisError(str):
+    # An error reply, the message without the leading "-"
+    pass
+
+
+class FakeRedisStore:
+    # Runs the Redis commands this app sends, for the Upstash REST and the native
+    # Redis stand-ins alike. TTLs are ignored
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.store: Dict[str, str] = {}
+        self.subscribers: Dict[str, List[Callable[[str, str], None]]] = {}
+
+    def execute(self, command: list):
+        name, args = command[0].upper(), [str(arg) for arg in command[1:]]
+        if name == "PUBLISH":
+            return self.publish(args[0], args[1])
+        with self.lock:
+            if name == "GET":
+                return self.store.get(args[0])
+            if name == "MGET":
+                return [self.store.get(key) for key in args]
+            if name == "SET":
+                options = [arg.upper() for arg in args[2:]]
+                if "NX" in options and args[0] in self.store:
+                    return None
+                self.store[args[0]] = args[1]
+                return "OK"
+            if name == "MSET":
+                self.store.update(zip(args[::2], args[1::2]))
+                return "OK"
+            if name == "DEL":
+                return sum(self.store.pop(key, None) is not None for key in args)
+            if name == "EVAL" and args[0] == COMPARE_AND_SET_SCRIPT:
+                key_count = int(args[1])
+                conflicts, published = self.compare_and_set(
+                    args[2 : 2 + key_count], args[2 + key_count :]
+                )
+            elif name == "EVAL":
+                # Otherwise the compare-and-delete script used to release locks
+                key, token = args[2], args[3]
+                if self.store.get(key) == token:
+                    del self.store[key]
+                    return 1
+                return 0
+            elif name in ("PING", "CLIENT", "SELECT"):
+                return "PONG" if name == "PING" else "OK"
+            else:
+                return RedisError(f"ERR unknown command '{name}'")
+        for channel, message in published:
+            self.publish(channel, message)
+        return conflicts
+
+    def compare_and_set(self, keys: List[str], args: List[str]) -> Tuple[list, list]:
+        # What COMPARE_AND_SET_SCRIPT does, TTLs aside. Returns the conflicts and
+        # the invalidations to publish
+        conflicts, published = [], []
+        for index in range(0, len(keys), 2):
+            key, version_key = keys[index], keys[index + 1]
+            expected_version, version, value = args[2 + index // 2 * 3 :][:3]
+            stored_version = self.store.get(version_key, "0")
+            if stored_version == expected_version:
+                self.store[key] = value
+                self.store[version_key] = version
+                published.append((args[1], f"{version} {key}"))
+            else:
+                conflicts += [key, stored_version, self.store.get(key)]
+        return conflicts, published
+
+    def publish(self, channel: str, message: str) -> int:
+        with self.lock:
+            subscribers = list(self.subscribers.get(channel, ()))
+        for subscriber in subscribers:
+            subscriber(channel, message)
+        return len(subscribers)
+
+    def subscribe(self, channel: str, subscriber: Callable[[str, str], None]) -> None:
+        with self.lock:
+            self.subscribers.setdefault(channel, []).append(subscriber)
+
+    def unsubscribe(self, channel: str, subscriber: Callable[[str, str], None]) -> None:
+        with self.lock:
+            if subscriber in self.subscribers.get(channel, ()):
+                self.subscribers[channel].remove(subscriber)
+
+
+class FakeUpstash(FakeService):
+    name = "upstash"
+
+    def __init__(self, latency: float = 0.0):
+        super().__init__(latency)
+        self.redis = FakeRedisStore()
+
+    def route(self, method, path, query, headers, body):
+        commands = json.loads(body)
+        if path.rstrip("/") in ("/pipeline", "/multi-exec"):
+            return "pipeline", json_response(
+                [self.make_result(command) for command in commands]
+            )
+        return commands[0].lower(), json_response(self.make_result(commands))
+
+    def make_result(self, command: list) -> dict:
+        result = self.redis.execute(command)
+        if isinstance(result, RedisError):
+            return {"error": result}
+        return {"result": result}
+
+
+def read_resp_command(rfile: BinaryIO) -> Optional[List[str]]:
+    # Clients send every command as an array of bulk strings
+    line = rfile.readline()
+    if not line:
+        return None
+    args = []
+    for _ in range(int(line[1:])):
+        length = int(rfile.readline()[1:])
+        args.append(rfile.read(length + 2)[:-2].decode())
+    return args
+
+
+def encode_resp(value) -> bytes:
+    if value is None:
+        return b"$-1\r\n"
+    if isinstance(value, RedisError):
+        return f"-{value}\r\n".encode()
+    if isinstance(value, int):
+        return f":{value}\r\n".encode()
+    if isinstance(value, list):
+        return f"*{len(value)}\r\n".encode() + b"".join(map(encode_resp, value))
+    data = str(value).encode()
+    return f"${len(data)}\r\n".encode() + data + b"\r\n"
+
+
+class FakeRedis(FakeService):
+    # Speaks RESP over TCP instead of HTTP, including pub/sub
+    name = "redis"
+
+    def __init__(self, latency: float = 0.0):
+        super().__init__(latency)
+        self.redis = FakeRedisStore()
+        self.tcp_server: Optional[ThreadingTCPServer] = None
+
+    @property
+    def url(self) -> str:
+        host, port = self.tcp_server.server_address[:2]
+        return f"redis://{host}:{port}/0"
+
+    def start(self) -> "FakeRedis":
+        service = self
+
+        class Handler(StreamRequestHandler):
+            def handle(self):
+                write_lock = threading.Lock()
+                channels: List[str] = []
+
+                def send(value) -> None:
+                    with write_lock:
+                        self.wfile.write(encode_resp(value))
+
+                def deliver(channel: str, message: str) -> None:
+                    send(["message", channel, message])
+
+                try:
+                    while True:
+                        command = read_resp_command(self.rfile)
+                        if command is None:
+                            return
+                        start = time.perf_counter()
+                        if service.latency:
+                            time.sleep(service.latency)
+                        name = command[0].upper()
+                        # Counted before the reply, so a client sees it once answered
+                        service.stats.record(
+                            f"{service.name} {name.lower()}",
+                            time.perf_counter() - start,
+                        )
+                        if name == "SUBSCRIBE":
+                            for channel in command[1:]:
+                                channels.append(channel)
+                                service.redis.subscribe(channel, deliver)
+                                send(["subscribe", channel, len(channels)])
+                        elif name == "UNSUBSCRIBE":
+                            for channel in command[1:] or list(channels):
+                                if channel in channels:
+                                    channels.remove(channel)
+                                service.redis.unsubscribe(channel, deliver)
+                                send(["unsubscribe", channel, len(channels)])
+                        elif name == "PING" and channels:
+                            send(["pong", ""])
+                        else:
+                            send(service.redis.execute(command))
+                except ConnectionError:
+                    pass
+                finally:
+                    for channel in channels:
+                        service.redis.unsubscribe(channel, deliver)
+
+        self.tcp_server = ThreadingTCPServer(("127.0.0.1", 0), Handler)
+        self.tcp_server.daemon_threads = True
+        threading.Thread(target=self.tcp_server.serve_forever, daemon=True).start()
+        return self
+
+    def stop(self) -> None:
+        self.tcp_server.shutdown()
+        self.tcp_server.server_close()
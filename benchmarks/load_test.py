@@ -0,0 +1,244 @@
+"""Load test the Flask app against local stand-ins for every external service.
+
+Boots api/index.py behind a local HTTP server with LINE, OpenAI, MinIO and
+Upstash replaced by the fakes in benchmarks.fake_services, sends correctly
+signed webhooks and reports throughput, latency percentiles and where the time
+went. No network access is needed.
+
+Usage: python -m benchmarks.load_test --requests 500 --concurrency 16 \\
+    --mix text=8,audio=1,settings=1 --openai-latency 0.2 --audio-push
+"""
+
+import argparse
+import base64
+import hashlib
+import hmac
+import http.client
+import json
+import logging
+import os
+import random
+import sys
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import Dict, List
+from werkzeug.serving import make_server
+from benchmarks.fake_services import FakeLine, FakeMinio, FakeOpenAI, FakeUpstash
+
+CHANNEL_SECRET = "load-test-secret"
+SETTINGS_COMMANDS = ("目前設定", "/current-setting")
+
+
+def parse_mix(value: str) -> Dict[str, int]:
+    mix = {}
+    for part in value.split(","):
+        kind, _, weight = part.partition("=")
+        if kind not in ("text", "audio", "settings"):
+            raise argparse.ArgumentTypeError(f"unknown event kind: {kind}")
+        mix[kind] = int(weight or 1)
+    return mix
+
+
+def make_event(
+    kind: str, index: int, user_id: str, text: str, redelivery: bool = False
+) -> dict:
+    if kind == "audio":
+        message = {"type": "audio", "id": f"audio{index}", "duration": 3000}
+        message["contentProvider"] = {"type": "line"}
+    else:
+        message = {"type": "text", "id": f"text{index}", "text": text}
+        message["quoteToken"] = f"quote{index}"
+    return {
+        "type": "message",
+        "mode": "active",
+        "timestamp": int(time.time() * 1000),
+        "webhookEventId": f"event{index}",
+        "deliveryContext": {"isRedelivery": redelivery},
+        "source": {"type": "user", "userId": user_id},
+        "replyToken": f"reply{index}",
+        "message": message,
+    }
+
+
+def sign(body: bytes) -> str:
+    digest = hmac.new(CHANNEL_SECRET.encode(), body, hashlib.sha256).digest()
+    return base64.b64encode(digest).decode()
+
+
+def percentile(values: List[float], fraction: float) -> float:
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(fraction * len(ordered)))]
+
+
+def format_metric(key) -> str:
+    name, labels = key
+    label = ",".join(f"{k}={v}" for k, v in labels)
+    return f"{name}{{{label}}}" if label else name
+
+
+def configure_environment(args, services) -> None:
+    line, openai, minio, upstash = services
+    os.environ.update(
+        {
+            "APP_ENVIRONMENT": "PRODUCTION",
+            "APP_PERSISTENT_USER_SETTINGS_ENABLED": str(args.persistent_settings),
+            "APP_PUSH_TRANSLATED_TEXT_AUDIO_ENABLED": str(args.audio_push),
+            "LINE_CHANNEL_ACCESS_TOKEN": "load-test-token",
+            "LINE_CHANNEL_SECRET": CHANNEL_SECRET,
+            "LINE_API_HOST": line.url,
+            "LINE_DATA_API_HOST": line.url,
+            "OPENAI_API_KEY": "sk-load-test",
+            "OPENAI_BASE_URL": f"{openai.url}/v1",
+            "MINIO_ENDPOINT": minio.url.removeprefix("http://"),
+            "MINIO_ACCESS_KEY": "load-test",
+            "MINIO_SECRET_KEY": "load-test-secret",
+            "MINIO_BUCKET": "load-test",
+            "MINIO_SECURE": "false",
+            "UPSTASH_REDIS_REST_URL": upstash.url,
+            "UPSTASH_REDIS_REST_TOKEN": "load-test-token",
+        }
+    )
+    os.makedirs(os.path.join("data", "audio"), exist_ok=True)
+
+
+def run(args) -> int:
+    services = (
+        FakeLine(args.line_latency).start(),
+        FakeOpenAI(args.openai_latency).start(),
+        FakeMinio(args.minio_latency).start(),
+        FakeUpstash(args.upstash_latency).start(),
+    )
+    configure_environment(args, services)
+    # Imported only now so the app picks up the environment above
+    from api.index import app
+    from api.utils.metrics import metrics
+
+    logging.getLogger("werkzeug").setLevel(logging.ERROR)
+    server = make_server("127.0.0.1", 0, app, threaded=True)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    port = server.server_port
+
+    kinds = random.Random(args.seed).choices(
+        list(args.mix), weights=list(args.mix.values()), k=args.requests
+    )
+    connections = threading.local()
+
+    def send(index: int, redelivery: bool = False):
+        kind = kinds[index]
+        user_id = f"U{index % args.users:032x}"
+        if kind == "settings":
+            text = SETTINGS_COMMANDS[index % len(SETTINGS_COMMANDS)]
+        else:
+            text = f"今天天氣很好，我們去公園散步吧。#{index % args.distinct_texts}"
+        body = json.dumps(
+            {
+                "destination": "Uload",
+                "events": [make_event(kind, index, user_id, text, redelivery)],
+            }
+        ).encode()
+        connection = getattr(connections, "connection", None)
+        if connection is None:
+            connection = connections.connection = http.client.HTTPConnection(
+                "127.0.0.1", port
+            )
+        start = time.perf_counter()
+        connection.request(
+            "POST",
+            "/webhook",
+            body,
+            {"Content-Type": "application/json", "X-Line-Signature": sign(body)},
+        )
+        response = connection.getresponse()
+        response.read()
+        return kind, response.status, time.perf_counter() - start
+
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=args.concurrency) as executor:
+        results = list(executor.map(send, range(args.requests)))
+    elapsed = time.perf_counter() - start
+    # Redelivered events were handled already and must not be replied again
+    redeliveries = min(args.redeliver, args.requests)
+    with ThreadPoolExecutor(max_workers=args.concurrency) as executor:
+        list(executor.map(lambda index: send(index, True), range(redeliveries)))
+    server.shutdown()
+
+    print(
+        f"{args.requests} requests in {elapsed:.2f}s "
+        f"({args.requests / elapsed:.1f} req/s, concurrency {args.concurrency})"
+    )
+    print(f"\n{'event':<10} {'count':>6} {'p50 ms':>8} {'p95 ms':>8} {'p99 ms':>8}")
+    for kind in ["all", *args.mix]:
+        latencies = [
+            seconds for k, _, seconds in results if kind in ("all", k) and seconds
+        ]
+        if latencies:
+            print(
+                f"{kind:<10} {len(latencies):>6} "
+                f"{percentile(latencies, 0.50) * 1000:>8.1f} "
+                f"{percentile(latencies, 0.95) * 1000:>8.1f} "
+                f"{percentile(latencies, 0.99) * 1000:>8.1f}"
+            )
+
+    snapshot = metrics.snapshot()
+    print(f"\n{'stage (app metrics)':<64} {'count':>7} {'mean ms':>9}")
+    for key, histogram in sorted(snapshot["histograms"].items()):
+        mean = histogram["sum"] / histogram["count"] * 1000
+        print(f"{format_metric(key):<64} {histogram['count']:>7} {mean:>9.1f}")
+
+    print(f"\n{'counter (app metrics)':<64} {'value':>7}")
+    for key, value in sorted(snapshot["counters"].items()):
+        print(f"{format_metric(key):<64} {value:>7g}")
+
+    print(f"\n{'route (fake services)':<64} {'count':>7} {'mean ms':>9}")
+    for service in services:
+        for route, (count, seconds) in sorted(service.stats.snapshot().items()):
+            print(f"{route:<64} {count:>7} {seconds / count * 1000:>9.1f}")
+
+    # Every event is answered with a reply, translated texts also with an audio push
+    failures = sum(status != 200 for _, status, _ in results)
+    replies = len(services[0].replies)
+    pushes = len(services[0].pushes)
+    expected_pushes = kinds.count("text") if args.audio_push else 0
+    print(
+        f"\nnon-200 responses: {failures}, replies: {replies}/{args.requests}, "
+        f"audio pushes: {pushes}/{expected_pushes}, redelivered: {redeliveries}"
+    )
+    for service in services:
+        service.stop()
+    passed = replies == args.requests and pushes == expected_pushes
+    return 0 if passed and not failures else 1
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--requests", type=int, default=200)
+    parser.add_argument("--concurrency", type=int, default=8)
+    parser.add_argument("--users", type=int, default=50)
+    parser.add_argument(
+        "--distinct-texts",
+        type=int,
+        default=sys.maxsize,
+        help="number of different texts, lower it to exercise cache hits",
+    )
+    parser.add_argument(
+        "--mix", type=parse_mix, default=parse_mix("text=8,audio=1,settings=1")
+    )
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--audio-push", action="store_true")
+    parser.add_argument("--persistent-settings", action="store_true")
+    parser.add_argument(
+        "--redeliver",
+        type=int,
+        default=0,
+        help="send this many events again marked as redelivered",
+    )
+    parser.add_argument("--line-latency", type=float, default=0.02)
+    parser.add_argument("--openai-latency", type=float, default=0.2)
+    parser.add_argument("--minio-latency", type=float, default=0.01)
+    parser.add_argument("--upstash-latency", type=float, default=0.01)
+    sys.exit(run(parser.parse_args()))
+
+
+if __name__ == "__main__":
+    main()
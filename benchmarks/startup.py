@@ -0,0 +1,128 @@
+"""Measure the cold start of the Flask app: import time and time to first response.
+
+Every run is a fresh interpreter, as on a serverless cold start. LINE and OpenAI
+are replaced by the local stand-ins in benchmarks.fake_services, so the first
+webhook is translated and replied without network access.
+
+Usage: python -m benchmarks.startup [--runs 5] [--audio-push]
+"""
+
+import argparse
+import json
+import os
+import statistics
+import subprocess
+import sys
+import time
+from benchmarks.fake_services import FakeLine, FakeMinio, FakeOpenAI
+from benchmarks.load_test import CHANNEL_SECRET, make_event, sign
+
+# Modules worth keeping off the import path, reported when they are loaded
+HEAVY_MODULES = (
+    "linebot.v3.messaging",
+    "openai",
+    "minio",
+    "tinytag",
+    "upstash_redis",
+    "redis",
+    "aiohttp",
+)
+
+
+def measure() -> dict:
+    # Runs in the child interpreter
+    start = time.perf_counter()
+    from api.index import app
+
+    import_seconds = time.perf_counter() - start
+    loaded_modules = [name for name in HEAVY_MODULES if name in sys.modules]
+    client = app.test_client()
+
+    start = time.perf_counter()
+    client.get("/")
+    home_seconds = time.perf_counter() - start
+
+    body = json.dumps(
+        {
+            "destination": "Ustartup",
+            "events": [make_event("text", 0, f"U{0:032x}", "今天天氣很好")],
+        }
+    ).encode()
+    start = time.perf_counter()
+    response = client.post(
+        "/webhook",
+        data=body,
+        headers={"Content-Type": "application/json", "X-Line-Signature": sign(body)},
+    )
+    webhook_seconds = time.perf_counter() - start
+    return {
+        "import": import_seconds,
+        "first /": home_seconds,
+        "first webhook": webhook_seconds,
+        "status": response.status_code,
+        "loaded": loaded_modules,
+    }
+
+
+def run(args) -> int:
+    line = FakeLine().start()
+    openai = FakeOpenAI().start()
+    minio = FakeMinio().start()
+    env = {
+        "PATH": os.environ.get("PATH", ""),
+        "HOME": os.environ.get("HOME", ""),
+        "APP_PUSH_TRANSLATED_TEXT_AUDIO_ENABLED": str(args.audio_push),
+        "LINE_CHANNEL_ACCESS_TOKEN": "startup-token",
+        "LINE_CHANNEL_SECRET": CHANNEL_SECRET,
+        "LINE_API_HOST": line.url,
+        "LINE_DATA_API_HOST": line.url,
+        "OPENAI_API_KEY": "sk-startup",
+        "OPENAI_BASE_URL": f"{openai.url}/v1",
+        "MINIO_ENDPOINT": minio.url.removeprefix("http://"),
+        "MINIO_ACCESS_KEY": "startup",
+        "MINIO_SECRET_KEY": "startup-secret",
+        "MINIO_BUCKET": "startup",
+        "MINIO_SECURE": "false",
+    }
+    results = []
+    for _ in range(args.runs):
+        start = time.perf_counter()
+        output = subprocess.run(
+            [sys.executable, "-m", "benchmarks.startup", "--child"],
+            env=env,
+            capture_output=True,
+            text=True,
+            check=True,
+        ).stdout
+        result = json.loads(output.splitlines()[-1])
+        result["process"] = time.perf_counter() - start
+        results.append(result)
+    for service in (line, openai, minio):
+        service.stop()
+
+    print(f"{args.runs} cold starts, audio push {args.audio_push}\n")
+    print(f"{'stage':<16} {'median ms':>10} {'min ms':>8} {'max ms':>8}")
+    for stage in ("import", "first /", "first webhook", "process"):
+        values = [result[stage] * 1000 for result in results]
+        print(
+            f"{stage:<16} {statistics.median(values):>10.1f} "
+            f"{min(values):>8.1f} {max(values):>8.1f}"
+        )
+    print(f"\nloaded by import: {', '.join(results[0]['loaded']) or 'none'}")
+    return 0 if all(result["status"] == 200 for result in results) else 1
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--runs", type=int, default=5)
+    parser.add_argument("--audio-push", action="store_true")
+    parser.add_argument("--child", action="store_true", help=argparse.SUPPRESS)
+    args = parser.parse_args()
+    if args.child:
+        print(json.dumps(measure()))
+        return
+    sys.exit(run(args))
+
+
+if __name__ == "__main__":
+    main()
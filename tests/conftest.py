@@ -0,0 +1,181 @@
+import datetime
+import importlib
+from types import SimpleNamespace
+import pytest
+from minio.error import S3Error
+from api.storage.cache import (
+    AsyncMultiTierCacheAdapter,
+    CacheConfig,
+    MultiTierCacheAdapter,
+)
+from api.storage.minio import MinioStorage
+from api.utils.metrics import metrics
+
+
+@pytest.fixture
+def cache_config(tmp_path):
+    # The shared memory backend stands in for the remote tier, every cache built
+    # from it in one test shares the same SQLite file like workers on one host
+    def make(**kwargs) -> CacheConfig:
+        return CacheConfig(
+            **{
+                "remote_cache_enabled": True,
+                "backend": "shared_memory",
+                "shared_memory_path": str(tmp_path / "cache.db"),
+                "namespace": "test",
+                **kwargs,
+            }
+        )
+
+    return make
+
+
+@pytest.fixture
+def make_cache(cache_config):
+    def make(**kwargs) -> MultiTierCacheAdapter:
+        return MultiTierCacheAdapter(cache_config(**kwargs))
+
+    return make
+
+
+@pytest.fixture
+def make_async_cache(cache_config):
+    def make(**kwargs) -> AsyncMultiTierCacheAdapter:
+        return AsyncMultiTierCacheAdapter(cache_config(**kwargs))
+
+    return make
+
+
+# What the entry points need to be imported, they read their settings on import
+APP_ENV = {
+    "APP_ENVIRONMENT": "DEVELOPMENT",
+    "LINE_CHANNEL_ACCESS_TOKEN": "token",
+    "LINE_CHANNEL_SECRET": "secret",
+    "OPENAI_API_KEY": "key",
+}
+
+
+def import_app_module(name):
+    with pytest.MonkeyPatch.context() as monkeypatch:
+        for key, value in APP_ENV.items():
+            monkeypatch.setenv(key, value)
+        return importlib.import_module(name)
+
+
+@pytest.fixture(scope="session")
+def index_module():
+    return import_app_module("api.index")
+
+
+@pytest.fixture(scope="session")
+def asgi_module():
+    return import_app_module("api.asgi")
+
+
+@pytest.fixture
+def asgi_request():
+    # Sends one HTTP request to an ASGI app and returns the status and body
+    async def request(app, method, path, headers=(), body=b""):
+        messages = []
+
+        async def receive():
+            return {"type": "http.request", "body": body, "more_body": False}
+
+        async def send(message):
+            messages.append(message)
+
+        scope = {"type": "http", "method": method, "path": path, "headers": headers}
+        await app(scope, receive, send)
+        return messages[0]["status"], messages[1]["body"].decode()
+
+    return request
+
+
+@pytest.fixture
+def read_counter():
+    # Counters are shared by all tests, so compare against a value read earlier
+    def read(name, **labels) -> float:
+        key = metrics.make_key(name, labels)
+        return metrics.snapshot()["counters"].get(key, 0)
+
+    return read
+
+
+class FakeMinioClient:
+    # Keeps objects and the lifecycle of buckets in memory
+    def __init__(self):
+        self.objects = {}
+        self.lifecycle = None
+        # Objects remove_objects reports as failed instead of deleting
+        self.undeletable = set()
+
+    def bucket_exists(self, bucket_name):
+        return True
+
+    def put_object(
+        self, bucket_name, object_name, data, length, content_type, metadata
+    ):
+        self.objects[object_name] = SimpleNamespace(
+            object_name=object_name,
+            is_dir=False,
+            content=data.read(length),
+            metadata={f"x-amz-meta-{key}": value for key, value in metadata.items()},
+            last_modified=datetime.datetime.now(datetime.timezone.utc),
+        )
+
+    def list_objects(self, bucket_name, prefix=None, recursive=False):
+        prefix = prefix or ""
+        folders = set()
+        for object_name in sorted(self.objects):
+            if not object_name.startswith(prefix):
+                continue
+            name = object_name[len(prefix) :]
+            if recursive or "/" not in name:
+                yield self.objects[object_name]
+            elif name.split("/")[0] not in folders:
+                folders.add(name.split("/")[0])
+                yield SimpleNamespace(
+                    object_name=f"{prefix}{name.split('/')[0]}/", is_dir=True
+                )
+
+    def remove_objects(self, bucket_name, delete_object_list):
+        for delete_object in delete_object_list:
+            if delete_object._name in self.undeletable:
+                yield SimpleNamespace(name=delete_object._name, code="AccessDenied")
+            else:
+                del self.objects[delete_object._name]
+
+    def stat_object(self, bucket_name, object_name):
+        if object_name not in self.objects:
+            raise S3Error("NoSuchKey", "", object_name, "", "", None)
+        return self.objects[object_name]
+
+    def get_bucket_lifecycle(self, bucket_name):
+        return self.lifecycle
+
+    def set_bucket_lifecycle(self, bucket_name, config):
+        self.lifecycle = config
+
+    def presigned_get_object(self, bucket_name, object_name):
+        return f"https://minio/{bucket_name}/{object_name}"
+
+
+@pytest.fixture
+def minio_env(monkeypatch):
+    for key, value in (
+        ("MINIO_ENDPOINT", "minio"),
+        ("MINIO_ACCESS_KEY", "key"),
+        ("MINIO_SECRET_KEY", "secret"),
+    ):
+        monkeypatch.setenv(key, value)
+    monkeypatch.delenv("MINIO_EXPIRATION_DAYS", raising=False)
+
+
+@pytest.fixture
+def make_minio_storage(minio_env):
+    def make(prefixes=("tts/",)) -> MinioStorage:
+        storage = MinioStorage(expiring_prefixes=prefixes)
+        storage.minio_client = FakeMinioClient()
+        return storage
+
+    return make
@@ -0,0 +1,208 @@
+import asyncio
+from types import SimpleNamespace
+import pytest
+
+TOKEN = "scrape-token"
+
+
+def make_event(chat_id, name):
+    return SimpleNamespace(source=SimpleNamespace(user_id=chat_id), name=name)
+
+
+class FakeHandler:
+    # Parses the body as the events themselves and records how they are handled
+    def __init__(self):
+        self.handled = []
+        self.running = 0
+        self.max_running = 0
+        self.gates = {}
+
+    def parse(self, body, signature):
+        return SimpleNamespace(events=self.events)
+
+    def dispatch(self, event, payload):
+        return self.handle(event)
+
+    async def handle(self, event):
+        self.running += 1
+        self.max_running = max(self.max_running, self.running)
+        try:
+            if event.name in self.gates:
+                await self.gates[event.name].wait()
+            else:
+                await asyncio.sleep(0.01)
+            self.handled.append(event.name)
+        finally:
+            self.running -= 1
+
+
+@pytest.fixture
+def fake_services(asgi_module, monkeypatch):
+    closed = []
+
+    async def close_line():
+        closed.append("line")
+
+    async def close_chatgpt():
+        closed.append("chatgpt")
+
+    handler = FakeHandler()
+    monkeypatch.setattr(
+        asgi_module, "line", SimpleNamespace(handler=handler, close=close_line)
+    )
+    monkeypatch.setattr(asgi_module, "chatgpt", SimpleNamespace(close=close_chatgpt))
+    monkeypatch.setattr(
+        asgi_module,
+        "storage_executor",
+        SimpleNamespace(shutdown=lambda: closed.append("storage")),
+    )
+    monkeypatch.setattr(asgi_module, "event_deduplicator", None)
+    return SimpleNamespace(handler=handler, closed=closed)
+
+
+def post_events(asgi_request, app, handler, events):
+    handler.events = events
+    return asgi_request(
+        app, "POST", "/webhook", [(b"x-line-signature", b"signature")], b"{}"
+    )
+
+
+def test_invalid_signature_is_rejected(asgi_module, asgi_request):
+    # The real handler checks the signature against LINE_CHANNEL_SECRET
+    status, body = asyncio.run(
+        asgi_request(
+            asgi_module.WebhookApp(4),
+            "POST",
+            "/webhook",
+            [(b"x-line-signature", b"invalid")],
+            b'{"destination": "bot", "events": []}',
+        )
+    )
+    assert (status, body) == (400, "Bad Request")
+
+
+def test_events_of_a_chat_are_handled_in_order(
+    asgi_module, asgi_request, fake_services
+):
+    handler = fake_services.handler
+
+    async def main():
+        app = asgi_module.WebhookApp(4)
+        handler.gates["a0"] = asyncio.Event()
+        events = [
+            make_event(chat, f"{chat}{index}") for index in range(3) for chat in "ab"
+        ]
+        status, _ = await post_events(asgi_request, app, handler, events)
+        # The request is answered before the events are handled
+        assert status == 200
+        assert set(app.chat_tasks) == {"a", "b"}
+        while len(handler.handled) < 3:
+            await asyncio.sleep(0.01)
+        # The other chat went on while the first event of this one is held
+        assert handler.handled == ["b0", "b1", "b2"]
+        handler.gates["a0"].set()
+        await asyncio.gather(*app.tasks)
+        return app
+
+    app = asyncio.run(main())
+    assert handler.handled[3:] == ["a0", "a1", "a2"]
+    assert app.chat_tasks == {}
+    assert app.tasks == set()
+
+
+def test_concurrency_is_limited(asgi_module, asgi_request, fake_services):
+    handler = fake_services.handler
+
+    async def main():
+        app = asgi_module.WebhookApp(2)
+        events = [make_event(f"chat{index}", str(index)) for index in range(6)]
+        await post_events(asgi_request, app, handler, events)
+        await asyncio.gather(*app.tasks)
+
+    asyncio.run(main())
+    assert len(handler.handled) == 6
+    assert handler.max_running == 2
+
+
+def test_failed_event_does_not_stop_its_chat(
+    asgi_module, asgi_request, fake_services, read_counter
+):
+    handler = fake_services.handler
+    failed = read_counter("webhook_events_failed_total")
+
+    def dispatch(event, payload):
+        if event.name == "bad":
+            raise RuntimeError("failed")
+        return handler.handle(event)
+
+    handler.dispatch = dispatch
+
+    async def main():
+        app = asgi_module.WebhookApp(4)
+        events = [make_event("a", "bad"), make_event("a", "good")]
+        await post_events(asgi_request, app, handler, events)
+        await asyncio.gather(*app.tasks)
+
+    asyncio.run(main())
+    assert handler.handled == ["good"]
+    assert read_counter("webhook_events_failed_total") == failed + 1
+
+
+def test_shutdown_waits_for_events_in_flight(asgi_module, asgi_request, fake_services):
+    handler = fake_services.handler
+
+    async def main():
+        app = asgi_module.WebhookApp(4)
+        lifespan = asyncio.Queue()
+        sent = []
+
+        async def send(message):
+            sent.append(message["type"])
+
+        serving = asyncio.create_task(app({"type": "lifespan"}, lifespan.get, send))
+        await lifespan.put({"type": "lifespan.startup"})
+        handler.gates["slow"] = asyncio.Event()
+        await post_events(asgi_request, app, handler, [make_event("a", "slow")])
+        await lifespan.put({"type": "lifespan.shutdown"})
+        await asyncio.sleep(0.05)
+        # The clients stay open while the event is handled
+        assert sent == ["lifespan.startup.complete"]
+        assert fake_services.closed == []
+        handler.gates["slow"].set()
+        await asyncio.wait_for(serving, 5)
+        return sent
+
+    assert asyncio.run(main()) == [
+        "lifespan.startup.complete",
+        "lifespan.shutdown.complete",
+    ]
+    assert handler.handled == ["slow"]
+    assert fake_services.closed == ["line", "chatgpt", "storage"]
+
+
+def test_unknown_path_is_not_found(asgi_module, asgi_request):
+    app = asgi_module.WebhookApp(4)
+    assert asyncio.run(asgi_request(app, "GET", "/")) == (200, "OK")
+    assert asyncio.run(asgi_request(app, "GET", "/missing")) == (404, "Not Found")
+
+
+@pytest.mark.parametrize(
+    "token, authorization, status",
+    [
+        (None, f"Bearer {TOKEN}", 404),
+        (TOKEN, None, 401),
+        (TOKEN, "Bearer wrong", 401),
+        (TOKEN, f"Bearer {TOKEN}", 200),
+    ],
+)
+def test_metrics_route(
+    asgi_module, asgi_request, monkeypatch, token, authorization, status
+):
+    monkeypatch.setattr(asgi_module, "app_metrics_token", token)
+    headers = [(b"authorization", authorization.encode())] if authorization else []
+    response_status, body = asyncio.run(
+        asgi_request(asgi_module.app, "GET", "/metrics", headers)
+    )
+    assert response_status == status
+    if status == 200:
+        assert "# TYPE" in body
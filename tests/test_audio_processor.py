@@ -0,0 +1,58 @@
+import datetime
+import io
+import time
+import pytest
+from api.storage.minio import SECONDS_PER_DAY, MinioStorage
+from api.utils.audio_processor import AudioProcessor
+
+
+def make_processor(make_minio_storage, make_cache) -> AudioProcessor:
+    return AudioProcessor(make_minio_storage(), None, "app", make_cache())
+
+
+def test_expiration_can_be_turned_off(minio_env, monkeypatch):
+    monkeypatch.setenv("MINIO_EXPIRATION_DAYS", "0")
+    storage = MinioStorage(expiring_prefixes=AudioProcessor.OBJECT_PREFIXES)
+    assert storage.expiring_prefixes == []
+
+
+def test_uploaded_audio_is_cached_until_it_expires(make_minio_storage, make_cache):
+    processor = make_processor(make_minio_storage, make_cache)
+    audio_key = processor.make_shared_audio_key("text", "tts-1", "alloy")
+    assert processor.get_shared_audio_duration(audio_key) is None
+    processor.upload_shared_audio(audio_key, io.BytesIO(b"mp3"), 1.5)
+    object_name = processor.get_shared_audio_object_name(audio_key)
+    assert object_name.startswith("tts/")
+    assert processor.minio_storage.client.lifecycle is not None
+    entry = processor.cache.get(processor.get_shared_audio_cache_key(audio_key))
+    assert entry["duration"] == 1.5
+    assert entry["expires_at"] == pytest.approx(
+        time.time() + 7 * SECONDS_PER_DAY, abs=60
+    )
+    assert processor.get_shared_audio_duration(audio_key) == 1.5
+
+
+def test_audio_about_to_expire_is_synthesized_again(make_minio_storage, make_cache):
+    processor = make_processor(make_minio_storage, make_cache)
+    audio_key = processor.make_shared_audio_key("text", "tts-1", "alloy")
+    processor.upload_shared_audio(audio_key, io.BytesIO(b"mp3"), 1.5)
+    # Uploaded almost a week ago, the lifecycle deletes it within the hour
+    stored = processor.minio_storage.client.objects[
+        processor.get_shared_audio_object_name(audio_key)
+    ]
+    stored.last_modified -= datetime.timedelta(days=7, minutes=-30)
+    processor.cache.delete(processor.get_shared_audio_cache_key(audio_key))
+    assert processor.get_shared_audio_duration(audio_key) is None
+    # Nor is a cached entry close to its expiry used
+    processor.cache_shared_audio(audio_key, 1.5, time.time() + 600)
+    assert processor.get_shared_audio_duration(audio_key) is None
+
+
+def test_duration_only_entries_ask_the_storage(make_minio_storage, make_cache):
+    processor = make_processor(make_minio_storage, make_cache)
+    audio_key = processor.make_shared_audio_key("text", "tts-1", "alloy")
+    processor.upload_shared_audio(audio_key, io.BytesIO(b"mp3"), 1.5)
+    cache_key = processor.get_shared_audio_cache_key(audio_key)
+    processor.cache.set(cache_key, 1.5)
+    assert processor.get_shared_audio_duration(audio_key) == 1.5
+    assert isinstance(processor.cache.get(cache_key), dict)
@@ -0,0 +1,214 @@
+import asyncio
+from api.storage.cache import (
+    NEGATIVE_ENTRY,
+    CacheConfig,
+    LRUWrapper,
+    SharedMemoryWrapper,
+    get_value_size,
+)
+from api.storage.codec import CacheCodec
+from api.utils.metrics import metrics
+
+
+def test_get_reads_remote_and_fills_local(make_cache):
+    writer, reader = make_cache(), make_cache()
+    writer.set("key", {"value": 1})
+    assert reader.local.get("key") is None
+    assert reader.get("key") == {"value": 1}
+    assert reader.local.get("key") == {"value": 1}
+
+
+def test_local_tier_answers_without_remote(make_cache):
+    cache = make_cache()
+    cache.set("key", "value")
+    cache.remote.delete("key")
+    assert cache.get("key") == "value"
+
+
+def test_get_many_mixes_tiers(make_cache):
+    writer, reader = make_cache(), make_cache()
+    writer.set_many({"a": 1, "b": 2})
+    reader.local.set("c", 3)
+    assert reader.get_many(["a", "b", "c", "missing"]) == {"a": 1, "b": 2, "c": 3}
+
+
+def test_delete_removes_both_tiers(make_cache):
+    cache, other = make_cache(), make_cache()
+    cache.set("key", "value")
+    cache.delete("key")
+    assert cache.get("key") is None
+    assert other.get("key") is None
+
+
+def test_miss_is_remembered_with_negative_ttl(make_cache, read_counter):
+    cache, writer = make_cache(negative_ttl=60), make_cache()
+    assert cache.get("key") is None
+    assert cache.local.get("key") is NEGATIVE_ENTRY
+    negative = read_counter("cache_lookups_total", namespace="test", result="negative")
+    writer.set("key", "value")
+    assert cache.get("key") is None
+    assert (
+        read_counter("cache_lookups_total", namespace="test", result="negative")
+        == negative + 1
+    )
+
+
+def test_disabled_remote_tier(make_cache):
+    cache = make_cache(remote_cache_enabled=False)
+    cache.set("key", "value")
+    assert make_cache(remote_cache_enabled=False).get("key") is None
+    assert cache.remote.get_many(["key"]) == {}
+    assert cache.acquire_lock("lock", "token", 10)
+
+
+def test_lock_is_exclusive_until_released(make_cache):
+    first, second = make_cache(), make_cache()
+    assert first.acquire_lock("lock", "first", 10)
+    assert not second.acquire_lock("lock", "second", 10)
+    # Only the holder's token releases the lock
+    second.release_lock("lock", "second")
+    assert not second.acquire_lock("lock", "second", 10)
+    first.release_lock("lock", "first")
+    assert second.acquire_lock("lock", "second", 10)
+
+
+def test_expired_lock_can_be_taken(make_cache):
+    first, second = make_cache(), make_cache()
+    assert first.acquire_lock("lock", "first", -1)
+    assert second.acquire_lock("lock", "second", 10)
+
+
+def test_async_adapter_shares_remote_tier(make_cache, make_async_cache):
+    cache = make_cache()
+
+    async def main():
+        async_cache = make_async_cache()
+        await async_cache.set_many({"a": 1, "b": 2})
+        assert await async_cache.get_many(["a", "b", "c"]) == {"a": 1, "b": 2}
+        await async_cache.delete("b")
+        return await async_cache.get("a")
+
+    assert asyncio.run(main()) == 1
+    assert cache.get_many(["a", "b"]) == {"a": 1}
+
+
+def test_shared_memory_keeps_the_last_written_rows(tmp_path):
+    wrapper = SharedMemoryWrapper(str(tmp_path / "cache.db"), CacheCodec(), 3)
+    for index in range(5):
+        wrapper.set(f"key{index}", index)
+    # Rewriting a row makes it the newest
+    wrapper.set("key2", 2)
+    assert wrapper.get_many([f"key{index}" for index in range(5)]) == {
+        "key2": 2,
+        "key3": 3,
+        "key4": 4,
+    }
+    (rows,) = wrapper.connect().execute("SELECT COUNT(*) FROM entries").fetchone()
+    assert rows == 3
+
+
+def test_shared_memory_purges_expired_rows(tmp_path, monkeypatch):
+    wrapper = SharedMemoryWrapper(str(tmp_path / "cache.db"), CacheCodec())
+    wrapper.set("expired", 1, seconds=-1)
+    wrapper.set("kept", 2, seconds=60)
+    wrapper.set("forever", 3)
+    monkeypatch.setattr(
+        wrapper, "purged_at", wrapper.purged_at - wrapper.PURGE_INTERVAL
+    )
+    wrapper.set("other", 4)
+    keys = [key for (key,) in wrapper.connect().execute("SELECT key FROM entries")]
+    assert sorted(keys) == ["forever", "kept", "other"]
+
+
+def test_jitter_can_be_disabled_in_code():
+    base = CacheConfig.from_env()
+    assert CacheConfig.merge(base, CacheConfig()).ttl_jitter == base.ttl_jitter
+    assert CacheConfig.merge(base, CacheConfig(ttl_jitter=0)).ttl_jitter == 0
+
+
+class FakeClock:
+    def __init__(self):
+        self.now = 0.0
+
+    def __call__(self):
+        return self.now
+
+
+def make_lru(max_bytes, **kwargs) -> LRUWrapper:
+    return LRUWrapper(100, max_bytes=max_bytes, namespace="lru_test", **kwargs)
+
+
+def test_byte_budget_evicts_least_recently_used():
+    value = "x" * 100
+    size = get_value_size(value)
+    cache = make_lru(size * 3)
+    for key in ("a", "b", "c"):
+        cache.set(key, value)
+    cache.get("a")
+    cache.set("d", value)
+    assert [cache.get(key) is not None for key in "abcd"] == [True, False, True, True]
+    assert cache.stats()["size"] == size * 3
+    assert cache.stats()["evictions"] == 1
+
+
+def test_byte_budget_counts_nested_values():
+    cache = make_lru(get_value_size({"text": "x" * 100}) * 2)
+    cache.set("small", {"text": "x" * 100})
+    # Bigger than what is left of the budget, so the older entry makes room
+    cache.set("large", {"text": "x" * 150})
+    assert cache.get("small") is None
+    assert cache.get("large") == {"text": "x" * 150}
+
+
+def test_oversized_value_is_not_kept(read_counter):
+    cache = make_lru(200)
+    cache.set("key", "small")
+    oversized = read_counter("cache_oversized_total", namespace="lru_test")
+    cache.set("key", "x" * 1000)
+    # The old value of the key is dropped too, it is no longer current
+    assert cache.get("key") is None
+    assert cache.stats()["evictions"] == 0
+    assert read_counter("cache_oversized_total", namespace="lru_test") == oversized + 1
+
+
+def test_expired_entries_leave_the_byte_budget():
+    clock = FakeClock()
+    value = "x" * 100
+    size = get_value_size(value)
+    cache = make_lru(size * 2, ttl=60, timer=clock)
+    cache.set("a", value)
+    cache.set("b", value)
+    clock.now = 61
+    assert cache.stats()["size"] == 0
+    cache.set("c", value)
+    cache.set("d", value)
+    # Expired entries were dropped, not evicted to make room
+    assert cache.get("c") == cache.get("d") == value
+    assert cache.stats()["evictions"] == 0
+
+
+def test_evictions_are_counted(read_counter):
+    cache = LRUWrapper(2, namespace="lru_count_test")
+    evictions = read_counter("cache_evictions_total", namespace="lru_count_test")
+    for key in "abcde":
+        cache.set(key, key)
+    assert cache.stats() == {
+        "namespace": "lru_count_test",
+        "entries": 2,
+        "size": 2,
+        "max_size": 2,
+        "evictions": 3,
+    }
+    assert (
+        read_counter("cache_evictions_total", namespace="lru_count_test")
+        == evictions + 3
+    )
+
+
+def test_stats_are_exported_as_gauges():
+    cache = LRUWrapper(10, namespace="lru_gauge_test")
+    cache.set("key", "value")
+    rendered = metrics.render()
+    assert 'cache_local_entries{namespace="lru_gauge_test"} 1' in rendered
+    assert 'cache_local_max_size{namespace="lru_gauge_test"} 10' in rendered
+    assert "cache_local_evictions" not in rendered
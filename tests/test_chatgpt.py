@@ -0,0 +1,67 @@
+import asyncio
+import logging
+import pytest
+from api.ai.chatgpt import AsyncChatGPT, ChatGPT, OpenAIConfig
+from benchmarks.fake_services import FakeOpenAI
+
+
+@pytest.fixture(autouse=True)
+def openai_env(monkeypatch):
+    monkeypatch.setenv("OPENAI_API_KEY", "key")
+    monkeypatch.delenv("OPENAI_WHISPER_MODEL", raising=False)
+    monkeypatch.delenv("OPENAI_FUSED_AUDIO_TRANSLATION_ENABLED", raising=False)
+
+
+def test_fused_audio_translation_requires_whisper_1():
+    with pytest.raises(ValueError, match="whisper-1"):
+        ChatGPT(
+            OpenAIConfig(
+                api_key="key",
+                whisper_model="gpt-4o-transcribe",
+                fused_audio_translation_enabled=True,
+            )
+        )
+
+
+def test_fused_audio_translation_warns_it_only_applies_to_english(caplog):
+    with caplog.at_level(logging.WARNING, logger="api.ai.chatgpt"):
+        ChatGPT()
+        assert caplog.records == []
+        ChatGPT(OpenAIConfig(api_key="key", fused_audio_translation_enabled=True))
+    assert "English" in caplog.text
+
+
+def test_retries_can_be_disabled_in_code(monkeypatch):
+    monkeypatch.setenv("OPENAI_MAX_RETRIES", "5")
+    assert ChatGPT().config.max_retries == 5
+    assert ChatGPT(OpenAIConfig(api_key="key", max_retries=0)).config.max_retries == 0
+
+
+@pytest.fixture(scope="module")
+def openai_service():
+    service = FakeOpenAI().start()
+    yield service
+    service.stop()
+
+
+def test_async_stream_keeps_the_scheduler_slot_until_it_ends(
+    openai_service, monkeypatch
+):
+    monkeypatch.setenv("OPENAI_BASE_URL", f"{openai_service.url}/v1")
+
+    async def main():
+        chatgpt = AsyncChatGPT(OpenAIConfig(api_key="key", max_concurrency=1))
+        stream = chatgpt.stream_translate("Hello there. How are you?", "ja")
+        deltas = [await stream.__anext__()]
+        # The only slot is taken until the stream is read to its end
+        with pytest.raises(asyncio.TimeoutError):
+            await asyncio.wait_for(chatgpt.translate("Hi", "ja"), 0.1)
+        deltas.extend([delta async for delta in stream])
+        translated_text = await asyncio.wait_for(chatgpt.translate("Hi", "ja"), 5)
+        await chatgpt.close()
+        return deltas, translated_text
+
+    deltas, translated_text = asyncio.run(main())
+    assert len(deltas) > 1
+    assert "".join(deltas) == "[translated] Hello there. How are you?"
+    assert translated_text == "[translated] Hi"
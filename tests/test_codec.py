@@ -0,0 +1,54 @@
+import base64
+import pytest
+from api.storage.codec import FORMAT_MARKER, CacheCodec
+
+VALUES = [
+    None,
+    0,
+    1.5,
+    "text",
+    "翻譯結果",
+    [1, "two", None],
+    {"version": 1, "settings": {"audio_language": "Traditional Chinese"}},
+    {"text": "long " * 1000},
+]
+
+
+@pytest.mark.parametrize("compression_threshold", [0, 1, 64])
+@pytest.mark.parametrize("value", VALUES)
+def test_round_trip(compression_threshold, value):
+    codec = CacheCodec(compression_threshold)
+    encoded = codec.encode(value)
+    assert isinstance(encoded, str)
+    assert codec.decode(encoded) == value
+
+
+def test_plain_json_is_untagged():
+    assert CacheCodec().encode({"a": "中"}) == '{"a":"中"}'
+
+
+def test_compression_only_when_smaller_once_base64_encoded():
+    codec = CacheCodec(compression_threshold=1)
+    assert codec.encode("x") == '"x"'
+    # Random text barely compresses, and grows by a third once base64 encoded
+    random_text = base64.b64encode(bytes(range(256)) * 2).decode()
+    assert codec.encode(random_text) == f'"{random_text}"'
+    encoded = codec.encode("repeated " * 100)
+    assert encoded.startswith(FORMAT_MARKER + "jz")
+    assert len(encoded) < len("repeated " * 100)
+
+
+def test_any_threshold_reads_values_of_others():
+    value = {"text": "hello " * 100}
+    encoded = CacheCodec(compression_threshold=16).encode(value)
+    assert CacheCodec().decode(encoded) == value
+
+
+def test_decode_legacy_values():
+    codec = CacheCodec()
+    assert codec.decode(None) is None
+    assert codec.decode('{"a": 1}') == {"a": 1}
+    # Values written as raw strings are returned as they are
+    assert codec.decode("not json") == "not json"
+    # Values of formats no longer written are a miss
+    assert codec.decode(FORMAT_MARKER + "m-gaFhAQ==") is None
@@ -0,0 +1,29 @@
+import pytest
+from flask import Config
+from api.config.key import ConfigKey
+from api.config.loader import ConfigLoader
+
+
+@pytest.mark.parametrize(
+    "persistent_settings, remote_cache, expected",
+    [
+        (None, None, False),
+        ("true", None, True),
+        ("true", "false", False),
+        ("false", "true", True),
+    ],
+)
+def test_remote_cache_flag_defaults_to_the_settings_flag(
+    monkeypatch, persistent_settings, remote_cache, expected
+):
+    for key, value in (
+        (ConfigKey.APP_PERSISTENT_USER_SETTINGS_ENABLED, persistent_settings),
+        (ConfigKey.APP_REMOTE_CACHE_ENABLED, remote_cache),
+    ):
+        if value is None:
+            monkeypatch.delenv(key.value, raising=False)
+        else:
+            monkeypatch.setenv(key.value, value)
+    config = Config(".")
+    ConfigLoader().load(config)
+    assert config[ConfigKey.APP_REMOTE_CACHE_ENABLED] is expected
@@ -0,0 +1,65 @@
+import asyncio
+from types import SimpleNamespace
+from api.utils.event_deduplicator import AsyncEventDeduplicator, EventDeduplicator
+
+TTL = 86400
+
+
+def make_event(event_id, redelivery=False):
+    return SimpleNamespace(
+        webhook_event_id=event_id,
+        delivery_context=SimpleNamespace(is_redelivery=redelivery),
+    )
+
+
+def make_workers(make_cache, count):
+    # Deduplicators of separate workers sharing only the remote tier
+    return [EventDeduplicator(make_cache(ttl=TTL), "app") for _ in range(count)]
+
+
+def test_duplicate_in_same_process_is_dropped(make_cache):
+    deduplicator = EventDeduplicator(make_cache(ttl=TTL), "app")
+    first, duplicate, other = make_event("1"), make_event("1"), make_event("2")
+    assert deduplicator.filter([first, duplicate, other]) == [first, other]
+    assert deduplicator.filter([make_event("1", redelivery=True)]) == []
+
+
+def test_events_without_id_are_kept(make_cache):
+    deduplicator = EventDeduplicator(make_cache(ttl=TTL), "app")
+    events = [SimpleNamespace(), make_event(None), make_event(None)]
+    assert deduplicator.filter(events) == events
+
+
+def test_redelivery_seen_by_another_worker_is_dropped(make_cache):
+    first, second = make_workers(make_cache, 2)
+    assert len(first.filter([make_event("1")])) == 1
+    assert second.filter([make_event("1", redelivery=True)]) == []
+
+
+def test_redelivery_is_claimed_by_one_worker(make_cache):
+    workers = make_workers(make_cache, 3)
+    accepted = [w.filter([make_event("1", redelivery=True)]) for w in workers]
+    assert [len(events) for events in accepted] == [1, 0, 0]
+
+
+def test_released_event_can_be_handled_again(make_cache):
+    first, second = make_workers(make_cache, 2)
+    event = make_event("1")
+    first.filter([event])
+    first.release(event)
+    redelivered = make_event("1", redelivery=True)
+    assert second.filter([redelivered]) == [redelivered]
+
+
+def test_async_deduplicator_shares_claims(make_cache, make_async_cache):
+    deduplicator = EventDeduplicator(make_cache(ttl=TTL), "app")
+
+    async def main():
+        async_deduplicator = AsyncEventDeduplicator(make_async_cache(ttl=TTL), "app")
+        first = await async_deduplicator.filter([make_event("1"), make_event("1")])
+        again = await async_deduplicator.filter([make_event("2", redelivery=True)])
+        return len(first), len(again)
+
+    assert asyncio.run(main()) == (1, 1)
+    assert deduplicator.filter([make_event("1", redelivery=True)]) == []
+    assert deduplicator.filter([make_event("2", redelivery=True)]) == []
@@ -0,0 +1,186 @@
+import threading
+import time
+from types import SimpleNamespace
+from api.utils.event_dispatcher import (
+    DispatchMode,
+    DispatcherConfig,
+    EventDispatcher,
+)
+
+
+def make_event(chat_id, name):
+    return SimpleNamespace(source=SimpleNamespace(user_id=chat_id), name=name)
+
+
+class FakeHandler:
+    # Records the events it handles, holding those with a gate until it is set
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.handled = []
+        self.threads = {}
+        self.gates = {}
+        self.started = {}
+        self.barrier = None
+
+    def hold(self, name) -> threading.Event:
+        self.started[name] = threading.Event()
+        gate = self.gates[name] = threading.Event()
+        return gate
+
+    def parse(self, body, signature):
+        return SimpleNamespace(events=body)
+
+    def dispatch(self, event, payload):
+        if event.name in self.started:
+            self.started[event.name].set()
+        if event.name in self.gates:
+            assert self.gates[event.name].wait(5)
+        if self.barrier is not None:
+            self.barrier.wait(5)
+        with self.lock:
+            self.handled.append(event.name)
+            self.threads[event.name] = threading.current_thread()
+
+    def wait_started(self, name):
+        assert self.started[name].wait(5)
+
+
+def make_dispatcher(handler, **kwargs) -> EventDispatcher:
+    return EventDispatcher(
+        handler,
+        DispatcherConfig(
+            mode=kwargs.pop("mode", DispatchMode.THREAD),
+            enqueue_timeout=0.01,
+            **kwargs,
+        ),
+    )
+
+
+def test_events_of_a_chat_are_handled_in_order():
+    handler = FakeHandler()
+    dispatcher = make_dispatcher(handler, workers=2)
+    events = [make_event(chat, f"{chat}{index}") for index in range(5) for chat in "ab"]
+    for event in events:
+        dispatcher.submit(event, None)
+    dispatcher.shutdown()
+    for chat in "ab":
+        assert [name for name in handler.handled if name[0] == chat] == [
+            f"{chat}{index}" for index in range(5)
+        ]
+
+
+def fill_queue(dispatcher, handler) -> threading.Event:
+    # The only worker is held by one chat and another chat fills the queue
+    gate = handler.hold("busy")
+    dispatcher.submit(make_event("x", "busy"), None)
+    handler.wait_started("busy")
+    dispatcher.submit(make_event("y", "queued"), None)
+    return gate
+
+
+def test_full_queue_is_bypassed_by_a_chat_without_pending_events(read_counter):
+    handler = FakeHandler()
+    dispatcher = make_dispatcher(handler, workers=1, queue_size=1)
+    gate = fill_queue(dispatcher, handler)
+    inline = read_counter("webhook_events_inline_total")
+    dispatcher.submit(make_event("z", "inline"), None)
+    assert handler.handled == ["inline"]
+    assert handler.threads["inline"] is threading.current_thread()
+    assert read_counter("webhook_events_inline_total") == inline + 1
+    gate.set()
+    dispatcher.shutdown()
+    assert handler.handled == ["inline", "busy", "queued"]
+
+
+def test_queued_event_waits_for_the_inline_event_of_its_chat():
+    handler = FakeHandler()
+    dispatcher = make_dispatcher(handler, workers=1, queue_size=1)
+    busy = fill_queue(dispatcher, handler)
+    first = handler.hold("first")
+    request = threading.Thread(
+        target=dispatcher.submit, args=(make_event("c", "first"), None)
+    )
+    request.start()
+    handler.wait_started("first")
+    # The queue has room again while the first event is still handled inline
+    busy.set()
+    while handler.handled != ["busy", "queued"]:
+        time.sleep(0.01)
+    dispatcher.submit(make_event("c", "second"), None)
+    time.sleep(0.05)
+    assert "second" not in handler.handled
+    first.set()
+    request.join()
+    dispatcher.shutdown()
+    assert handler.handled == ["busy", "queued", "first", "second"]
+
+
+def test_event_behind_pending_events_of_its_chat_is_not_inlined(read_counter):
+    handler = FakeHandler()
+    dispatcher = make_dispatcher(handler, workers=1, queue_size=1, blocked_timeout=5)
+    gate = handler.hold("busy")
+    dispatcher.submit(make_event("c", "busy"), None)
+    handler.wait_started("busy")
+    dispatcher.submit(make_event("c", "queued"), None)
+    blocked = read_counter("webhook_events_blocked_total")
+    threading.Timer(0.05, gate.set).start()
+    dispatcher.submit(make_event("c", "blocked"), None)
+    assert read_counter("webhook_events_blocked_total") == blocked + 1
+    dispatcher.shutdown()
+    assert handler.handled == ["busy", "queued", "blocked"]
+    assert handler.threads["blocked"] is not threading.current_thread()
+
+
+def test_blocked_event_is_dropped_after_its_deadline(read_counter):
+    handler = FakeHandler()
+    dispatcher = make_dispatcher(handler, workers=1, queue_size=1, blocked_timeout=0.05)
+    gate = handler.hold("busy")
+    dispatcher.submit(make_event("c", "busy"), None)
+    handler.wait_started("busy")
+    dispatcher.submit(make_event("c", "queued"), None)
+    dropped = read_counter("webhook_events_dropped_total")
+    dispatcher.submit(make_event("c", "dropped"), None)
+    assert read_counter("webhook_events_dropped_total") == dropped + 1
+    gate.set()
+    dispatcher.shutdown()
+    assert handler.handled == ["busy", "queued"]
+    assert dispatcher.chats == {}
+
+
+def test_sync_mode_handles_chats_concurrently():
+    handler = FakeHandler()
+    dispatcher = make_dispatcher(handler, mode=DispatchMode.SYNC, workers=2)
+    # Passes only once the three chats are handled at the same time
+    handler.barrier = threading.Barrier(3)
+    dispatcher.dispatch([make_event(chat, chat) for chat in "abc"], "signature")
+    assert sorted(handler.handled) == ["a", "b", "c"]
+    assert handler.threads["a"] is threading.current_thread()
+    dispatcher.shutdown()
+
+
+def test_sync_mode_keeps_the_order_of_a_chat():
+    handler = FakeHandler()
+    dispatcher = make_dispatcher(handler, mode=DispatchMode.SYNC, workers=2)
+    events = [make_event(chat, f"{chat}{index}") for index in range(3) for chat in "ab"]
+    dispatcher.dispatch(events, "signature")
+    for chat in "ab":
+        assert [name for name in handler.handled if name[0] == chat] == [
+            f"{chat}{index}" for index in range(3)
+        ]
+    dispatcher.shutdown()
+
+
+def test_shutdown_drains_the_queues_before_stopping_the_workers():
+    handler = FakeHandler()
+    dispatcher = make_dispatcher(handler, workers=2, queue_size=20)
+    gate = handler.hold("a0")
+    events = [make_event(chat, f"{chat}{index}") for index in range(5) for chat in "ab"]
+    for event in events:
+        dispatcher.submit(event, None)
+    threading.Timer(0.05, gate.set).start()
+    dispatcher.shutdown()
+    assert sorted(handler.handled) == sorted(event.name for event in events)
+    assert not any(worker.is_alive() for worker in dispatcher.workers)
+    # Later events are handled in the request thread
+    dispatcher.dispatch([make_event("a", "late")], "signature")
+    assert handler.threads["late"] is threading.current_thread()
@@ -0,0 +1,194 @@
+import asyncio
+import socket
+import pytest
+from linebot.v3.messaging import ApiException, TextMessage
+from api.bot.line import AsyncLine, Line, LineConfig
+from benchmarks.fake_services import FakeLine, RouteStats
+
+aiohttp = pytest.importorskip("aiohttp")
+
+
+@pytest.fixture(scope="module")
+def line_service():
+    service = FakeLine().start()
+    yield service
+    service.stop()
+
+
+@pytest.fixture
+def fake_line(line_service):
+    line_service.replies.clear()
+    line_service.pushes.clear()
+    line_service.push_retry_keys.clear()
+    line_service.failures.clear()
+    line_service.stats = RouteStats()
+    return line_service
+
+
+@pytest.fixture(autouse=True)
+def line_env(monkeypatch):
+    monkeypatch.setenv("LINE_CHANNEL_ACCESS_TOKEN", "token")
+    monkeypatch.setenv("LINE_CHANNEL_SECRET", "secret")
+    for key in ("LINE_CONNECTION_POOL_SIZE", "LINE_RETRIES", "LINE_API_HOST"):
+        monkeypatch.delenv(key, raising=False)
+
+
+def make_config(fake_line, **kwargs) -> LineConfig:
+    return LineConfig(
+        access_token="token",
+        channel_secret="secret",
+        retry_backoff=0.01,
+        api_host=fake_line.url,
+        data_api_host=fake_line.url,
+        **kwargs,
+    )
+
+
+def count_requests(fake_line, route) -> int:
+    return fake_line.stats.snapshot().get(f"line {route}", (0, 0.0))[0]
+
+
+def test_config_from_env_and_merge(monkeypatch):
+    monkeypatch.setenv("LINE_CHANNEL_ACCESS_TOKEN", "env-token")
+    monkeypatch.setenv("LINE_CHANNEL_SECRET", "env-secret")
+    monkeypatch.setenv("LINE_CONNECTION_POOL_SIZE", "20")
+    base = LineConfig.from_env()
+    assert (base.access_token, base.connection_pool_size, base.retries) == (
+        "env-token",
+        20,
+        3,
+    )
+    assert base.get_hosts() == {}
+    merged = LineConfig.merge(
+        base, LineConfig(access_token="", channel_secret="", api_host="http://fake")
+    )
+    assert (merged.access_token, merged.channel_secret) == ("env-token", "env-secret")
+    assert merged.connection_pool_size == 20
+    assert merged.get_hosts() == {"https://api.line.me": "http://fake"}
+
+
+def test_client_pools_connections_and_retries(fake_line):
+    line = Line(make_config(fake_line, connection_pool_size=7, retries=2))
+    line.open()
+    pool_options = line.api_client.rest_client.pool_manager.connection_pool_kw
+    assert pool_options["maxsize"] == 7
+    assert pool_options["retries"].total == 2
+    assert pool_options["retries"].backoff_factor == 0.01
+    assert (socket.SOL_SOCKET, socket.SO_KEEPALIVE, 1) in pool_options["socket_options"]
+    # The client is reused by every request
+    api_client = line.api_client
+    line.show_loading_animation("user")
+    assert line.api_client is api_client
+    line.close()
+
+
+def test_idempotent_request_is_retried_on_error_status(fake_line):
+    line = Line(make_config(fake_line))
+    fake_line.failures["content"] = [503]
+    assert line.get_audio_by_message("message") == fake_line.audio
+    assert count_requests(fake_line, "content") == 2
+
+
+def test_reply_is_not_retried_on_error_status(fake_line):
+    line = Line(make_config(fake_line))
+    fake_line.failures["reply"] = [503]
+    with pytest.raises(ApiException):
+        line.reply_message("reply-token", TextMessage(text="hello"))
+    assert count_requests(fake_line, "reply") == 1
+    assert fake_line.replies == []
+
+
+def make_async_line(fake_line, **kwargs) -> AsyncLine:
+    return AsyncLine(make_config(fake_line, **kwargs))
+
+
+def test_async_push_accepts_409_for_its_retry_key(fake_line):
+    line = make_async_line(fake_line)
+
+    async def main():
+        try:
+            # 409: LINE already accepted a push with this retry key
+            fake_line.failures["push"] = [409]
+            await line.push_message("user", TextMessage(text="hello"))
+            await line.push_message("user", TextMessage(text="again"))
+        finally:
+            await line.close()
+
+    asyncio.run(main())
+    assert [push["messages"][0]["text"] for push in fake_line.pushes] == ["again"]
+    first_key, second_key = fake_line.push_retry_keys
+    assert first_key and second_key and first_key != second_key
+
+
+def test_async_push_raises_other_errors(fake_line):
+    line = make_async_line(fake_line)
+
+    async def main():
+        try:
+            fake_line.failures["push"] = [400]
+            await line.push_message("user", TextMessage(text="hello"))
+        finally:
+            await line.close()
+
+    with pytest.raises(ApiException):
+        asyncio.run(main())
+
+
+def test_async_reply_reaches_line(fake_line):
+    line = make_async_line(fake_line)
+
+    async def main():
+        try:
+            await line.reply_messages(
+                "reply-token", [TextMessage(text="a"), TextMessage(text="b")]
+            )
+        finally:
+            await line.close()
+
+    asyncio.run(main())
+    (reply,) = fake_line.replies
+    assert reply["replyToken"] == "reply-token"
+    assert [message["text"] for message in reply["messages"]] == ["a", "b"]
+
+
+def test_with_retries_retries_connection_errors(fake_line):
+    line = make_async_line(fake_line, retries=2)
+    calls = []
+
+    async def request():
+        calls.append(1)
+        if len(calls) < 3:
+            raise aiohttp.ClientConnectionError()
+        return "done"
+
+    async def failing_request():
+        calls.append(1)
+        raise aiohttp.ClientConnectionError()
+
+    assert asyncio.run(line.with_retries(request)) == "done"
+    assert len(calls) == 3
+    calls.clear()
+    with pytest.raises(aiohttp.ClientConnectionError):
+        asyncio.run(line.with_retries(failing_request))
+    assert len(calls) == 3
+
+
+def test_with_retries_leaves_other_errors_alone(fake_line):
+    line = make_async_line(fake_line)
+    calls = []
+
+    async def disconnected():
+        calls.append(1)
+        raise aiohttp.ServerDisconnectedError()
+
+    # A reply only retries errors raised before the connection was made
+    with pytest.raises(aiohttp.ServerDisconnectedError):
+        asyncio.run(line.with_retries(disconnected, aiohttp.ClientConnectorError))
+    assert len(calls) == 1
+
+
+def test_retries_can_be_disabled_in_code(monkeypatch):
+    monkeypatch.setenv("LINE_RETRIES", "5")
+    base = LineConfig.from_env()
+    assert LineConfig.merge(base, LineConfig("token", "secret")).retries == 5
+    assert LineConfig.merge(base, LineConfig("token", "secret", retries=0)).retries == 0
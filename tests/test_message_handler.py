@@ -0,0 +1,234 @@
+import asyncio
+from concurrent.futures import Future
+from types import SimpleNamespace
+import pytest
+from api.bot.line import Line
+from api.bot.message_handler import (
+    DEFAULT_USER_SETTINGS,
+    USER_AUDIO_LANGUAGE_KEY,
+    USER_TRANSLATE_LANGUAGE_KEY,
+    AsyncTranslationReplier,
+    StreamedTranslation,
+    TranslationReplier,
+    batch_messages,
+    create_command_reply,
+    get_settings_changes,
+)
+from api.config.key import ConfigKey
+from api.utils.text_segmenter import TextSegmenter
+
+
+@pytest.mark.parametrize(
+    "user_input, expected",
+    [
+        ("設定語音辨識後翻譯為 日文", {USER_AUDIO_LANGUAGE_KEY: "Japanese"}),
+        ("設定打字後翻譯為 英文", {USER_TRANSLATE_LANGUAGE_KEY: "English"}),
+        ("設定", None),
+        ("目前設定", None),
+        ("hello", None),
+    ],
+)
+def test_get_settings_changes(user_input, expected):
+    assert get_settings_changes(user_input) == expected
+
+
+def test_setting_command_offers_languages():
+    reply = create_command_reply("/setting", DEFAULT_USER_SETTINGS)
+    actions = [item.action.text for item in reply.quick_reply.items]
+    assert "設定語音辨識後翻譯為 英文" in actions
+    reply = create_command_reply("設定語音辨識後翻譯為 英文", DEFAULT_USER_SETTINGS)
+    actions = [item.action.text for item in reply.quick_reply.items]
+    assert "設定打字後翻譯為 英文" in actions
+
+
+def test_settings_replies_show_given_settings():
+    settings = {**DEFAULT_USER_SETTINGS, USER_TRANSLATE_LANGUAGE_KEY: "Japanese"}
+    current = create_command_reply("目前設定", settings).text
+    assert (
+        current
+        == "我方語言：繁體中文（Traditional Chinese）\n對方語言：日文（Japanese）"
+    )
+    done = create_command_reply("設定打字後翻譯為 日文", settings).text
+    assert done == f"設定完畢！\n{current}"
+
+
+def test_text_to_translate_has_no_command_reply():
+    assert create_command_reply("hello", DEFAULT_USER_SETTINGS) is None
+
+
+def test_batch_messages():
+    size = Line.MAX_MESSAGES_PER_REQUEST
+    messages = list(range(size * 2 + 1))
+    assert batch_messages(messages) == [
+        messages[:size],
+        messages[size : size * 2],
+        messages[size * 2 :],
+    ]
+    assert batch_messages([]) == []
+
+
+def stream(deltas):
+    translation = StreamedTranslation(TextSegmenter())
+    replies = [translation.add(delta) for delta in deltas]
+    return [reply for reply in replies if reply is not None], translation.finish()
+
+
+def test_first_sentences_are_handed_out_once_more_arrives():
+    replies, rest = stream(["Hello there. ", "How ", "are you? ", "Fine."])
+    assert replies == ["Hello there. "]
+    assert rest == (None, "How are you? Fine.")
+
+
+def test_translation_in_one_piece_is_replied_whole():
+    replies, rest = stream(["Hello there. How are you?"])
+    assert replies == []
+    assert rest == ("Hello there. How are you?", "")
+
+
+def test_number_split_across_deltas_is_not_a_sentence_end():
+    replies, rest = stream(["It costs 3.", "50 dollars. ", "Thanks."])
+    assert replies == ["It costs 3.50 dollars. "]
+    assert rest == (None, "Thanks.")
+
+
+class FakeLine:
+    # Records what is sent, in order, as (kind, recipient, texts or audio URL)
+    def __init__(self, sent):
+        self.sent = sent
+
+    def reply_messages(self, reply_token, messages):
+        self.sent.append(("reply", reply_token, [m.text for m in messages]))
+
+    def push_messages(self, user_id, messages):
+        self.sent.append(("push", user_id, [m.text for m in messages]))
+
+    def push_message(self, user_id, message):
+        self.sent.append(("push", user_id, message.original_content_url))
+
+
+class FakeAsyncLine(FakeLine):
+    async def reply_messages(self, reply_token, messages):
+        super().reply_messages(reply_token, messages)
+
+    async def push_messages(self, user_id, messages):
+        super().push_messages(user_id, messages)
+
+    async def push_message(self, user_id, message):
+        super().push_message(user_id, message)
+
+
+class FakeTranslator:
+    # Stands in for the segmented translator and the client streaming under it
+    def __init__(self, sent, deltas):
+        self.sent = sent
+        self.text_segmenter = TextSegmenter()
+        self.chatgpt = SimpleNamespace(stream_translate=self.stream_translate)
+        self.deltas = deltas
+
+    def translate(self, text, language):
+        self.sent.append(("translate", language, text))
+        return "".join(self.deltas)
+
+    def stream_translate(self, text, language):
+        self.sent.append(("stream", language, text))
+        yield from self.deltas
+
+
+class FakeAsyncTranslator(FakeTranslator):
+    async def translate(self, text, language):
+        return super().translate(text, language)
+
+    async def stream_translate(self, text, language):
+        for delta in super().stream_translate(text, language):
+            yield delta
+
+
+STREAMING_CONFIG = {
+    ConfigKey.APP_STREAMING_REPLY_ENABLED: True,
+    ConfigKey.APP_STREAMING_REPLY_MIN_LENGTH: 10,
+}
+
+
+def make_replier(config, deltas, replier_class=TranslationReplier):
+    sent = []
+    if replier_class is TranslationReplier:
+        line, translator = FakeLine(sent), FakeTranslator(sent, deltas)
+    else:
+        line, translator = FakeAsyncLine(sent), FakeAsyncTranslator(sent, deltas)
+    return replier_class(config, line, translator), sent
+
+
+def test_long_translation_is_split_across_reply_and_pushes():
+    paragraph = "x" * (Line.MAX_TEXT_LENGTH - 10) + "\n\n"
+    size = Line.MAX_MESSAGES_PER_REQUEST
+    replier, sent = make_replier({}, [paragraph * (size + 1)])
+    replier.reply_translation("token", "user", "long text", "ja")
+    assert [(kind, recipient) for kind, recipient, _ in sent] == [
+        ("translate", "ja"),
+        ("reply", "token"),
+        ("push", "user"),
+    ]
+    assert len(sent[1][2]) == size
+    assert len(sent[2][2]) == 1
+
+
+def test_streamed_translation_replies_first_sentences_early():
+    replier, sent = make_replier(
+        STREAMING_CONFIG, ["Hello there. ", "How are ", "you?"]
+    )
+    replier.reply_translation("token", "user", "long enough text", "ja")
+    assert sent == [
+        ("stream", "ja", "long enough text"),
+        ("reply", "token", ["Hello there."]),
+        ("push", "user", ["How are you?"]),
+    ]
+    # Short texts are not streamed
+    replier, sent = make_replier(STREAMING_CONFIG, ["Hi."])
+    replier.reply_translation("token", "user", "short", "ja")
+    assert sent[0] == ("translate", "ja", "short")
+
+
+def test_audio_is_prepared_before_the_reply_and_pushed_after():
+    replier, sent = make_replier({}, ["Hello."])
+
+    def prepare_audio(translated_text):
+        sent.append(("prepare", None, translated_text))
+        future = Future()
+        future.set_result(("https://audio", 1.5))
+        return future
+
+    replier.reply_translation("token", "user", "text", "ja", prepare_audio)
+    assert sent[1:] == [
+        ("prepare", None, "Hello."),
+        ("reply", "token", ["Hello."]),
+        ("push", "user", "https://audio"),
+    ]
+
+
+def test_async_replier_matches_the_sync_one():
+    async def prepare_audio(translated_text):
+        return "https://audio", 1.5
+
+    async def main():
+        replier, streamed = make_replier(
+            STREAMING_CONFIG, ["Hello there. ", "Fine."], AsyncTranslationReplier
+        )
+        await replier.reply_translation(
+            "token", "user", "long enough text", "ja", prepare_audio
+        )
+        replier, plain = make_replier({}, ["Hello."], AsyncTranslationReplier)
+        await replier.reply_translation("token", "user", "text", "ja", prepare_audio)
+        return streamed, plain
+
+    streamed, plain = asyncio.run(main())
+    assert streamed == [
+        ("stream", "ja", "long enough text"),
+        ("reply", "token", ["Hello there."]),
+        ("push", "user", ["Fine."]),
+        ("push", "user", "https://audio"),
+    ]
+    assert plain == [
+        ("translate", "ja", "text"),
+        ("reply", "token", ["Hello."]),
+        ("push", "user", "https://audio"),
+    ]
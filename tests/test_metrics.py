@@ -0,0 +1,102 @@
+import pytest
+from api.utils.metrics import Metrics
+
+TOKEN = "metrics-token"
+
+
+def test_render_groups_metrics_under_one_type_line():
+    registry = Metrics()
+    registry.increment("requests_total", route="/a")
+    registry.increment("requests_total", 2, route="/b")
+    registry.set_gauge("queue_depth", 3)
+    assert registry.render() == (
+        "# TYPE requests_total counter\n"
+        'requests_total{route="/a"} 1\n'
+        'requests_total{route="/b"} 2\n'
+        "# TYPE queue_depth gauge\n"
+        "queue_depth 3\n"
+    )
+
+
+def test_render_histogram_buckets_are_cumulative():
+    registry = Metrics()
+    for value in (0.004, 0.02, 20):
+        registry.observe("call_seconds", value, service="line")
+    lines = registry.render().splitlines()
+    assert lines[0] == "# TYPE call_seconds histogram"
+    assert 'call_seconds_bucket{service="line",le="0.005"} 1' in lines
+    assert 'call_seconds_bucket{service="line",le="0.025"} 2' in lines
+    assert 'call_seconds_bucket{service="line",le="10.0"} 2' in lines
+    assert 'call_seconds_bucket{service="line",le="+Inf"} 3' in lines
+    assert 'call_seconds_sum{service="line"} 20.024' in lines
+    assert 'call_seconds_count{service="line"} 3' in lines
+
+
+def test_render_escapes_label_values():
+    registry = Metrics()
+    registry.increment("errors_total", reason='a "b"\\c\nd')
+    assert 'errors_total{reason="a \\"b\\"\\\\c\\nd"} 1' in registry.render()
+
+
+def test_external_call_counts_errors():
+    registry = Metrics()
+
+    @registry.external_call("openai", "translate")
+    def fail():
+        raise ValueError()
+
+    with pytest.raises(ValueError):
+        fail()
+    snapshot = registry.snapshot()
+    labels = (("operation", "translate"), ("service", "openai"))
+    assert snapshot["counters"] == {("external_call_errors_total", labels): 1}
+    assert snapshot["histograms"][("external_call_seconds", labels)]["count"] == 1
+
+
+def test_collectors_are_called_until_their_object_is_gone():
+    registry = Metrics()
+
+    class Source:
+        def export(self, registry):
+            registry.set_gauge("source_value", 1)
+
+    source = Source()
+    registry.add_collector(source.export)
+    assert "source_value 1" in registry.render()
+    del source
+    registry.collect()
+    assert registry.collectors == []
+
+
+@pytest.mark.parametrize(
+    "authorization, token, allowed",
+    [
+        (f"Bearer {TOKEN}", TOKEN, True),
+        (f"Bearer {TOKEN}x", TOKEN, False),
+        (TOKEN, TOKEN, False),
+        (None, TOKEN, False),
+        ("Bearer ", "", False),
+        ("Bearer None", None, False),
+    ],
+)
+def test_is_scrape_allowed(authorization, token, allowed):
+    assert Metrics.is_scrape_allowed(authorization, token) is allowed
+
+
+@pytest.mark.parametrize(
+    "token, authorization, status",
+    [
+        (None, f"Bearer {TOKEN}", 404),
+        (TOKEN, None, 401),
+        (TOKEN, "Bearer wrong", 401),
+        (TOKEN, f"Bearer {TOKEN}", 200),
+    ],
+)
+def test_flask_metrics_route(index_module, monkeypatch, token, authorization, status):
+    monkeypatch.setattr(index_module, "app_metrics_token", token)
+    headers = {"Authorization": authorization} if authorization else {}
+    response = index_module.app.test_client().get("/metrics", headers=headers)
+    assert response.status_code == status
+    if status == 200:
+        assert response.mimetype == "text/plain"
+        assert "# TYPE" in response.get_data(as_text=True)
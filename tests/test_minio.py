@@ -0,0 +1,162 @@
+import io
+import logging
+import threading
+import time
+import pytest
+from minio.commonconfig import ENABLED, Filter
+from minio.lifecycleconfig import Expiration, LifecycleConfig, Rule
+from api.storage.minio import (
+    LEGACY_EXPIRATION_RULE_ID,
+    MinioConfig,
+    MinioStorage,
+)
+from api.utils.legacy_audio_cleanup import clean_legacy_folders
+
+USER_FOLDER = "a" * 64 + "/"
+
+
+def put(storage, *object_names):
+    for object_name in object_names:
+        storage.client.put_object("app", object_name, io.BytesIO(b""), 0, "", {})
+
+
+def make_rule(rule_id, prefix, days):
+    return Rule(
+        ENABLED,
+        rule_filter=Filter(prefix=prefix),
+        rule_id=rule_id,
+        expiration=Expiration(days=days),
+    )
+
+
+def test_expiration_keeps_the_rules_of_other_prefixes(make_minio_storage):
+    storage = make_minio_storage()
+    storage.client.lifecycle = LifecycleConfig(
+        [
+            make_rule("operator", "backups/", 30),
+            make_rule(LEGACY_EXPIRATION_RULE_ID, "", 1),
+            make_rule("expire-tts", "tts/", 1),
+        ]
+    )
+    storage.set_files_expiration("app", ["tts/"], 7)
+    rules = {
+        rule.rule_id: (rule.rule_filter.prefix, rule.expiration.days)
+        for rule in storage.client.lifecycle.rules
+    }
+    assert rules == {"operator": ("backups/", 30), "expire-tts": ("tts/", 7)}
+
+
+def test_bucket_gets_the_expiration_once(make_minio_storage):
+    storage = make_minio_storage()
+    storage.ensure_bucket("app")
+    (rule,) = storage.client.lifecycle.rules
+    assert (rule.rule_id, rule.rule_filter.prefix) == ("expire-tts", "tts/")
+    storage.client.lifecycle = None
+    storage.ensure_bucket("app")
+    assert storage.client.lifecycle is None
+
+
+def test_existing_expiration_is_not_rewritten(make_minio_storage):
+    storage = make_minio_storage()
+    storage.client.lifecycle = LifecycleConfig([make_rule("expire-tts", "tts/", 7)])
+    written = storage.client.lifecycle
+    storage.ensure_bucket("app")
+    assert storage.client.lifecycle is written
+
+
+class SlowMinioClient:
+    # Counts the bucket setup calls and holds each of them for a while
+    def __init__(self, client):
+        self.client = client
+        self.calls = []
+
+    def __getattr__(self, name):
+        method = getattr(self.client, name)
+
+        def call(*args, **kwargs):
+            self.calls.append(name)
+            time.sleep(0.01)
+            return method(*args, **kwargs)
+
+        return call
+
+
+def test_concurrent_uploads_set_the_bucket_up_once(make_minio_storage):
+    storage = make_minio_storage()
+    client = storage.minio_client = SlowMinioClient(storage.minio_client)
+    threads = [
+        threading.Thread(
+            target=storage.upload_stream,
+            args=("app", f"tts/{index}.mp3", io.BytesIO(b"audio"), 5),
+            kwargs={"metadata": {}},
+        )
+        for index in range(5)
+    ]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    setup_calls = [call for call in client.calls if call != "put_object"]
+    assert setup_calls == [
+        "bucket_exists",
+        "get_bucket_lifecycle",
+        "set_bucket_lifecycle",
+    ]
+    assert len(client.client.objects) == 5
+
+
+def test_failed_expiration_does_not_fail_uploads(make_minio_storage, caplog):
+    storage = make_minio_storage()
+
+    def deny(bucket_name, config):
+        raise RuntimeError("AccessDenied")
+
+    storage.client.set_bucket_lifecycle = deny
+    with caplog.at_level(logging.WARNING, logger="api.storage.minio"):
+        storage.upload_stream("app", "tts/a.mp3", io.BytesIO(b"audio"), 5, metadata={})
+        storage.upload_stream("app", "tts/b.mp3", io.BytesIO(b"audio"), 5, metadata={})
+    assert sorted(storage.client.objects) == ["tts/a.mp3", "tts/b.mp3"]
+    # Logged once, the bucket is not set up again on every upload
+    assert len(caplog.records) == 1
+    assert "AccessDenied" in caplog.text
+
+
+def test_expiration_can_be_left_to_the_operator(make_minio_storage, caplog):
+    client = make_minio_storage().minio_client
+    with caplog.at_level(logging.WARNING, logger="api.storage.minio"):
+        storage = MinioStorage(
+            MinioConfig(endpoint="", access_key="", secret_key="", expiration_days=0),
+            expiring_prefixes=("tts/",),
+        )
+    assert "MINIO_EXPIRATION_DAYS" in caplog.text
+    storage.minio_client = client
+    storage.upload_stream("app", "tts/a.mp3", io.BytesIO(b"audio"), 5, metadata={})
+    assert client.lifecycle is None
+    assert storage.get_file_info("app", "tts/a.mp3").expires_at is None
+
+
+def test_clean_files_deletes_everything_before_failing(make_minio_storage):
+    storage = make_minio_storage()
+    put(storage, "old/1.mp3", "old/2.mp3", "old/3.mp3", "tts/kept.mp3")
+    storage.client.undeletable = {"old/1.mp3", "old/2.mp3"}
+    with pytest.raises(RuntimeError, match="2 個檔案刪除失敗"):
+        storage.clean_files("app", "old/")
+    assert sorted(storage.client.objects) == ["old/1.mp3", "old/2.mp3", "tts/kept.mp3"]
+
+
+def test_legacy_audio_cleanup_deletes_only_per_user_folders(make_minio_storage):
+    storage = make_minio_storage()
+    put(
+        storage,
+        USER_FOLDER + "1.mp3",
+        "users/" + USER_FOLDER + "2.mp3",
+        "tts/shared.mp3",
+        "other/3.mp3",
+    )
+    assert clean_legacy_folders(storage, "app", dry_run=True) == [
+        USER_FOLDER,
+        "users/" + USER_FOLDER,
+    ]
+    assert len(storage.client.objects) == 4
+    clean_legacy_folders(storage, "app")
+    assert sorted(storage.client.objects) == ["other/3.mp3", "tts/shared.mp3"]
@@ -0,0 +1,58 @@
+import threading
+from concurrent.futures import ThreadPoolExecutor
+import pytest
+from api.utils.pipeline import Pipeline
+from api.utils.tracing import get_trace_id, trace
+
+
+@pytest.fixture
+def executor():
+    with ThreadPoolExecutor(4) as executor:
+        yield executor
+
+
+def test_stages_get_the_results_of_their_dependencies(executor):
+    pipeline = Pipeline(executor)
+    pipeline.add("a", lambda: 1)
+    pipeline.add("b", lambda: 2)
+    pipeline.add("sum", lambda a, b: a + b, "a", "b")
+    pipeline.add("double", lambda total: total * 2, "sum")
+    pipeline.wait()
+    assert pipeline.result("double") == 6
+
+
+def test_independent_stages_run_concurrently(executor):
+    barrier = threading.Barrier(2, timeout=5)
+    pipeline = Pipeline(executor)
+    pipeline.add("a", barrier.wait)
+    pipeline.add("b", barrier.wait)
+    pipeline.wait(timeout=5)
+    assert {pipeline.result("a"), pipeline.result("b")} == {0, 1}
+
+
+def test_a_failure_fails_its_dependents_without_running_them(executor):
+    calls = []
+    pipeline = Pipeline(executor)
+
+    def fail():
+        raise ValueError("failed")
+
+    pipeline.add("failing", fail)
+    pipeline.add("other", lambda: "other")
+    pipeline.add("dependent", lambda *_: calls.append("dependent"), "failing", "other")
+    pipeline.add("indirect", lambda _: calls.append("indirect"), "dependent")
+    pipeline.wait(timeout=5)
+    for name in ("failing", "dependent", "indirect"):
+        with pytest.raises(ValueError, match="failed"):
+            pipeline.result(name)
+    assert pipeline.result("other") == "other"
+    assert calls == []
+
+
+def test_stages_keep_the_context_of_the_caller(executor):
+    pipeline = Pipeline(executor)
+    with trace("trace-1", "user-1"):
+        pipeline.add("first", get_trace_id)
+        pipeline.add("second", lambda _: get_trace_id(), "first")
+    pipeline.wait(timeout=5)
+    assert pipeline.result("first") == pipeline.result("second") == "trace-1"
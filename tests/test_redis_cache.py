@@ -0,0 +1,186 @@
+import asyncio
+import threading
+import pytest
+from api.storage.cache import (
+    AsyncMultiTierCacheAdapter,
+    AsyncRedisWrapper,
+    CacheConfig,
+    MultiTierCacheAdapter,
+    RedisWrapper,
+)
+from api.storage.codec import CacheCodec
+from api.utils.user_settings_manager import UserSettingsManager
+from benchmarks.fake_services import FakeRedis, FakeRedisStore, RouteStats
+
+
+@pytest.fixture(scope="module")
+def redis_service():
+    service = FakeRedis().start()
+    yield service
+    service.stop()
+
+
+@pytest.fixture
+def fake_redis(redis_service):
+    redis_service.redis = FakeRedisStore()
+    redis_service.stats = RouteStats()
+    return redis_service
+
+
+def make_wrapper(fake_redis) -> RedisWrapper:
+    return RedisWrapper(fake_redis.url, 2, CacheCodec())
+
+
+def make_redis_cache(fake_redis, cache_class=MultiTierCacheAdapter):
+    return cache_class(
+        CacheConfig(
+            remote_cache_enabled=True,
+            backend="redis",
+            redis_url=fake_redis.url,
+            redis_pool_size=2,
+            namespace="redis_test",
+        )
+    )
+
+
+def count_commands(fake_redis, name) -> int:
+    return fake_redis.stats.snapshot().get(f"redis {name}", (0, 0.0))[0]
+
+
+class Invalidations:
+    # Collects invalidations heard by a subscription, from another thread
+    def __init__(self):
+        self.condition = threading.Condition()
+        self.received = []
+
+    def __call__(self, key, version):
+        with self.condition:
+            self.received.append((key, version))
+            self.condition.notify_all()
+
+    def wait_for(self, count):
+        with self.condition:
+            self.condition.wait_for(lambda: len(self.received) >= count, timeout=5)
+        return self.received
+
+
+def test_values_round_trip(fake_redis):
+    wrapper = make_wrapper(fake_redis)
+    wrapper.set("key", {"a": 1}, seconds=60)
+    assert wrapper.get("key") == {"a": 1}
+    wrapper.set_many({"b": [1, 2], "c": "text"})
+    assert wrapper.get_many(["key", "b", "c", "missing"]) == {
+        "key": {"a": 1},
+        "b": [1, 2],
+        "c": "text",
+    }
+    wrapper.delete_many(["b", "c"])
+    wrapper.delete("key")
+    assert wrapper.get_many(["key", "b", "c"]) == {}
+    assert wrapper.get_many([]) == {}
+
+
+def test_many_keys_take_one_round_trip(fake_redis):
+    wrapper = make_wrapper(fake_redis)
+    wrapper.set_many({f"key{index}": index for index in range(10)})
+    assert len(wrapper.get_many([f"key{index}" for index in range(10)])) == 10
+    assert count_commands(fake_redis, "mget") == 1
+
+
+def test_lock_is_released_only_by_its_holder(fake_redis):
+    wrapper = make_wrapper(fake_redis)
+    assert wrapper.acquire_lock("lock", "first", 10)
+    assert not wrapper.acquire_lock("lock", "second", 10)
+    wrapper.release_lock("lock", "second")
+    assert not wrapper.acquire_lock("lock", "second", 10)
+    wrapper.release_lock("lock", "first")
+    assert wrapper.acquire_lock("lock", "second", 10)
+
+
+def test_compare_and_set_reports_conflicts(fake_redis):
+    wrapper = make_wrapper(fake_redis)
+    assert wrapper.compare_and_set_many({"a": (0, 1, "one"), "b": (0, 1, "b")}) == {}
+    # "a" is still at version 1, "b" was not expected to exist yet
+    conflicts = wrapper.compare_and_set_many({"a": (1, 2, "two"), "b": (0, 2, "x")})
+    assert conflicts == {"b": (1, "b")}
+    assert wrapper.get_many(["a", "b"]) == {"a": "two", "b": "b"}
+    assert wrapper.compare_and_set_many({}) == {}
+
+
+def test_writes_are_announced_to_subscribers(fake_redis):
+    invalidations = Invalidations()
+    assert make_wrapper(fake_redis).subscribe(invalidations)
+    # Wait for the subscription before writing, as it is made in the background
+    while fake_redis.redis.publish("cache.invalidations", "0 ready") == 0:
+        pass
+    make_wrapper(fake_redis).compare_and_set_many({"a": (0, 7, "value")})
+    assert invalidations.wait_for(2)[1:] == [("a", 7)]
+
+
+def test_adapter_uses_the_redis_backend(fake_redis):
+    writer, reader = (make_redis_cache(fake_redis) for _ in range(2))
+    writer.set_many({"a": 1, "b": 2})
+    assert reader.get_many(["a", "b", "c"]) == {"a": 1, "b": 2}
+    assert reader.local.get("a") == 1
+
+
+def test_async_wrapper(fake_redis):
+    invalidations = Invalidations()
+
+    async def main():
+        wrapper = AsyncRedisWrapper(fake_redis.url, 2, CacheCodec())
+        await wrapper.set_many({"a": 1, "b": 2})
+        await wrapper.set("c", 3, seconds=60)
+        values = await wrapper.get_many(["a", "b", "c", "d"])
+        await wrapper.delete_many(["a", "b"])
+        assert await wrapper.get("a") is None
+        assert await wrapper.acquire_lock("lock", "token", 10)
+        await wrapper.release_lock("lock", "token")
+        assert await wrapper.subscribe(invalidations)
+        while fake_redis.redis.publish("cache.invalidations", "0 ready") == 0:
+            await asyncio.sleep(0.01)
+        conflicts = await wrapper.compare_and_set_many(
+            {"c": (0, 1, "x"), "e": (0, 1, "e")}
+        )
+        await asyncio.get_running_loop().run_in_executor(
+            None, invalidations.wait_for, 2
+        )
+        wrapper.subscription.cancel()
+        await wrapper.redis.aclose()
+        return values, conflicts
+
+    values, conflicts = asyncio.run(main())
+    assert values == {"a": 1, "b": 2, "c": 3}
+    # "c" has no version key, so version 0 was expected and it was written
+    assert conflicts == {}
+    assert invalidations.received[1:] == [("c", 1), ("e", 1)]
+
+
+def test_async_adapter_shares_the_sync_adapters_values(fake_redis):
+    make_redis_cache(fake_redis).set("key", "value")
+
+    async def main():
+        cache = make_redis_cache(fake_redis, AsyncMultiTierCacheAdapter)
+        return await cache.get("key")
+
+    assert asyncio.run(main()) == "value"
+
+
+def test_settings_manager_subscribes_on_first_use(fake_redis):
+    manager = UserSettingsManager(make_redis_cache(fake_redis), "app")
+    other = UserSettingsManager(make_redis_cache(fake_redis), "app")
+    assert count_commands(fake_redis, "subscribe") == 0
+    assert manager.get_or_init_settings("user", {"language": "en"}) == {
+        "language": "en"
+    }
+    assert count_commands(fake_redis, "subscribe") == 1
+    while fake_redis.redis.publish("cache.invalidations", "0 ready") == 0:
+        pass
+    # A write of another worker drops the entry from the local tier
+    other.set_settings("user", {"language": "ja"})
+    key = manager.make_key("user")
+    for _ in range(500):
+        if manager.cache.local.get(key) is None:
+            break
+        threading.Event().wait(0.01)
+    assert manager.get_settings("user") == {"language": "ja"}
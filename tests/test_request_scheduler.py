@@ -0,0 +1,166 @@
+import asyncio
+import math
+import threading
+import pytest
+from api.utils.request_scheduler import (
+    MIN_RATE_FACTOR,
+    Budget,
+    Priority,
+    RequestScheduler,
+    TokenBucket,
+    Waiter,
+    parse_budgets,
+)
+
+
+def test_parse_budgets():
+    assert parse_budgets(" gpt-5-nano=500/200000, whisper-1=50,tts= ") == {
+        "gpt-5-nano": (500, 200000),
+        "whisper-1": (50, 0),
+        "tts": (0, 0),
+    }
+    with pytest.raises(ValueError):
+        parse_budgets("gpt-5-nano=many")
+
+
+def test_token_bucket_refills_over_time():
+    bucket = TokenBucket(60)
+    now = bucket.updated
+    assert bucket.wait_time(60, 1.0, now) == 0
+    bucket.take(60)
+    assert bucket.wait_time(1, 1.0, now) == pytest.approx(1.0)
+    assert bucket.wait_time(1, 1.0, now + 1) == pytest.approx(0.0)
+    # Half the rate doubles the wait
+    assert bucket.wait_time(2, 0.5, now + 1) == pytest.approx(2.0)
+
+
+def test_token_bucket_caps_large_requests():
+    bucket = TokenBucket(60)
+    now = bucket.updated
+    assert bucket.wait_time(1000, 1.0, now) == 0
+    bucket.take(1000)
+    assert bucket.level == 0
+    assert bucket.wait_time(1000, 1.0, now) == pytest.approx(60.0)
+
+
+def test_budget_slows_down_and_recovers():
+    budget = Budget(requests_per_minute=60)
+    now = budget.requests.updated
+    budget.slow_down(retry_after=5, now=now)
+    assert budget.rate_factor == 0.5
+    assert budget.wait_time(1, now) == pytest.approx(5.0)
+    for _ in range(10):
+        budget.slow_down(retry_after=0, now=now)
+    assert budget.rate_factor == MIN_RATE_FACTOR
+    for _ in range(100):
+        budget.speed_up()
+    assert budget.rate_factor == 1.0
+
+
+def test_unlimited_budget_never_waits():
+    budget = Budget()
+    budget.take(10**9)
+    assert budget.wait_time(10**9, 0.0) == 0
+
+
+def make_waiter(user, priority=Priority.INTERACTIVE, model="model", tokens=1):
+    return Waiter(model, priority, user, tokens)
+
+
+def grant_order(scheduler, waiters):
+    # Lets one waiter run at a time and records who was granted
+    order = []
+    with scheduler.condition:
+        for waiter in waiters:
+            scheduler.enqueue(waiter)
+        while scheduler.queued:
+            scheduler.grant()
+            granted = [w for w in waiters if w.granted and w not in order]
+            assert len(granted) == 1
+            order.extend(granted)
+            scheduler.running -= 1
+    return [(waiter.user, waiter.priority) for waiter in order]
+
+
+def test_users_take_turns():
+    scheduler = RequestScheduler("test", max_concurrency=1)
+    waiters = [make_waiter("a"), make_waiter("a"), make_waiter("a"), make_waiter("b")]
+    assert [user for user, _ in grant_order(scheduler, waiters)] == [
+        "a",
+        "b",
+        "a",
+        "a",
+    ]
+
+
+def test_interactive_goes_before_background():
+    scheduler = RequestScheduler("test", max_concurrency=1)
+    waiters = [
+        make_waiter("a", Priority.BACKGROUND),
+        make_waiter("b", Priority.INTERACTIVE),
+        make_waiter("c", Priority.BACKGROUND),
+        make_waiter("d", Priority.INTERACTIVE),
+    ]
+    assert grant_order(scheduler, waiters) == [
+        ("b", Priority.INTERACTIVE),
+        ("d", Priority.INTERACTIVE),
+        ("a", Priority.BACKGROUND),
+        ("c", Priority.BACKGROUND),
+    ]
+
+
+def test_budget_holds_back_its_model_only():
+    scheduler = RequestScheduler("test", budgets={"limited": (1, 0)})
+    limited = [make_waiter("a", model="limited"), make_waiter("b", model="limited")]
+    free = make_waiter("c", model="free")
+    with scheduler.condition:
+        for waiter in (*limited, free):
+            scheduler.enqueue(waiter)
+        delay = scheduler.grant()
+    assert [w.granted for w in (*limited, free)] == [True, False, True]
+    assert delay == pytest.approx(60.0, rel=0.01)
+    assert scheduler.running == 2
+
+
+def test_no_waiters_means_no_delay():
+    scheduler = RequestScheduler("test")
+    with scheduler.condition:
+        assert math.isinf(scheduler.grant())
+
+
+def test_acquire_blocks_until_release():
+    scheduler = RequestScheduler("test", max_concurrency=1)
+    scheduler.acquire("model", Priority.INTERACTIVE, "a", 1)
+    acquired = threading.Event()
+
+    def acquire():
+        scheduler.acquire("model", Priority.INTERACTIVE, "b", 1)
+        acquired.set()
+
+    thread = threading.Thread(target=acquire)
+    thread.start()
+    assert not acquired.wait(0.1)
+    scheduler.release()
+    assert acquired.wait(1)
+    thread.join()
+    assert scheduler.running == 1
+
+
+def test_cancelled_async_waiter_leaves_queue():
+    scheduler = RequestScheduler("test", max_concurrency=1)
+
+    async def main():
+        await scheduler.acquire_async("model", Priority.INTERACTIVE, "a", 1)
+        task = asyncio.create_task(
+            scheduler.acquire_async("model", Priority.INTERACTIVE, "b", 1)
+        )
+        await asyncio.sleep(0.05)
+        assert scheduler.queued == 1
+        task.cancel()
+        with pytest.raises(asyncio.CancelledError):
+            await task
+        scheduler.release()
+
+    asyncio.run(main())
+    assert scheduler.queued == 0
+    assert scheduler.running == 0
@@ -0,0 +1,84 @@
+import asyncio
+import threading
+from api.utils.segmented_translator import (
+    AsyncSegmentedTranslator,
+    SegmentedTranslator,
+    SegmentedTranslatorConfig,
+)
+from api.utils.text_segmenter import TextSegmenter
+from api.utils.tracing import get_trace_id, trace
+
+
+class FakeChatGPT:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.translated = []
+        self.prefetched = []
+
+    def translate(self, text, language):
+        with self.lock:
+            self.translated.append((text, get_trace_id()))
+        return f"<{text}>"
+
+    def prefetch_translations(self, texts, language):
+        self.prefetched.append(list(texts))
+
+
+def make_translator(chatgpt, threshold=10):
+    return SegmentedTranslator(
+        chatgpt,
+        TextSegmenter(),
+        SegmentedTranslatorConfig(threshold=threshold, segment_size=8, concurrency=4),
+    )
+
+
+def test_short_text_is_translated_whole():
+    chatgpt = FakeChatGPT()
+    assert make_translator(chatgpt).translate("Hi. Yo.", "ja") == "<Hi. Yo.>"
+    assert chatgpt.prefetched == []
+
+
+def test_long_text_is_translated_per_segment_in_order():
+    chatgpt = FakeChatGPT()
+    text = "One. Two. Three.\n\nFour."
+    result = make_translator(chatgpt).translate(text, "ja")
+    assert result == "<One.> <Two.> <Three.>\n\n<Four.>"
+    assert chatgpt.prefetched == [["One. ", "Two. ", "Three.\n\n", "Four."]]
+
+
+def test_segments_keep_the_callers_trace():
+    chatgpt = FakeChatGPT()
+    with trace("trace-1", "user-1"):
+        make_translator(chatgpt).translate("One. Two. Three.", "ja")
+    assert {trace_id for _, trace_id in chatgpt.translated} == {"trace-1"}
+
+
+class FakeAsyncChatGPT:
+    def __init__(self):
+        self.translated = []
+
+    async def translate(self, text, language):
+        self.translated.append((text, get_trace_id()))
+        return f"<{text}>"
+
+
+def test_async_translator_translates_segments_in_order():
+    chatgpt = FakeAsyncChatGPT()
+    translator = AsyncSegmentedTranslator(
+        chatgpt,
+        TextSegmenter(),
+        SegmentedTranslatorConfig(threshold=10, segment_size=8, concurrency=2),
+    )
+
+    async def main():
+        with trace("trace-1", "user-1"):
+            return (
+                await translator.translate("Hi. Yo.", "ja"),
+                await translator.translate("One. Two. Three.\n\nFour.", "ja"),
+            )
+
+    assert asyncio.run(main()) == (
+        "<Hi. Yo.>",
+        "<One.> <Two.> <Three.>\n\n<Four.>",
+    )
+    assert {trace_id for _, trace_id in chatgpt.translated} == {"trace-1"}
@@ -0,0 +1,78 @@
+import threading
+import time
+import pytest
+from api.utils.single_flight import SingleFlight
+
+
+def start_calls(read_counter, single_flight, count, func):
+    # Calls func through single_flight from count threads and returns once all but
+    # the leader wait for it; followers are counted right before they wait
+    def read_followers():
+        return read_counter("single_flight_shared_total", operation=single_flight.name)
+
+    followers = read_followers()
+    results = [None] * count
+
+    def run(index):
+        try:
+            results[index] = single_flight.do("key", func)
+        except Exception as error:
+            results[index] = error
+
+    threads = [threading.Thread(target=run, args=(i,)) for i in range(count)]
+    for thread in threads:
+        thread.start()
+    while read_followers() < followers + count - 1:
+        time.sleep(0.001)
+    return threads, results
+
+
+def test_concurrent_calls_share_one_result(read_counter):
+    single_flight = SingleFlight("shared_result")
+    release = threading.Event()
+    calls = []
+
+    def load():
+        calls.append(1)
+        release.wait(5)
+        return "value"
+
+    threads, results = start_calls(read_counter, single_flight, 5, load)
+    release.set()
+    for thread in threads:
+        thread.join()
+    assert results == ["value"] * 5
+    assert len(calls) == 1
+
+
+def test_concurrent_calls_share_one_error(read_counter):
+    single_flight = SingleFlight("shared_error")
+    release = threading.Event()
+    error = ValueError("failed")
+    calls = []
+
+    def load():
+        calls.append(1)
+        release.wait(5)
+        raise error
+
+    threads, results = start_calls(read_counter, single_flight, 5, load)
+    release.set()
+    for thread in threads:
+        thread.join()
+    assert results == [error] * 5
+    assert len(calls) == 1
+
+
+def test_failed_call_does_not_keep_the_key():
+    single_flight = SingleFlight("test")
+    with pytest.raises(ValueError):
+        single_flight.do("key", lambda: int("x"))
+    assert single_flight.calls == {}
+    assert single_flight.do("key", lambda: "value") == "value"
+
+
+def test_different_keys_do_not_share():
+    single_flight = SingleFlight("test")
+    assert single_flight.do("a", lambda: 1) == 1
+    assert single_flight.do("b", lambda: 2) == 2
@@ -0,0 +1,68 @@
+import pytest
+from api.utils.text_segmenter import TextSegmenter
+
+segmenter = TextSegmenter()
+
+
+@pytest.mark.parametrize(
+    "text, expected",
+    [
+        ("", []),
+        ("No end", ["No end"]),
+        ("One. Two! Three?", ["One. ", "Two! ", "Three?"]),
+        ("你好。今天天氣很好！", ["你好。", "今天天氣很好！"]),
+        ("「你好。」他說", ["「你好。」", "他說"]),
+        ('He said "Hi." Then left.', ['He said "Hi." ', "Then left."]),
+        ("Wait... What?!", ["Wait... ", "What?!"]),
+        ("It costs 3.50 dollars.", ["It costs 3.50 dollars."]),
+        ("See e.g.this", ["See e.g.this"]),
+        ("Line one\n\nLine two", ["Line one\n\n", "Line two"]),
+        ("a; b", ["a; b"]),
+    ],
+)
+def test_split_sentences(text, expected):
+    assert segmenter.split_sentences(text) == expected
+
+
+@pytest.mark.parametrize(
+    "text, final, expected",
+    [
+        ("", True, 0),
+        ("No end", True, 0),
+        ("One. Two", True, 5),
+        ("The total is 3.", True, 15),
+        # A streamed text may continue with "50"
+        ("The total is 3.", False, 0),
+        ("The total is 3. Next", False, 16),
+        ("Call Dr.", False, 0),
+        ("你好。", False, 3),
+        ("Line\n", False, 5),
+    ],
+)
+def test_find_sentence_end(text, final, expected):
+    assert segmenter.find_sentence_end(text, final) == expected
+
+
+def test_split_text_keeps_sentences_whole():
+    text = "One. Two. Three. Four."
+    assert segmenter.split_text(text, 10) == ["One. Two. ", "Three. ", "Four."]
+
+
+def test_split_text_cuts_long_sentences():
+    chunks = segmenter.split_text("short. " + "x" * 25, 10)
+    assert chunks == ["short. ", "x" * 10, "x" * 10, "x" * 5]
+    assert all(len(chunk) <= 10 for chunk in chunks)
+
+
+@pytest.mark.parametrize("max_length", [1, 3, 7, 50])
+def test_split_text_loses_nothing(max_length):
+    text = "第一句。Second one! 3.50 is a price.\n\nLast"
+    chunks = segmenter.split_text(text, max_length)
+    assert "".join(chunks) == text
+    assert all(0 < len(chunk) <= max_length for chunk in chunks)
+
+
+def test_split_paragraphs_packs_each_paragraph():
+    text = "A. B.\nC. D."
+    assert segmenter.split_paragraphs(text, 100) == ["A. B.\n", "C. D."]
+    assert "".join(segmenter.split_paragraphs(text, 3)) == text
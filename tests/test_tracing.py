@@ -0,0 +1,26 @@
+import logging
+from api.utils.tracing import enable_trace_id_logging, get_trace_id, get_user_id, trace
+
+
+def test_trace_sets_and_restores_ids():
+    with trace("outer", "user-1"):
+        with trace(user_id="user-2") as inner:
+            assert get_trace_id() == inner != "outer"
+            assert get_user_id() == "user-2"
+        assert (get_trace_id(), get_user_id()) == ("outer", "user-1")
+    assert (get_trace_id(), get_user_id()) == (None, None)
+
+
+def test_log_records_carry_the_trace_id(caplog):
+    factory = logging.getLogRecordFactory()
+    try:
+        enable_trace_id_logging()
+        # Enabling it again does not wrap the factory twice
+        enable_trace_id_logging()
+        with caplog.at_level(logging.INFO):
+            logging.getLogger("test").info("outside")
+            with trace("trace-1"):
+                logging.getLogger("test").info("inside")
+    finally:
+        logging.setLogRecordFactory(factory)
+    assert [record.trace_id for record in caplog.records] == ["-", "trace-1"]
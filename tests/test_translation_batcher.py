@@ -0,0 +1,128 @@
+import contextvars
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+import pytest
+from api.utils.translation_batcher import TranslationBatcher
+
+caller = contextvars.ContextVar("caller", default=None)
+
+
+class Translator:
+    def __init__(self, batch_error=None, failing_text=None):
+        self.batch_error = batch_error
+        self.failing_text = failing_text
+        self.batches = []
+        self.batch_callers = []
+        self.singles = []
+        self.lock = threading.Lock()
+
+    def translate_batch(self, texts, language):
+        with self.lock:
+            self.batches.append(list(texts))
+            self.batch_callers.append(caller.get())
+        if self.batch_error:
+            raise self.batch_error
+        return [f"{text}:{language}" for text in texts]
+
+    def translate_one(self, text, language):
+        with self.lock:
+            self.singles.append((text, caller.get()))
+        if text == self.failing_text:
+            raise RuntimeError(text)
+        return f"{text}:{language}"
+
+
+def make_batcher(translator, window_ms=50, max_size=4):
+    return TranslationBatcher(
+        window_ms, max_size, translator.translate_batch, translator.translate_one
+    )
+
+
+def translate_all(batcher, texts, language="ja"):
+    def translate(text):
+        caller.set(text)
+        try:
+            return batcher.translate(text, language)
+        except RuntimeError as error:
+            return error
+
+    with ThreadPoolExecutor(len(texts)) as executor:
+        return list(executor.map(translate, texts))
+
+
+def test_texts_in_window_are_sent_together():
+    translator = Translator()
+    results = translate_all(make_batcher(translator), ["a", "b", "c"])
+    assert results == ["a:ja", "b:ja", "c:ja"]
+    assert [sorted(batch) for batch in translator.batches] == [["a", "b", "c"]]
+    assert translator.singles == []
+
+
+def test_batch_is_requested_in_the_context_of_its_first_caller():
+    translator = Translator()
+    translate_all(make_batcher(translator), ["a", "b", "c"])
+    assert translator.batch_callers == [translator.batches[0][0]]
+
+
+def test_full_batch_is_sent_without_waiting():
+    translator = Translator()
+    batcher = make_batcher(translator, window_ms=10000, max_size=2)
+    start = time.perf_counter()
+    assert translate_all(batcher, ["a", "b"]) == ["a:ja", "b:ja"]
+    assert time.perf_counter() - start < 1
+
+
+def test_languages_are_batched_separately():
+    translator = Translator()
+    batcher = make_batcher(translator)
+    with ThreadPoolExecutor(2) as executor:
+        results = list(
+            executor.map(batcher.translate, ["a", "b"], ["ja", "en"]),
+        )
+    assert results == ["a:ja", "b:en"]
+    assert translator.batches == []
+    assert sorted(text for text, _ in translator.singles) == ["a", "b"]
+
+
+def test_failed_batch_falls_back_per_text():
+    translator = Translator(batch_error=ValueError("unusable response"))
+    results = translate_all(make_batcher(translator), ["a", "b", "c"])
+    assert results == ["a:ja", "b:ja", "c:ja"]
+    assert len(translator.batches) == 1
+    # Each fallback runs in the context of the caller who asked for it
+    assert sorted(translator.singles) == [("a", "a"), ("b", "b"), ("c", "c")]
+
+
+def test_other_batch_errors_reach_every_caller():
+    translator = Translator(batch_error=RuntimeError("rate limited"))
+    results = translate_all(make_batcher(translator), ["a", "b", "c"])
+    assert all(str(result) == "rate limited" for result in results)
+    assert len(translator.batches) == 1
+    assert translator.singles == []
+
+
+def test_fallback_errors_reach_their_own_caller():
+    translator = Translator(batch_error=ValueError("unusable"), failing_text="b")
+    results = translate_all(make_batcher(translator), ["a", "b", "c"])
+    assert results[0] == "a:ja" and results[2] == "c:ja"
+    assert isinstance(results[1], RuntimeError)
+
+
+def test_fallback_requests_run_concurrently():
+    class SlowTranslator(Translator):
+        def translate_one(self, text, language):
+            time.sleep(0.2)
+            return super().translate_one(text, language)
+
+    translator = SlowTranslator(batch_error=ValueError("unusable"))
+    start = time.perf_counter()
+    translate_all(make_batcher(translator), ["a", "b", "c", "d"])
+    assert time.perf_counter() - start < 0.6
+
+
+@pytest.mark.parametrize("batch_error", [None, ValueError("unusable")])
+def test_single_text_is_translated_alone(batch_error):
+    translator = Translator(batch_error=batch_error)
+    assert translate_all(make_batcher(translator), ["a"]) == ["a:ja"]
+    assert translator.batches == []
@@ -0,0 +1,138 @@
+import asyncio
+import threading
+import time
+from api.utils.translation_cache import (
+    AsyncTranslationCache,
+    TranslationCache,
+    make_translation_key,
+)
+
+ARGS = ("Hello", "Japanese", "gpt-5-nano", 1.0)
+
+
+def test_key_ignores_normalization_and_surrounding_whitespace():
+    composed, decomposed = "caf\u00e9", "cafe\u0301"
+    assert make_translation_key("app", composed, *ARGS[1:]) == make_translation_key(
+        "app", f"  {decomposed}\n", *ARGS[1:]
+    )
+
+
+def test_key_depends_on_model_and_temperature():
+    key = make_translation_key("app", *ARGS)
+    assert make_translation_key("app", "Hello", "Japanese", "gpt-5", 1.0) != key
+    assert make_translation_key("app", "Hello", "Japanese", "gpt-5-nano", 0.5) != key
+    assert make_translation_key("other", *ARGS) != key
+
+
+def test_stored_translation_is_shared(make_cache):
+    writer, reader = (TranslationCache(make_cache(), "app") for _ in range(2))
+    assert reader.get(*ARGS) is None
+    writer.set(*ARGS, "こんにちは")
+    assert reader.get(" Hello ", *ARGS[1:]) == "こんにちは"
+
+
+def test_translation_expires_after_ttl(make_cache, monkeypatch):
+    writer = TranslationCache(make_cache(ttl=60), "app")
+    writer.set(*ARGS, "こんにちは")
+    now = time.time()
+    monkeypatch.setattr(time, "time", lambda: now + 61)
+    # A worker that has not read the entry yet finds it expired
+    assert TranslationCache(make_cache(ttl=60), "app").get(*ARGS) is None
+
+
+def test_lookups_are_counted(make_cache, read_counter):
+    cache = TranslationCache(make_cache(), "app")
+    hits = read_counter("translation_cache_requests_total", result="hit")
+    misses = read_counter("translation_cache_requests_total", result="miss")
+    cache.get(*ARGS)
+    cache.set(*ARGS, "こんにちは")
+    cache.get(*ARGS)
+    cache.get(*ARGS)
+    assert read_counter("translation_cache_requests_total", result="hit") == hits + 2
+    assert read_counter("translation_cache_requests_total", result="miss") == misses + 1
+
+
+def test_async_cache_shares_entries(make_cache, make_async_cache):
+    cache = TranslationCache(make_cache(), "app")
+    cache.set(*ARGS, "こんにちは")
+
+    async def main():
+        async_cache = AsyncTranslationCache(make_async_cache(), "app")
+        await async_cache.set("Bye", *ARGS[1:], "さようなら")
+        return await async_cache.get(*ARGS)
+
+    assert asyncio.run(main()) == "こんにちは"
+    assert cache.get("Bye", *ARGS[1:]) == "さようなら"
+
+
+def make_locking_workers(make_cache, monkeypatch, lock_seconds):
+    # Translation caches of two workers that take the translation lock
+    monkeypatch.setattr(TranslationCache, "LOCK_POLL_INTERVAL", 0.01)
+    return [TranslationCache(make_cache(), "app", lock_seconds) for _ in range(2)]
+
+
+def test_lock_holder_translates_and_releases(make_cache, monkeypatch):
+    first, second = make_locking_workers(make_cache, monkeypatch, 10)
+    assert first.load(*ARGS, lambda: "こんにちは") == "こんにちは"
+    key = first.make_key(*ARGS)
+    # The lock was released, so another worker can take it right away
+    assert second.cache.acquire_lock(f"{key}.lock", "token", 10)
+
+
+def test_waiting_worker_polls_for_the_stored_result(make_cache, monkeypatch):
+    first, second = make_locking_workers(make_cache, monkeypatch, 10)
+    lock_key = f"{first.make_key(*ARGS)}.lock"
+    assert first.cache.acquire_lock(lock_key, "first", 10)
+    timer = threading.Timer(0.05, first.set, (*ARGS, "こんにちは"))
+    timer.start()
+    try:
+        assert second.load(*ARGS, lambda: "unexpected") == "こんにちは"
+    finally:
+        timer.join()
+
+
+def test_waiting_worker_translates_after_lock_timeout(
+    make_cache, monkeypatch, read_counter
+):
+    first, second = make_locking_workers(make_cache, monkeypatch, 1)
+    lock_key = f"{first.make_key(*ARGS)}.lock"
+    assert first.cache.acquire_lock(lock_key, "first", 1)
+    waits = read_counter("translation_cache_lock_waits_total")
+    start = time.monotonic()
+    assert second.load(*ARGS, lambda: "こんにちは") == "こんにちは"
+    assert time.monotonic() - start >= 1
+    assert read_counter("translation_cache_lock_waits_total") == waits + 1
+    assert first.get(*ARGS) == "こんにちは"
+
+
+def test_async_waiting_worker_polls_for_the_stored_result(
+    make_cache, make_async_cache, monkeypatch
+):
+    monkeypatch.setattr(AsyncTranslationCache, "LOCK_POLL_INTERVAL", 0.01)
+    first = TranslationCache(make_cache(), "app", 10)
+    lock_key = f"{first.make_key(*ARGS)}.lock"
+    assert first.cache.acquire_lock(lock_key, "first", 10)
+
+    async def translate():
+        return "unexpected"
+
+    async def main():
+        second = AsyncTranslationCache(make_async_cache(), "app", 10)
+        asyncio.get_running_loop().call_later(0.05, first.set, *ARGS, "こんにちは")
+        return await second.load(*ARGS, translate)
+
+    assert asyncio.run(main()) == "こんにちは"
+
+
+def test_async_lock_holder_translates_and_releases(make_cache, make_async_cache):
+    async def translate():
+        return "こんにちは"
+
+    async def main():
+        cache = AsyncTranslationCache(make_async_cache(), "app", 10)
+        return await cache.load(*ARGS, translate)
+
+    assert asyncio.run(main()) == "こんにちは"
+    other = TranslationCache(make_cache(), "app", 10)
+    assert other.get(*ARGS) == "こんにちは"
+    assert other.cache.acquire_lock(f"{other.make_key(*ARGS)}.lock", "token", 10)
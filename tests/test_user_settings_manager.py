@@ -0,0 +1,174 @@
+import asyncio
+from api.utils.user_settings_manager import (
+    AsyncUserSettingsManager,
+    UserSettingsManager,
+    make_settings_entry,
+    read_settings_entry,
+    resolve_writes,
+)
+
+DEFAULTS = {"translate_language": "English", "audio_language": "Japanese"}
+
+
+def make_manager(make_cache) -> UserSettingsManager:
+    return UserSettingsManager(make_cache(), "app")
+
+
+def test_read_settings_entry_accepts_unversioned_entries():
+    assert read_settings_entry(None) == (0, {})
+    assert read_settings_entry({"version": 5, "settings": {"a": 1}}) == (5, {"a": 1})
+    assert read_settings_entry({"a": 1}) == (0, {"a": 1})
+
+
+def test_resolve_writes():
+    old, new = make_settings_entry({"a": 1, "b": 1}), make_settings_entry({"a": 2})
+    # The change was made on an older entry: the stored settings are kept and
+    # the change applied on top
+    entries = resolve_writes({"key": (0, {"a": 2}, new)}, {"key": old})
+    assert entries == {"key": {"version": new["version"], "settings": {"a": 2, "b": 1}}}
+    # The stored entry is newer than the change: nothing is written
+    assert resolve_writes({"key": (0, {"a": 1}, old)}, {"key": new}) == {}
+    # Nothing stored: the entry is written as it is
+    assert resolve_writes({"key": (0, {"a": 2}, new)}, {}) == {"key": new}
+
+
+def test_new_user_gets_the_defaults(make_cache):
+    manager, other = make_manager(make_cache), make_manager(make_cache)
+    assert manager.get_or_init_settings("user", DEFAULTS) == DEFAULTS
+    assert other.get_settings("user") == DEFAULTS
+
+
+def test_concurrent_changes_of_two_workers_are_merged(make_cache):
+    first, second = make_manager(make_cache), make_manager(make_cache)
+    first.get_or_init_settings("user", DEFAULTS)
+    second.get_settings("user")
+    first.set_settings("user", {"audio_language": "Korean"})
+    # The second worker still holds the entry the first one replaced
+    settings = second.set_settings("user", {"translate_language": "French"})
+    expected = {"translate_language": "French", "audio_language": "Korean"}
+    assert settings == expected
+    assert make_manager(make_cache).get_settings("user") == expected
+
+
+def test_unversioned_entries_are_updated(make_cache):
+    manager = make_manager(make_cache)
+    manager.cache.remote.set(manager.make_key("user"), DEFAULTS)
+    settings = manager.set_settings("user", {"audio_language": "Korean"})
+    assert settings == {**DEFAULTS, "audio_language": "Korean"}
+    assert make_manager(make_cache).get_settings("user") == settings
+
+
+def test_write_behind_changes_are_flushed_together(make_cache):
+    manager = make_manager(make_cache)
+    manager.config.write_behind_ms = 60000
+    manager.get_or_init_settings("user", DEFAULTS)
+    manager.set_settings("user", {"audio_language": "Korean"})
+    manager.set_settings("user", {"translate_language": "French"})
+    reader = make_manager(make_cache)
+    assert reader.get_settings("user") == {}
+    manager.timer.cancel()
+    manager.flush()
+    assert manager.pending == {}
+    assert make_manager(make_cache).get_settings("user") == {
+        "translate_language": "French",
+        "audio_language": "Korean",
+    }
+
+
+def test_invalidate_drops_only_older_local_entries(make_cache):
+    manager = make_manager(make_cache)
+    manager.get_or_init_settings("user", DEFAULTS)
+    key = manager.make_key("user")
+    version, _ = read_settings_entry(manager.cache.local.get(key))
+    manager.invalidate(key, version)
+    assert manager.cache.local.get(key) is not None
+    manager.invalidate(key, version + 1)
+    assert manager.cache.local.get(key) is None
+
+
+def test_async_changes_of_two_workers_are_merged(make_async_cache):
+    async def run():
+        first = AsyncUserSettingsManager(make_async_cache(), "app")
+        second = AsyncUserSettingsManager(make_async_cache(), "app")
+        await first.get_or_init_settings("user", DEFAULTS)
+        await second.get_settings("user")
+        await first.set_settings("user", {"audio_language": "Korean"})
+        return await second.set_settings("user", {"translate_language": "French"})
+
+    assert asyncio.run(run()) == {
+        "translate_language": "French",
+        "audio_language": "Korean",
+    }
+
+
+class CountingWrapper:
+    # Records the calls made to the remote tier
+    def __init__(self, wrapper):
+        self.wrapper = wrapper
+        self.calls = []
+
+    def __getattr__(self, name):
+        method = getattr(self.wrapper, name)
+
+        def call(*args, **kwargs):
+            self.calls.append(name)
+            return method(*args, **kwargs)
+
+        return call
+
+
+def test_new_user_costs_one_read_and_one_conditional_write(make_cache):
+    manager = make_manager(make_cache)
+    # The subscription is made once per manager, not per user
+    manager.subscribe()
+    wrapper = manager.cache.remote.wrapper = CountingWrapper(
+        manager.cache.remote.wrapper
+    )
+    manager.get_or_init_settings("user", DEFAULTS)
+    assert wrapper.calls == ["get", "compare_and_set_many"]
+    wrapper.calls.clear()
+    manager.get_or_init_settings("user", DEFAULTS)
+    assert wrapper.calls == []
+
+
+class FlakySubscription:
+    # Fails the first subscription and records the later ones
+    def __init__(self):
+        self.calls = 0
+
+    def __call__(self, callback):
+        self.calls += 1
+        if self.calls == 1:
+            raise ConnectionError("unreachable")
+        return True
+
+
+def test_failed_subscription_is_retried_by_a_later_call(make_cache):
+    manager = make_manager(make_cache)
+    subscribe = manager.cache.subscribe = FlakySubscription()
+    assert manager.get_or_init_settings("user", DEFAULTS) == DEFAULTS
+    assert not manager.subscribed
+    manager.get_settings("user")
+    assert manager.subscribed
+    manager.get_settings("user")
+    assert subscribe.calls == 2
+
+
+def test_async_failed_subscription_is_retried_by_a_later_call(make_async_cache):
+    manager = AsyncUserSettingsManager(make_async_cache(), "app")
+    subscription = FlakySubscription()
+
+    async def subscribe(callback):
+        return subscription(callback)
+
+    manager.cache.subscribe = subscribe
+
+    async def run():
+        settings = await manager.get_or_init_settings("user", DEFAULTS)
+        assert not manager.subscribed
+        await manager.get_settings("user")
+        return settings
+
+    assert asyncio.run(run()) == DEFAULTS
+    assert manager.subscribed
+    assert subscription.calls == 2